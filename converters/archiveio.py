@@ -0,0 +1,142 @@
+#!env/bin/python
+"""
+Reading the files to convert from, and writing the converted files to, zip and tar archives, so a batch does not
+have to be unpacked into the in folder and repacked from the out folder. Members are read into memory and passed
+to the converters as file objects, and outputs are added to the archive as entries.
+
+In a parallel conversion, each worker process opens the in archive itself, while the out archive is an OutputSink
+written by the main process.
+"""
+import io
+import os
+import tarfile
+import time
+import zipfile
+
+from .outputsink import OutputSink
+
+ZIP_EXTENSIONS = ('.zip',)
+TAR_MODES = (('.tar.gz', 'gz'), ('.tgz', 'gz'), ('.tar.bz2', 'bz2'), ('.tar.xz', 'xz'), ('.tar', ''))
+
+
+def archive_kind(fpath):
+    """
+    Returns 'zip' or the tar compression ('' for none) for the path of an archive, or None if it is not one
+    """
+    lower = fpath.lower()
+    if lower.endswith(ZIP_EXTENSIONS):
+        return 'zip'
+    for ext, comp in TAR_MODES:
+        if lower.endswith(ext):
+            return comp
+    return None
+
+
+def is_archive(fpath):
+    return archive_kind(fpath) is not None
+
+
+class ArchiveReader:
+    """
+    An archive of files to convert. Files are known by their base names, as the converters derive ids from them,
+    so folders in the archive are ignored.
+    """
+    def __init__(self, fpath):
+        if not os.path.isfile(fpath):
+            raise FileNotFoundError("The in archive, {}, does not exist".format(fpath))
+        self.path = fpath
+        self.kind = archive_kind(fpath)
+        self.archive = None
+        self.pid = None
+        self.members = {}  # Member names keyed on base name
+        self.open()
+        if self.kind == 'zip':
+            names = [info.filename for info in self.archive.infolist() if not info.is_dir()]
+        else:
+            names = [info.name for info in self.archive.getmembers() if info.isfile()]
+        for name in names:
+            basename = name.rsplit('/', 1)[-1]
+            if '__MACOSX' in name or basename in self.members:
+                continue
+            self.members[basename] = name
+
+    def open(self):
+        # Archives are opened once per process, as an open archive cannot be shared with a forked process
+        if self.archive is not None:
+            self.archive.close()
+        if self.kind == 'zip':
+            self.archive = zipfile.ZipFile(self.path)
+        else:
+            self.archive = tarfile.open(self.path, 'r:' + self.kind)
+        self.pid = os.getpid()
+
+    def names(self):
+        return sorted(self.members)
+
+    def read(self, basename):
+        """
+        Returns a file object with the content of a member
+        """
+        if self.pid != os.getpid():
+            self.open()
+        name = self.members[basename]
+        if self.kind == 'zip':
+            return io.BytesIO(self.archive.read(name))
+        return io.BytesIO(self.archive.extractfile(name).read())
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['archive'] = None
+        state['pid'] = None
+        return state
+
+
+class ArchiveWriter(OutputSink):
+    """
+    An archive the converted files are written to as entries. It is created when the first entry is added, replacing
+    any existing archive, and must be closed at the end of the conversion.
+    """
+    unpicklable = ('archive',)
+
+    def __init__(self, fpath):
+        super().__init__(fpath)
+        self.kind = archive_kind(fpath)
+        self.archive = None
+        self.names = set()
+
+    def add(self, name, data):
+        """
+        Adds an entry with the given bytes
+        """
+        self.put((name, data))
+
+    def write(self, item):
+        name, data = item
+        if self.archive is None:
+            self.create()
+        if name in self.names:
+            raise FileExistsError("The archive {} already has an entry {}".format(self.path, name))
+        self.names.add(name)
+        if self.kind == 'zip':
+            self.archive.writestr(name, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = time.time()
+            self.archive.addfile(info, io.BytesIO(data))
+
+    def create(self):
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        if self.kind == 'zip':
+            self.archive = zipfile.ZipFile(self.path, 'w', zipfile.ZIP_DEFLATED)
+        else:
+            self.archive = tarfile.open(self.path, 'w:' + self.kind)
+
+    def close(self):
+        self.stop_listener()
+        with self.lock:
+            if self.archive is not None:
+                self.archive.close()
+                self.archive = None
@@ -5,11 +5,27 @@ But not yet finalized
 """
 import os
 import logging
+import multiprocessing
 from .styleelements import fontSame
+from . import archiveio, conversionlog, outputsink, progress
+from .archiveio import ArchiveReader, ArchiveWriter
+from .media import image_rel_ids
+from .progress import Progress, ProgressMonitor
+from .stylecache import StyleCache
 
 TEMPLATE_FOLDER = 'templates'
 
 
+def init_worker(progress_queue, quiet, log_queue, loglevel, sink_queues=None):
+    """
+    Initializer for the processes of the worker pool of a parallel conversion
+    """
+    progress.init_worker(progress_queue, quiet)
+    conversionlog.init_worker(log_queue, loglevel)
+    if sink_queues:
+        outputsink.init_worker(sink_queues)
+
+
 class BaseConverter:
     def __init__(self, args, other_settings=None):
         self.args = args
@@ -18,13 +34,24 @@ class BaseConverter:
         self.current_file_path = ''
         self.indir = args.indir
         self.infile_ext = args.extension
-        if not os.path.isdir(self.indir):
+        # The in and out paths can also be zip or tar archives
+        self.inarchive = ArchiveReader(self.indir) if archiveio.is_archive(self.indir) else None
+        if self.inarchive is None and not os.path.isdir(self.indir):
             raise NotADirectoryError("The in path, {}, is not a directory".format(self.indir))
         self.getfiles()
         self.outdir = args.out
         self.overwrite = args.overwrite
-        if not os.path.isdir(self.outdir):
+        self.outarchive = ArchiveWriter(self.outdir) if archiveio.is_archive(self.outdir) else None
+        if self.outarchive is not None:
+            if os.path.isfile(self.outdir) and not self.overwrite:
+                raise FileExistsError("The out archive, {}, already exists. "
+                                      "Use --overwrite to replace it".format(self.outdir))
+        elif not os.path.isdir(self.outdir):
             raise NotADirectoryError("The out path, {}, is not a directory".format(self.outdir))
+        self.textstore = None  # The TextStore of converters that also store their outputs in a database
+        # The style names of the documents, looked up by style id. With -sc, they are also saved for later conversions
+        self.stylecache = StyleCache(args.style_cache if 'style_cache' in args else None)
+        self.styles = None  # The StyleTable of the current document
         self.metafields = args.metafields if args.metafields else False
         self.template = args.template
         self.xmltemplate = ''
@@ -45,11 +72,16 @@ class BaseConverter:
         self.textid = ''
         self.log = args.log
         self.loglevel = logging.DEBUG if self.debug else logging.WARN
-        logging.basicConfig(level=self.loglevel)
+        conversionlog.start(self.loglevel)
+        self.check_log()
         self.other_settings = other_settings
+        self.quiet = args.quiet if args.quiet else False
+        progress.set_quiet(self.quiet)
+        self.jobs = max(int(args.jobs), 1) if args.jobs else 1
+        self.interactive = True  # Whether the user can be prompted, false in worker processes
 
     def getfiles(self):
-        files_in_dir = os.listdir(self.indir)
+        files_in_dir = self.inarchive.names() if self.inarchive else os.listdir(self.indir)
         files_in_dir.sort()
         for sfile in files_in_dir:
             if sfile.endswith(self.infile_ext) and not sfile.startswith('~'):
@@ -60,19 +92,169 @@ class BaseConverter:
         logpath = os.path.join(self.log, self.current_file.replace('docx', 'log'))
         if self.debug:
             print("Log file for {} is: {}".format(self.current_file, logpath))
-        loghandler = logging.FileHandler(logpath, 'w')
-        log = logging.getLogger()
-        for hdlr in log.handlers[:]:
-            log.removeHandler(hdlr)
-        log.addHandler(loghandler)
+        conversionlog.start_document(logpath, self.current_file)
+
+    def check_log(self):
+        """
+        Checks the log folder before any file is converted, if each file is logged to it, which it is with -d
+        """
+        if self.debug:
+            conversionlog.check_folder(self.log)
+
+    @staticmethod
+    def endlog():
+        conversionlog.end_document()
 
     def convert(self):
-        for fl in self.files:
-            print("\n======================================\nConverting file: {}".format(fl))
-            self.current_file = fl
-            if self.debug:
-                self.setlog()
+        try:
+            if self.jobs > 1 and len(self.files) > 1:
+                self.convert_parallel(self.files)
+            else:
+                for fl in self.files:
+                    self.convertfile(fl)
+        finally:
+            self.close_sinks()
+
+    def sinks(self):
+        """
+        Returns the outputs shared by all the files, which are written by the main process in a parallel conversion
+        """
+        sinks = [sink for sink in (self.outarchive, self.textstore) if sink is not None]
+        return sinks + ([self.stylecache] if self.stylecache.path else [])
+
+    def close_sinks(self):
+        """
+        Closes the shared outputs at the end of a conversion, also when it fails or is interrupted, so an out archive
+        or database is finished and the items of the files converted are not lost. Raises a ConversionException if
+        the items sent by the worker processes of a parallel conversion could not all be written
+        """
+        failures = []
+        for sink in self.sinks():
+            sink.close()
+            failures += ["{} ({})".format(sink.path, err) for err in sink.failures]
+        if failures:
+            raise ConversionException("Could not write {} items to the shared outputs, the first to {}".format(
+                len(failures), failures[0]))
+
+    def open_input(self, fname):
+        """
+        Returns the path of a file to convert, or a file object with its content if reading from an archive
+        """
+        if self.inarchive is not None:
+            return self.inarchive.read(fname)
+        return os.path.join(self.indir, fname)
+
+    def write_output(self, fname, data):
+        """
+        Writes the bytes of a converted file to the out folder, or as an entry of the out archive
+
+        :param fname: the path of the file relative to the out folder
+        """
+        if self.outarchive is not None:
+            self.outarchive.add(fname.replace(os.sep, '/'), data)
+            return
+        fpth = os.path.join(self.outdir, fname)
+        os.makedirs(os.path.dirname(fpth), exist_ok=True)
+        with open(fpth, 'wb') as outfile:
+            outfile.write(data)
+
+    def convertfile(self, fl):
+        progress.message("\n======================================\nConverting file: {}".format(fl))
+        self.current_file = fl
+        if self.debug:
+            self.setlog()
+        else:
+            # Without a log file, the repeated messages are still counted per file
+            conversionlog.start_document(None, fl)
+        try:
             self.convertdoc()
+        finally:
+            self.endlog()
+
+    def convertfile_task(self, fl):
+        """
+        Converts a single file in a worker process of a parallel conversion
+
+        :param fl: the file name
+        :return: tuple: (file name, error message or None if converted)
+        """
+        self.interactive = False
+        try:
+            self.convertfile(fl)
+        except Exception as e:
+            return fl, "{}: {}".format(e.__class__.__name__, e)
+        return fl, None
+
+    def convert_parallel(self, items, task=None, label="Converted files", results=None):
+        """
+        Converts the items (usually file names) in a pool of self.jobs worker processes, showing the combined progress
+        of the workers. The task is called with each item and must return a tuple of the item and an error message
+        or None. The default task is convertfile_task().
+
+        :param results: optional list to which the item returned by the task for every item is appended
+        :return: list of (item, error message) tuples for the items that failed
+        """
+        task = task or self.convertfile_task
+        queue = multiprocessing.Queue()
+        log_queue, log_listener = conversionlog.start_worker_listener()
+        monitor = ProgressMonitor(label, len(items), queue)
+        sink_queues = {sink.path: sink.start_listener() for sink in self.sinks()}
+        failed = []
+        monitor.start()
+        pool = multiprocessing.Pool(self.jobs, initializer=init_worker,
+                                    initargs=(queue, self.quiet, log_queue, self.loglevel, sink_queues))
+        try:
+            for item, err in pool.imap_unordered(task, items):
+                if results is not None:
+                    results.append(item)
+                if err:
+                    failed.append((item, err))
+                monitor.item_done(err is not None)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            # Wait for the workers to exit so their queued log records and progress updates are all delivered
+            pool.join()
+            log_listener.stop()
+            monitor.stop()
+            for sink in self.sinks():
+                sink.stop_listener()
+        for item, err in failed:
+            print("Failed to convert {}: {}".format(item_name(item), err))
+        return failed
+
+    def run_tasks(self, items, task=None, label="Converted files", results=None):
+        """
+        Runs a task for each item, in worker processes with convert_parallel() if there is more than one job and item,
+        otherwise one after the other in this process, and closes the shared outputs at the end. The task is called
+        as in convert_parallel().
+
+        :param results: optional list to which the item returned by the task for every item is appended, which keeps
+                        the results of the items done if the conversion is interrupted
+        :return: tuple: (the list of the items returned by the task, list of (item, error message) tuples for the
+                 items that failed)
+        """
+        task = task or self.convertfile_task
+        results = [] if results is None else results
+        try:
+            if self.jobs > 1 and len(items) > 1:
+                failed = self.convert_parallel(items, task=task, label=label, results=results)
+            else:
+                failed = []
+                prog = Progress(label, len(items))
+                for item in items:
+                    result, err = task(item)
+                    results.append(result)
+                    if err:
+                        failed.append((result, err))
+                        print("Failed to convert {}: {}".format(item_name(result), err))
+                    prog.update(detail=item_name(item))
+                prog.close()
+        finally:
+            self.close_sinks()
+        return results, failed
 
     def convertdoc(self):
         pass
@@ -80,15 +262,15 @@ class BaseConverter:
     def merge_runs(self):
         '''
         Take a document and go through all runs in all paragraphs, if two consecutive runs have the same style, then merge them
+        The style names are looked up in self.styles, the StyleTable of the document
 
         :param doc:
         :return:
         '''
-        totp = len(self.worddoc.paragraphs)
-        ct = 0
-        for para in self.worddoc.paragraphs:
-            ct += 1
-            print("\rMerging runs: {}%".format(int(ct/totp*100)), end='')
+        paras = self.worddoc.paragraphs
+        prog = Progress("Merging runs", len(paras))
+        for para in paras:
+            prog.update()
             runs2remove = []
             lastrun = False
             # Merge runs with same style
@@ -98,7 +280,10 @@ class BaseConverter:
                     lastrun = r
                 elif not fontSame(lastrun, r):
                     lastrun = r
-                elif r.style.name == lastrun.style.name:
+                elif image_rel_ids(r.element) or image_rel_ids(lastrun.element):
+                    # Setting the text of a run removes its images
+                    lastrun = r
+                elif self.styles.run_style(r) == self.styles.run_style(lastrun):
                     # Otherwise is charstyle and font characteristics are the same, append the two
                     lastrun.text += r.text
                     runs2remove.append(r)
@@ -109,4 +294,15 @@ class BaseConverter:
             for rr in runs2remove:
                 el = rr._element
                 el.getparent().remove(el)
-        print("")
+        prog.close()
+
+
+def item_name(item):
+    """
+    Returns the name of an item of a conversion, which is a file name or a tuple starting with the path of a file
+    """
+    return item if isinstance(item, str) else item[0]
+
+
+class ConversionException(Exception):
+    pass
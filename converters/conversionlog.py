@@ -0,0 +1,198 @@
+#!env/bin/python
+"""
+Logging pipeline for the converters. Records are put on a queue by a QueueHandler on the root logger and written by a
+QueueListener thread, so the conversion does not wait on log writes. Each document has its own buffered log file,
+started with start_document() and closed with end_document(). Messages of the same category are only logged the first
+few times in a document, and the number of repeats is added to the end of its log, e.g. "style X missing ×412", or
+printed to stderr for a document converted without a log file.
+
+In a parallel conversion, the worker processes put their records on a multiprocessing queue that is read by a listener
+in the parent process. So every log file is written by a single process and the records of a document stay together.
+"""
+import atexit
+import logging
+import multiprocessing
+import os
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+REPEAT_LIMIT = 3  # Number of times a message category is logged per document before it is only counted
+LOG_BUFFER_SIZE = 64 * 1024
+CONSOLE_FORMAT = '%(levelname)s:%(name)s:%(message)s'
+
+listener = None
+docfilter = None
+
+
+class DocumentFilter(logging.Filter):
+    """
+    Filter on the queue handler of a process that stamps each record with the current document log path and
+    suppresses the repeats of a message category beyond REPEAT_LIMIT, counting them instead
+    """
+    def __init__(self):
+        super().__init__()
+        self.document = None  # The log path of the current document, None if it has no log file
+        self.docname = None  # The name of the current document, None outside of a document
+        self.counts = {}
+
+    def filter(self, record):
+        record.document = self.document
+        category = getattr(record, 'category', None) or record.getMessage()
+        ct = self.counts.get(category, 0) + 1
+        self.counts[category] = ct
+        return ct <= REPEAT_LIMIT
+
+    def repeats(self):
+        return ["{} ×{}".format(cat, ct) for cat, ct in self.counts.items() if ct > REPEAT_LIMIT]
+
+
+class LogRouter(logging.Handler):
+    """
+    Handler of the queue listener that writes each record to the buffered log file of its document. Records flagged
+    as console messages (from mylog) are also printed and records outside of a document go to stderr as they did
+    with logging.basicConfig
+    """
+    def __init__(self):
+        super().__init__()
+        self.files = {}
+        self.consoleformatter = logging.Formatter(CONSOLE_FORMAT)
+
+    def emit(self, record):
+        # An error here, e.g. a log file that cannot be opened, must not stop the listener thread
+        try:
+            doc = getattr(record, 'document', None)
+            if getattr(record, 'control', None) == 'close':
+                logfile = self.files.pop(doc, None) if doc else None
+                if logfile is not None:
+                    for line in record.repeats:
+                        logfile.write(line + "\n")
+                    logfile.close()
+                elif record.repeats:
+                    sys.stderr.write("Repeated messages in {}:\n".format(record.docname))
+                    for line in record.repeats:
+                        sys.stderr.write("\t" + line + "\n")
+                return
+            msg = record.getMessage()
+            if getattr(record, 'console', False):
+                print(msg)
+            if doc:
+                logfile = self.files.get(doc)
+                if logfile is None:
+                    logfile = open(doc, 'w', encoding='utf-8', buffering=LOG_BUFFER_SIZE)
+                    self.files[doc] = logfile
+                logfile.write(msg + "\n")
+            elif not getattr(record, 'console', False):
+                sys.stderr.write(self.consoleformatter.format(record) + "\n")
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        for logfile in self.files.values():
+            logfile.close()
+        self.files = {}
+        super().close()
+
+
+router = LogRouter()
+
+
+def setup_process(logqueue, level):
+    """
+    Replaces the handlers of the root logger of this process with a queue handler and document filter
+    """
+    global docfilter
+    docfilter = DocumentFilter()
+    qhandler = QueueHandler(logqueue)
+    qhandler.addFilter(docfilter)
+    log = logging.getLogger()
+    for hdlr in log.handlers[:]:
+        log.removeHandler(hdlr)
+    log.addHandler(qhandler)
+    log.setLevel(level)
+
+
+def start(level):
+    """
+    Starts the logging pipeline in the main process
+    """
+    global listener
+    if listener is not None:
+        logging.getLogger().setLevel(level)
+        return
+    logqueue = queue.SimpleQueue()
+    setup_process(logqueue, level)
+    listener = QueueListener(logqueue, router)
+    listener.start()
+    atexit.register(stop)
+
+
+def stop():
+    global listener
+    if listener is not None:
+        end_document()
+        listener.stop()
+        listener = None
+        router.close()
+
+
+def start_worker_listener():
+    """
+    Starts a listener in the main process for the records of the worker processes of a parallel conversion
+
+    :return: tuple: (the multiprocessing queue to pass to init_worker(), the listener to stop after the conversion)
+    """
+    logqueue = multiprocessing.Queue()
+    wklistener = QueueListener(logqueue, router)
+    wklistener.start()
+    return logqueue, wklistener
+
+
+def init_worker(logqueue, level):
+    """
+    Initializer for worker processes, which send their log records to the listener of the parent process
+    """
+    setup_process(logqueue, level)
+
+
+def check_folder(logdir):
+    """
+    Raises NotADirectoryError if the log folder does not exist, so a conversion fails before its log files are
+    opened by the listener thread
+    """
+    if not os.path.isdir(logdir):
+        raise NotADirectoryError("The log path, {}, is not a directory".format(logdir))
+
+
+def start_document(logpath, docname):
+    """
+    Starts logging the records of this process to the log file of a document, or if logpath is None only counting
+    the repeats of its messages
+    """
+    end_document()
+    if logpath is not None:
+        check_folder(os.path.dirname(logpath) or '.')
+    if docfilter is not None:
+        docfilter.document = logpath
+        docfilter.docname = docname
+        docfilter.counts = {}
+
+
+def end_document():
+    """
+    Closes the log file of the current document after adding the counts of the repeated messages, which are printed
+    to stderr if it has no log file
+    """
+    if docfilter is None or docfilter.docname is None:
+        return
+    record = logging.LogRecord('root', logging.INFO, '', 0, 'end of document log', None, None)
+    record.control = 'close'
+    record.document = docfilter.document
+    record.docname = docfilter.docname
+    record.repeats = docfilter.repeats()
+    docfilter.document = None
+    docfilter.docname = None
+    docfilter.counts = {}
+    for hdlr in logging.getLogger().handlers:
+        if isinstance(hdlr, QueueHandler):
+            hdlr.enqueue(record)
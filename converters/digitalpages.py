@@ -3,55 +3,152 @@
 A convert that just addes digital pages to word docs
 """
 from .baseconverter import BaseConverter
+from .progress import Progress
+from .pageplan import plan_pages, RUN_SEPARATOR
 from os import path
+from fnmatch import fnmatch
+from io import BytesIO
+import json
 import docx
 from docx.text.run import Run
-from docx.oxml.text.run import CT_R
+from docx.oxml import OxmlElement
 import re
+import time
+from copy import deepcopy
+
+PROFILE_FOLDER = 'profiles'
+TSEK_PATTERN = r'[\u0F00-\u0F14\u0F3A-\u0F3D\u0FD2-\u0FD8\s]+'  # at least one of the Tibetan punctuation or space-like characters
+# The digital paging settings that can be given in -opt, a profile or a batch manifest, with the attribute of the
+# DigitalPaginator each sets, and its key if the attribute is a dictionary
+PAGING_SETTINGS = {
+    'lines_per_page': ('lines_per_page', None),
+    'tsek_per_line': ('tsek_per_line', None),
+    'page_style': ('digstyles', 'page'),
+    'line_style': ('digstyles', 'line'),
+    'page_template': ('tmplts', 'page'),
+    'line_template': ('tmplts', 'line'),
+    'tsek_pattern': ('tsekpattern', None),
+}
 
 
 class DigitalPages(BaseConverter):
     def __init__(self, args, **kwargs):
         super().__init__(args, **kwargs)
         self.outfile = ""
+        self.paging = PagingOptions(args.options if 'options' in args else '')
+        self.paginator = None
+        self.plan_only = args.plan_only if 'plan_only' in args else False
+
+    def convertdoc(self):
+        self.current_file_path = self.open_input(self.current_file)
+        self.worddoc = docx.Document(self.current_file_path)
+        self.styles = self.stylecache.table(self.worddoc)
+        self.merge_runs()
+        self.paginator = self.paging.paginator(self.current_file)
+        self.paginator.plan_document(self.worddoc, self.styles)
+        if self.plan_only:
+            self.paginator.report_plan(self.current_file)
+            return
+        self.paginator.apply()
+        outname = self.current_file.replace('.doc', '-out.doc')
+        if self.outarchive is not None:
+            docdata = BytesIO()
+            self.worddoc.save(docdata)
+            self.write_output(outname, docdata.getvalue())
+            return
+        self.outfile = path.join(self.outdir, outname)
+        self.worddoc.save(self.outfile)
+
+
+class DigitalPaginator:
+    """
+    Adds digital pages and lines to a Word document, after every tsek_per_line tsek groups and lines_per_page lines,
+    as runs in the digital page and line styles, e.g. [2] and [2.1]. The DigitalPages converter saves the paginated
+    document, while the TextConverter paginates the document it is converting with the -dp option, so the runs
+    become digpage and digline milestones without an intermediate document.
+    """
+    def __init__(self):
         self.lines_per_page = 15
         self.tsek_per_line = 20
         self.digstyles = {
             'page': 'page number',  # 'page number',  # This is the digital page style name (page number repurposed)
             'line': 'line number'  # 'line number' # this is the digital line style name
         }
-        # style_id_list = [digpage_style_id, digline_style_id]
         self.pgct = 1  # Page start 1 (to insert first page and line markers)
         self.lnct = 0  # Line start 0 (increment after adding so we can use = below)
-        self.ct = 0
         self.tmplts = {
             'page': 'tdp',
             'line': 'tdl'
         }
-        self.tsekpattern = r'[\u0F00-\u0F14\u0F3A-\u0F3D\u0FD2-\u0FD8\s]+'  # at least one of the Tibetan punctuation or space-like characters
+        self.tsekpattern = TSEK_PATTERN
         self.tskcount = 0
-        self.donefirst = False
+        self.tsekre = None
+        self.placeholderre = None
+        self.digstyle_ids = {}
+        self.worddoc = None
+        self.styles = None
+        self.paras = []
+        self.runs = []
+        self.plan = None
+        self.plantime = 0.0
 
-    def convertdoc(self):
-        self.current_file_path = path.join(self.indir, self.current_file)
-        self.worddoc = docx.Document(self.current_file_path)
-        self.merge_runs()
-        totalpct = len(self.worddoc.paragraphs)
-        pct = 0
-        # Reset class variables for each document
-        self.pgct = 1
-        self.lnct = 0
-        self.ct = 0
-        self.tskcount = 0
-        self.donefirst = False
+    def configure(self, settings):
+        """
+        Sets the paging settings from a dictionary keyed on the names in PAGING_SETTINGS
+        """
+        for name, val in settings.items():
+            attr, key = PAGING_SETTINGS[name]
+            if key is None:
+                setattr(self, attr, val)
+            else:
+                getattr(self, attr)[key] = val
+        return self
+
+    def plan_document(self, worddoc, styles):
+        """
+        Plans the digital pages and lines of a document, whose runs should already be merged
+
+        :param styles: the StyleTable of the document
+        :return: the PagePlan
+        """
+        self.worddoc = worddoc
+        self.styles = styles
+        self.tsekre = re.compile(self.tsekpattern)
+        self.paras = self.content_paragraphs()
+        self.runs = [r for p in self.paras for r in p.runs]
+        plstart = time.perf_counter()
+        self.plan = plan_pages([r.text for r in self.runs], self.tsekre, self.tsek_per_line, self.lines_per_page)
+        self.plantime = (time.perf_counter() - plstart) * 1000
+        # Set the counters to where the document ends
+        self.pgct = self.plan.page_count
+        self.lnct = len(self.plan.lines) % self.lines_per_page
+        self.tskcount = self.plan.tsek_remainder
+        return self.plan
 
-        print("Inserting placeholders ...")
+    def apply(self):
+        """
+        Adds the planned pages and lines to the document as runs in the digital page and line styles
+        """
+        self.placeholderre = re.compile(r'\[({})\s+\d+\]|\[({})\s+\d+\.\d+\]'.format(
+            re.escape(self.tmplts['page']), re.escape(self.tmplts['line'])))
+        # Resolve the digital styles once for the document
+        self.digstyle_ids = {mstype: self.worddoc.styles[stnm].style_id for mstype, stnm in self.digstyles.items()}
+        self.apply_plan()
+        prog = Progress("Inserting placeholders", len(self.paras))
+        for p in self.paras:
+            prog.update()
+            self.apply_styles(p)
+        prog.close()
 
+    def content_paragraphs(self):
+        """
+        Returns the paragraphs to paginate: those after the first heading (usually front or body) that are not
+        headings or page or line numbers
+        """
+        paras = []
         foundhead = False
         for p in self.worddoc.paragraphs:
-            pct += 1
-            print("\rDoing paragraph {} of {}        ".format(pct, totalpct), end="")
-            psnm = p.style.name
+            psnm = self.styles.paragraph_style(p)
             # Don't start counting until we get the first header (usually front or body)
             if not foundhead and 'Heading' not in psnm:
                 continue
@@ -63,95 +160,178 @@ class DigitalPages(BaseConverter):
                     doinsert = False
                     break
             if doinsert:
-                self.insert_ms(p)
-                self.apply_styles(p)
-        print("\n")
-        self.outfile = path.join(self.outdir, self.current_file.replace('.doc', '-out.doc'))
-        self.worddoc.save(self.outfile)
+                paras.append(p)
+        return paras
 
-    def insert_ms(self, p):
-        for r in p.runs:
-            inserts = []
+    def apply_plan(self):
+        """
+        Inserts the page and line placeholders of the plan, e.g. [tdl 1.2], into the text of the runs, joining each
+        run's text and placeholders once
+        """
+        for ri, inserts in self.plan.inserts(self.tmplts).items():
+            r = self.runs[ri]
             rtxt = r.text
-            endindex = -1
-            for m in re.finditer(self.tsekpattern, rtxt):
-                endindex = m.end()
-                if m.start() == 0:
-                    continue
-                self.tskcount += 1
-                if self.tskcount == self.tsek_per_line:
-                    self.lnct += 1
-                    self.tskcount = 0
-                    if self.lnct == self.lines_per_page:
-                        self.pgct += 1
-                        self.lnct = 0
-                        inserts.append(('page', f"{self.pgct}", m))
-                        inserts.append(('line', f"{self.pgct}.{self.lnct + 1}", m))
-                    else:
-                        inserts.append(('line', f"{self.pgct}.{self.lnct + 1}", m))
-
-            inserts.reverse()
-            for ins in inserts:
-                mstype, msnum, m = ins
-                ms = f"[{self.tmplts[mstype]} {msnum}]"
-                rtxt = rtxt[:m.end()] + ms + rtxt[m.end():]
-
-            r.text = rtxt
-            if not self.donefirst:
-                rtxt = f"[{self.tmplts['page']} 1][{self.tmplts['line']} 1.1]" + rtxt
-                r.text = rtxt
-                self.donefirst = True
+            segments = []
+            pos = 0
+            for offset, placeholder in inserts:
+                segments.append(rtxt[pos:offset])
+                segments.append(placeholder)
+                pos = offset
+            segments.append(rtxt[pos:])
+            r.text = ''.join(segments)
+
+    def report_plan(self, docname):
+        """
+        Prints the number of pages and lines of the plan and where the pages break, by paragraph number (counted
+        in the paragraphs paginated) and character offset in the paragraph
+        """
+        plan = self.plan
+        print("{}: {} tsek groups, {} pages, {} lines ({} tsek per line, {} lines per page), planned in {:.1f} ms"
+              .format(docname, plan.tsekct, plan.page_count, plan.line_count, self.tsek_per_line,
+                      self.lines_per_page, self.plantime))
+        runpos = []
+        for pind, p in enumerate(self.paras):
+            offset = 0
+            for r in p.runs:
+                runpos.append((pind + 1, offset))
+                offset += len(r.text)
+        for run, offset, page in zip(plan.breakruns[plan.ispage].tolist(), plan.breakoffsets[plan.ispage].tolist(),
+                                     plan.pages[plan.ispage].tolist()):
+            pnum, runoffset = runpos[run]
+            print("  Page {} starts in paragraph {} at character {}".format(page, pnum, runoffset + offset))
 
     def apply_styles(self, p):
-        newp = p.insert_paragraph_before('', p.style)
+        """
+        Splits the runs of a paragraph at the page and line placeholders, so each placeholder, without its template
+        name, e.g. [1.2], is a run in the digital page or line style. The runs are split in place, keeping the
+        paragraph and the formatting of the text runs, and runs without a placeholder are left as they are.
+        """
         for r in p.runs:
             rtxt = r.text
-            pgrex = '\[' + self.tmplts["page"] + '\s+\d+\]'
-            mtchs = [m for m in re.finditer(pgrex, rtxt)]
-            if len(mtchs) > 0:
-                newp.add_run(rtxt[:mtchs[0].start()], r.style)
-                for mi, mtch in enumerate(mtchs):
-                    ms = rtxt[mtch.start():mtch.end()]
-                    ms = ms.replace(self.tmplts["page"] + ' ', '')
-                    newp.add_run(ms, self.worddoc.styles[self.digstyles['page']])
-                    endindex = mtchs[mi + 1].start() if mi < len(mtchs) - 1 else len(rtxt)
-                    postrun = rtxt[mtch.end():endindex]
-                    newp.add_run(postrun, r.style)
-            else:
-                newp.add_run(r.text, r.style)
-        self.delete_paragraph(p)
-        # Do Line milestones
-        newp2 = newp.insert_paragraph_before('', newp.style)
-        for r in newp.runs:
-            rtxt = r.text
-            pgrex = '\[' + self.tmplts["line"] + '\s+\d+\.\d+\]'
-            mtchs = [m for m in re.finditer(pgrex, rtxt)]
-            if len(mtchs) > 0:
-                # Add text before first match
-                newp2.add_run(rtxt[:mtchs[0].start()], r.style)
-                for mi, mtch in enumerate(mtchs):
-                    # add milestone run
-                    ms = rtxt[mtch.start():mtch.end()]
-                    ms = ms.replace(self.tmplts["line"] + ' ', '')
-                    newp2.add_run(ms, self.worddoc.styles[self.digstyles['line']])
-                    # Add post milestone run
-                    endindex = mtchs[mi + 1].start() if mi < len(mtchs) - 1 else len(rtxt)
-                    postrun = rtxt[mtch.end():endindex]
-                    newp2.add_run(postrun, r.style)
+            mtchs = list(self.placeholderre.finditer(rtxt))
+            if len(mtchs) == 0:
+                continue
+            pieces = []
+            pos = 0
+            for mtch in mtchs:
+                mstype = 'page' if mtch.group(1) else 'line'
+                pieces.append((rtxt[pos:mtch.start()], None))
+                pieces.append((mtch.group(0).replace(self.tmplts[mstype] + ' ', ''), mstype))
+                pos = mtch.end()
+            pieces.append((rtxt[pos:], None))
+            runel = r._element
+            lastel = runel
+            for txt, mstype in pieces[1:]:
+                if txt == '':
+                    continue
+                if mstype is None:
+                    # A copy of the original run keeps its formatting
+                    newel = deepcopy(runel)
+                else:
+                    newel = OxmlElement('w:r')
+                    newel.style = self.digstyle_ids[mstype]
+                lastel.addnext(newel)
+                lastel = newel
+                Run(newel, r._parent).text = txt
+            if pieces[0][0] == '':
+                runel.getparent().remove(runel)
             else:
-                newp2.add_run(r.text, r.style)
-        self.delete_paragraph(newp)
+                r.text = pieces[0][0]
 
-    def add_run(self, r, txt, style_name):
-        runel = CT_R()
-        r._element.addnext(runel)
-        newrun = Run(runel, r._parent)
-        newrun.text = txt
-        newrun.style = self.worddoc.styles[style_name]
-        return newrun
+
+class PagingOptions:
+    """
+    The digital paging settings from the -opt option, which is a JSON object, or the path of a JSON file, e.g.:
+        {"profile": "kangyur", "tsek_per_line": 18, "manifest": "batch.json"}
+    The settings are those in PAGING_SETTINGS. A profile is a JSON file of settings, given by path or by name in
+    the profiles folder, whose settings those in the options override. The manifest is a JSON object, or file,
+    keyed on file name patterns with the settings or profile name for the matching files, e.g.:
+        {"lccw-*": "lccw", "kt-0001-text.docx": {"profile": "kangyur", "lines_per_page": 7}}
+    The settings of all the patterns a file name matches are applied in order.
+    """
+    def __init__(self, options=''):
+        self.settings = {}
+        self.manifest = []  # List of (file name pattern, settings) tuples
+        if not options:
+            return
+        opts = load_json_option(options, "-opt options")
+        if not isinstance(opts, dict):
+            raise ValueError("The -opt options must be a JSON object")
+        manifest = opts.pop('manifest', None)
+        self.settings = self.resolve(opts)
+        if manifest is not None:
+            manifest = load_json_option(manifest, "batch manifest")
+            if not isinstance(manifest, dict):
+                raise ValueError("The batch manifest must be a JSON object keyed on file name patterns")
+            for pattern, fopts in manifest.items():
+                if isinstance(fopts, str):
+                    fopts = {'profile': fopts}
+                self.manifest.append((pattern, self.resolve(fopts)))
 
     @staticmethod
-    def delete_paragraph(paragraph):
-        p = paragraph._element
-        p.getparent().remove(p)
-        p._p = p._element = None
+    def resolve(opts):
+        """
+        Returns the settings of an options dictionary with those of its profile, if any, underneath
+        """
+        opts = dict(opts)
+        settings = {}
+        profile = opts.pop('profile', None)
+        if profile:
+            profpath = profile if path.isfile(profile) else path.join(PROFILE_FOLDER, profile + '.json')
+            if not path.isfile(profpath):
+                raise FileNotFoundError("The paging profile, {}, was not found".format(profile))
+            settings.update(PagingOptions.resolve(load_json_option(profpath, "profile " + profile)))
+        for name, val in opts.items():
+            if name not in PAGING_SETTINGS:
+                raise ValueError("Unknown digital paging setting: {}. The settings are: {}".format(
+                    name, ', '.join(PAGING_SETTINGS)))
+            if name in ('lines_per_page', 'tsek_per_line') and (not isinstance(val, int) or val < 1):
+                raise ValueError("The {} setting must be a positive whole number, not {}".format(name, val))
+            if name == 'tsek_pattern':
+                check_tsek_pattern(val)
+        settings.update(opts)
+        return settings
+
+    def for_file(self, fname):
+        settings = dict(self.settings)
+        for pattern, fsettings in self.manifest:
+            if fnmatch(fname, pattern):
+                settings.update(fsettings)
+        return settings
+
+    def paginator(self, fname):
+        """
+        Returns a DigitalPaginator with the settings for a file
+        """
+        return DigitalPaginator().configure(self.for_file(fname))
+
+
+def check_tsek_pattern(pattern):
+    """
+    Checks that a tsek_pattern setting is a regular expression that cannot match the RUN_SEPARATOR the page planner
+    joins the texts of the runs with, as a tsek group must not be matched across runs
+    """
+    try:
+        tsekre = re.compile(pattern)
+    except (re.error, TypeError) as e:
+        raise ValueError("The tsek_pattern setting, {}, is not a valid regular expression: {}".format(pattern, e))
+    # Tried on the separator between two runs ending in tseks, as a pattern may only match it after a tsek
+    context = '\u0F40\u0F0B' + RUN_SEPARATOR + '\u0F40\u0F0B'
+    if any(RUN_SEPARATOR in mtch.group(0) for mtch in tsekre.finditer(context)):
+        raise ValueError("The tsek_pattern setting, {}, must not match {!r}, which separates the runs when pages "
+                         "are planned".format(pattern, RUN_SEPARATOR))
+
+
+def load_json_option(option, desc):
+    """
+    Loads an option that is either JSON or the path of a JSON file, or returns it if already loaded
+    """
+    if not isinstance(option, str):
+        return option
+    try:
+        if path.isfile(option):
+            with open(option, 'r', encoding='utf-8') as jf:
+                return json.load(jf)
+        return json.loads(option)
+    except ValueError as ve:
+        raise ValueError("The {} is not valid JSON: {}".format(desc, ve))
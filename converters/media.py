@@ -0,0 +1,177 @@
+#!env/bin/python
+"""
+Extraction of the images embedded in the Word documents, for facsimile-heavy texts. With -md, each image referred
+to in the text is streamed out of the word/media folder of the docx into the media folder of the out folder, named
+by the SHA-1 hash of its content, so an image used several times or in several documents of the batch is written
+once. The TextConverter marks its place in the TEI with:
+    <figure><graphic url="media/3f2a...c1.png"/></figure>
+where the url is relative to the out folder while the document is converted, and relative to the folder of the XML
+file when it is written, e.g. ../media/3f2a...c1.png for a text folder or the folder of a template.
+
+The thumbnail and web derivatives of each new image are made with Pillow, as JPEGs in the thumbs and web folders of
+the media folder, in a pool of worker processes in the main process. The documents go on being converted while they
+are made, and the conversion waits for the last ones when it closes the MediaStore. In a parallel conversion, the
+conversion workers extract the images and send their names to the main process, which makes the derivatives once
+for each image.
+"""
+import hashlib
+import multiprocessing
+import os
+import posixpath
+
+from PIL import Image, ImageOps
+
+from .outputsink import OutputSink
+from .walkmanifest import HASH_BLOCK_SIZE
+
+MEDIA_FOLDER = 'media'
+DERIVATIVE_SIZES = {'thumbs': (200, 200), 'web': (1600, 1600)}
+DERIVATIVE_FORMAT = ('JPEG', '.jpg')
+MEDIA_HASH_LENGTH = 20
+DRAWING_NS = 'http://schemas.openxmlformats.org/drawingml/2006/main'
+VML_NS = 'urn:schemas-microsoft-com:vml'
+RELS_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+
+
+def image_rel_ids(runel):
+    """
+    Returns the relationship ids of the images in a run, in DrawingML drawings or legacy VML pictures
+
+    :param runel: the w:r element of the run
+    """
+    rids = [blip.get('{%s}embed' % RELS_NS) for blip in runel.iter('{%s}blip' % DRAWING_NS)]
+    rids += [imgdata.get('{%s}id' % RELS_NS) for imgdata in runel.iter('{%s}imagedata' % VML_NS)]
+    return [rid for rid in rids if rid]
+
+
+def relative_url(url, xmldir):
+    """
+    Makes the url of an image relative to the folder of an XML file
+
+    :param url: the url of the image relative to the out folder, from MediaStore.extract()
+    :param xmldir: the folder of the XML file relative to the out folder
+    """
+    return posixpath.relpath(url, xmldir.replace(os.sep, '/'))
+
+
+def derivative_path(mediadir, kind, fname):
+    return os.path.join(mediadir, kind, os.path.splitext(fname)[0] + DERIVATIVE_FORMAT[1])
+
+
+def make_derivatives(mediadir, fname):
+    """
+    Makes the derivatives of an image in the media folder, in a worker process of the MediaStore
+
+    :return: error message, or None if they were made
+    """
+    try:
+        with Image.open(os.path.join(mediadir, fname)) as img:
+            img = ImageOps.exif_transpose(img)
+            if img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            for kind, size in DERIVATIVE_SIZES.items():
+                derived = img.copy()
+                derived.thumbnail(size)
+                outpath = derivative_path(mediadir, kind, fname)
+                os.makedirs(os.path.dirname(outpath), exist_ok=True)
+                derived.save(outpath + '.tmp', DERIVATIVE_FORMAT[0])
+                os.replace(outpath + '.tmp', outpath)
+    except Exception as e:
+        return "Could not make the derivatives of {}: {}: {}".format(fname, e.__class__.__name__, e)
+    return None
+
+
+class MediaStore(OutputSink):
+    """
+    The media folder of the out folder, shared by the documents of a conversion. Its pool is started when the first
+    new image is added, or before the conversion workers in a parallel conversion, and it must be closed at the end
+    of the conversion to wait for the derivatives.
+    """
+    unpicklable = ('pool',)
+
+    def __init__(self, outdir, jobs=1):
+        super().__init__(os.path.join(outdir, MEDIA_FOLDER))
+        self.jobs = jobs
+        self.pool = None
+        self.pending = []  # The results of the derivatives being made
+        self.seen = set()  # The images added in this conversion
+        self.failed = 0
+
+    def extract(self, zipdoc, member):
+        """
+        Copies an image from a docx to the media folder, unless it is already there
+
+        :param zipdoc: the zipfile.ZipFile of the docx
+        :param member: the name of the image in the docx, e.g. word/media/image1.png
+        :return: the url of the image relative to the out folder
+        """
+        os.makedirs(self.path, exist_ok=True)
+        ext = os.path.splitext(member)[1].lower()
+        tmppath = os.path.join(self.path, '.{}-{}'.format(os.getpid(), os.path.basename(member)))
+        sha = hashlib.sha1()
+        with zipdoc.open(member) as src, open(tmppath, 'wb') as dest:
+            for block in iter(lambda: src.read(HASH_BLOCK_SIZE), b''):
+                sha.update(block)
+                dest.write(block)
+        fname = sha.hexdigest()[:MEDIA_HASH_LENGTH] + ext
+        fpath = os.path.join(self.path, fname)
+        if os.path.isfile(fpath):
+            os.remove(tmppath)
+        else:
+            os.replace(tmppath, fpath)
+        self.put(fname)
+        return MEDIA_FOLDER + '/' + fname
+
+    def register(self, url):
+        """
+        Adds an image that is already in the media folder, e.g. of a div spliced with -inc, so its derivatives are
+        made if they are missing
+
+        :param url: the url of the image from extract()
+        :return: bool: whether the image is in the media folder
+        """
+        fname = posixpath.basename(url)
+        if not os.path.isfile(os.path.join(self.path, fname)):
+            return False
+        self.put(fname)
+        return True
+
+    def start_pool(self):
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.jobs)
+
+    def start_listener(self):
+        # The pool is started in the main thread, before the conversion workers
+        self.start_pool()
+        return super().start_listener()
+
+    def write(self, fname):
+        if fname in self.seen:
+            return
+        self.seen.add(fname)
+        if all(os.path.isfile(derivative_path(self.path, kind, fname)) for kind in DERIVATIVE_SIZES):
+            return  # Made in an earlier conversion
+        self.start_pool()
+        self.pending.append(self.pool.apply_async(make_derivatives, (self.path, fname)))
+
+    def close(self):
+        self.stop_listener()
+        with self.lock:
+            if self.pool is None:
+                return
+            self.pool.close()
+            for result in self.pending:
+                err = result.get()
+                if err:
+                    self.failed += 1
+                    print(err)
+            self.pool.join()
+            self.pool = None
+            print("Extracted {} images, {} without derivatives".format(len(self.seen), self.failed))
+            self.pending = []
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['pending'] = []
+        state['seen'] = set()
+        return state
@@ -0,0 +1,82 @@
+#!env/bin/python
+"""
+Sidecar indexes of the page and line milestones of numbered files, so a reference like "12.4" can be found with a
+seek to its byte offset instead of parsing the whole file. The index of a file is either a JSON file next to it
+(e.g. lccw-0001-text.xml.index.json) or the rows of that file in a SQLite database shared by all the files in the
+out folder. Both list the milestones in document order with their n, unit, byte offset, element path and the id
+of the enclosing div.
+"""
+import json
+import os
+import sqlite3
+
+INDEX_SUFFIX = '.index.json'
+INDEX_DB_NAME = 'milestones.sqlite'
+INDEX_FORMATS = ('json', 'sqlite')
+
+index_dbs = {}  # The open index databases of this process keyed on path
+
+
+def index_path(outpath):
+    return outpath + INDEX_SUFFIX
+
+
+def write_json_index(outpath, entries):
+    """
+    Writes the JSON index of a numbered file next to it
+
+    :param outpath: the path of the numbered file
+    :param entries: list of the milestone entries from the MilestoneIndexer
+    """
+    with open(index_path(outpath), 'w', encoding='utf-8') as jf:
+        json.dump({'file': os.path.basename(outpath), 'milestones': entries}, jf, ensure_ascii=False)
+
+
+def remove_json_index(outpath):
+    if os.path.isfile(index_path(outpath)):
+        os.remove(index_path(outpath))
+
+
+def get_index_db(outdir):
+    """
+    Returns the milestone index database of an out folder, opened once per process. Worker processes of a parallel
+    conversion each open their own connection, as a connection cannot be shared with a forked process
+    """
+    dbpath = os.path.join(outdir, INDEX_DB_NAME)
+    db = index_dbs.get(dbpath)
+    if db is None or db.pid != os.getpid():
+        db = MilestoneIndexDB(dbpath)
+        index_dbs[dbpath] = db
+    return db
+
+
+class MilestoneIndexDB:
+    """
+    The SQLite milestone index of the files of an out folder, keyed on the path of each file relative to it.
+    Each file's rows are replaced in one transaction, and concurrent writers wait for the lock.
+    """
+    def __init__(self, dbpath):
+        self.path = dbpath
+        self.pid = os.getpid()
+        self.conn = sqlite3.connect(self.path, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS milestones (file TEXT NOT NULL, seq INTEGER NOT NULL, '
+                          'n TEXT, unit TEXT, offset INTEGER, path TEXT, div TEXT, PRIMARY KEY (file, seq))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS milestones_n ON milestones (file, n)')
+
+    def set_file(self, relpath, entries):
+        """
+        Replaces the index rows of a file with the given entries
+        """
+        with self.conn:
+            self.conn.execute('DELETE FROM milestones WHERE file = ?', (relpath,))
+            self.conn.executemany('INSERT INTO milestones VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                  [(relpath, seq, ent['n'], ent['unit'], ent['offset'], ent['path'], ent['div'])
+                                   for seq, ent in enumerate(entries)])
+
+    def remove_file(self, relpath):
+        with self.conn:
+            self.conn.execute('DELETE FROM milestones WHERE file = ?', (relpath,))
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,386 @@
+#!env/bin/python
+"""
+Streaming engine for numbering the page and line milestones of THL TEI XML files.
+
+The input file is memory mapped and tokenized once. Only the n attributes of the page and line milestones are
+rewritten (and, if requested, a first line milestone inserted after each page milestone and the text that follows
+it, where the numbering put it when it parsed the whole file with lxml). Every other byte,
+including the XML declaration, DOCTYPE, entity references, comments and whitespace, is copied through unchanged.
+So memory use does not depend on the size of the file and the numbering is as fast as the file can be read and written.
+"""
+import codecs
+import mmap
+import re
+
+# Patterns to find the next token of interest. Until the root element is found every tag is examined, then only
+# milestones and the markup that may contain text looking like a milestone (comments, CDATA, processing instructions)
+ANY_TAG_PATTERN = re.compile(rb'<')
+MILESTONE_TAG_PATTERN = re.compile(rb'<(?:!--|!\[CDATA\[|\?|/?milestone[\s/>])')
+START_TAG_PATTERN = re.compile(rb'<([^\s/>!?]+)((?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*)\s*(/?)>')
+END_TAG_PATTERN = re.compile(rb'</([^\s>]+)\s*>')
+DOCTYPE_PATTERN = re.compile(rb'<!DOCTYPE[^\[>]*(?:\[.*?\]\s*)?>', re.DOTALL)
+ATTR_PATTERN = re.compile(rb'([^\s=/>]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+TAG_END_PATTERN = re.compile(rb'\s*/?>$')
+DELIMITERS = ((b'<!--', b'-->', 'comment'), (b'<![CDATA[', b']]>', 'cdata'))
+WRITE_BUFFER_SIZE = 1024 * 1024
+CHECK_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class Token:
+    """
+    A markup token of the stream: kind is 'start', 'empty', 'end', 'comment', 'cdata', 'pi', 'doctype' or 'other'.
+    For tags, name is the tag name and attrs the bytes of its attributes.
+    """
+    __slots__ = ('kind', 'start', 'end', 'name', 'attrs')
+
+    def __init__(self, kind, start, end, name=None, attrs=b''):
+        self.kind = kind
+        self.start = start
+        self.end = end
+        self.name = name
+        self.attrs = attrs
+
+    def get(self, attname, default=None):
+        """
+        Returns the value of an attribute of a tag as a string
+        """
+        mtch = self.find(attname)
+        if mtch is None:
+            return default
+        return mtch.group(mtch.lastindex).decode('utf-8')
+
+    def find(self, attname):
+        """
+        Returns the match of an attribute in attrs, whose last group is the value, or None
+        """
+        for mtch in ATTR_PATTERN.finditer(self.attrs):
+            if mtch.group(1) == attname:
+                return mtch
+        return None
+
+
+class MilestoneStream:
+    """
+    Tokenizes a memory mapped (or bytes) XML document and copies it to an output stream. Subclasses look at the
+    tokens in handle() and call replace() or insert() to change the output. With all_tags False only milestone tags
+    (and the root element) are reported, which is enough for numbering.
+    """
+    def __init__(self, all_tags=False):
+        self.all_tags = all_tags
+        self.data = b''
+        self.outstream = None
+        self.written = 0     # Position in the input up to which it has been copied to the output
+        self.outpos = 0      # Number of bytes written to the output
+        self.root = None     # The start token of the root element
+
+    def run(self, data, outstream):
+        self.data = data
+        self.outstream = outstream
+        self.written = 0
+        self.outpos = 0
+        check_utf8(data)
+        for token in self.tokens():
+            if self.root is None and token.kind in ('start', 'empty'):
+                self.root = token
+                self.handle_root(token)
+            self.handle(token)
+        self.copy_to(len(data))
+        self.finish()
+
+    def tokens(self):
+        data = self.data
+        pos = 0
+        pattern = ANY_TAG_PATTERN
+        while True:
+            if self.root is not None and not self.all_tags:
+                pattern = MILESTONE_TAG_PATTERN
+            mtch = pattern.search(data, pos)
+            if not mtch:
+                return
+            pos = mtch.start()
+            token = self.read_token(pos)
+            if token is None:
+                pos += 1    # A stray "<" is left as text
+                continue
+            pos = token.end
+            yield token
+
+    def read_token(self, pos):
+        data = self.data
+        second = data[pos + 1:pos + 2]
+        if second == b'/':
+            mtch = END_TAG_PATTERN.match(data, pos)
+            return Token('end', pos, mtch.end(), mtch.group(1)) if mtch else None
+        if second == b'?':
+            end = data.find(b'?>', pos + 2)
+            return Token('pi', pos, end + 2) if end > -1 else None
+        if second == b'!':
+            for opener, closer, kind in DELIMITERS:
+                if data[pos:pos + len(opener)] == opener:
+                    end = data.find(closer, pos + len(opener))
+                    return Token(kind, pos, end + len(closer)) if end > -1 else None
+            if data[pos:pos + 9] == b'<!DOCTYPE':
+                mtch = DOCTYPE_PATTERN.match(data, pos)
+                return Token('doctype', pos, mtch.end()) if mtch else None
+            end = data.find(b'>', pos)
+            return Token('other', pos, end + 1) if end > -1 else None
+        mtch = START_TAG_PATTERN.match(data, pos)
+        if mtch:
+            kind = 'empty' if mtch.group(3) else 'start'
+            return Token(kind, pos, mtch.end(), mtch.group(1), mtch.group(2))
+        return None
+
+    def handle_root(self, token):
+        pass
+
+    def handle(self, token):
+        pass
+
+    def finish(self):
+        pass
+
+    def write(self, chunk):
+        self.outstream.write(chunk)
+        self.outpos += len(chunk)
+
+    def copy_to(self, pos):
+        if pos > self.written:
+            self.write(self.data[self.written:pos])
+            self.written = pos
+
+    def replace(self, token, newbytes):
+        self.copy_to(token.start)
+        self.write(newbytes)
+        self.written = token.end
+
+    def insert(self, pos, newbytes):
+        self.copy_to(pos)
+        self.write(newbytes)
+
+
+class MilestoneNumberer(MilestoneStream):
+    """
+    Numbers the page milestones sequentially from the start number (plus the rend number of the root element if it
+    has one) and the line milestones as page.line. If add_first is true, a first line milestone is inserted after
+    each page milestone and its tail text, i.e. before the next markup, as lxml's addnext() inserted it.
+    """
+    def __init__(self, start=1, add_first=False, line_unit='line', all_tags=False):
+        super().__init__(all_tags)
+        self.start = start
+        self.add_first = add_first
+        self.line_unit = line_unit
+        self.pnm = start - 1
+        self.lnm = 0
+        self.pending = None   # (tag, n) of a first line milestone to insert after a page milestone
+        self.milestone_ct = 0
+
+    def handle_root(self, token):
+        rend = token.get(b'rend')
+        if rend and rend.isdigit():
+            self.pnm += int(rend)
+
+    def handle(self, token):
+        if token.name != b'milestone':
+            return
+        if token.kind == 'end':
+            if self.pending is not None:
+                self.insert_first_line(token.end)
+            return
+        unit = None
+        nattr = None
+        for mtch in ATTR_PATTERN.finditer(token.attrs):
+            if mtch.group(1) == b'unit':
+                unit = mtch.group(mtch.lastindex)
+            elif mtch.group(1) == b'n':
+                nattr = mtch
+        if unit is None:
+            return
+        # The offset of the milestone in the output, as everything before it is copied through
+        offset = self.outpos + token.start - self.written
+        lunit = unit.lower()
+        if b'page' in lunit:
+            self.pnm += 1
+            self.lnm = 0
+            num = str(self.pnm)
+            self.set_number(token, num, nattr)
+            self.add_entry(unit.decode('utf-8'), num, offset)
+            if self.add_first:
+                firstnum = "{}.1".format(self.pnm)
+                firstline = '<milestone unit="{}" n="{}"/>'.format(self.line_unit, firstnum).encode('utf-8')
+                self.lnm = 1
+                self.pending = (firstline, firstnum)
+                if token.kind == 'empty':
+                    self.insert_first_line(token.end)
+        elif b'line' in lunit:
+            self.lnm += 1
+            num = "{}.{}".format(self.pnm, self.lnm)
+            self.set_number(token, num, nattr)
+            self.add_entry(unit.decode('utf-8'), num, offset)
+
+    def insert_first_line(self, pos):
+        """
+        Inserts the pending first line milestone after the tail text of the page milestone ending at pos
+        """
+        pos = tail_end(self.data, pos)
+        firstline, firstnum = self.pending
+        self.add_entry(self.line_unit, firstnum, self.outpos + pos - self.written, True)
+        self.insert(pos, firstline)
+        self.pending = None
+
+    def add_entry(self, unit, num, offset, inserted=False):
+        """
+        Called with each milestone numbered, or inserted, and its byte offset in the output. Used for indexing
+        """
+        pass
+
+    def set_number(self, token, num, nattr=None):
+        """
+        Rewrites the n attribute of a milestone tag, adding it if the tag does not have one
+
+        :param nattr: the match of the n attribute in the token's attrs, if it has one
+        """
+        self.milestone_ct += 1
+        num = num.encode('utf-8')
+        if nattr is not None:
+            # Only the value is replaced, so the bytes from the end of the last write up to it are copied unchanged
+            offset = token.start + 1 + len(token.name)
+            grp = nattr.lastindex
+            self.copy_to(offset + nattr.start(grp))
+            self.write(num)
+            self.written = offset + nattr.end(grp)
+            return
+        tag = self.data[token.start:token.end]
+        tagend = TAG_END_PATTERN.search(tag)
+        self.replace(token, tag[:tagend.start()] + b' n="' + num + b'"' + tag[tagend.start():])
+
+
+class MilestoneIndexer(MilestoneNumberer):
+    """
+    Numbers the milestones and keeps an index of them, with the n, unit, byte offset in the output, element path
+    (e.g. /TEI.2[1]/text[1]/body[1]/div[2]/p[3]/milestone[1]) and id of the enclosing div of each. All tags are
+    tokenized to keep track of the element paths, so this is slower than numbering alone.
+    """
+    def __init__(self, start=1, add_first=False, line_unit='line'):
+        super().__init__(start, add_first, line_unit, all_tags=True)
+        self.stack = []     # The open elements, each a list of name, path, child counts and enclosing div id
+        self.path = ''      # The path of the milestone being numbered
+        self.entries = []
+
+    def handle(self, token):
+        kind = token.kind
+        if kind == 'start' or kind == 'empty':
+            name = token.name.decode('utf-8')
+            self.path = self.child_path(name)
+            if kind == 'start':
+                divid = self.stack[-1][3] if len(self.stack) > 0 else None
+                if name.startswith('div'):
+                    divid = token.get(b'id', divid)
+                self.stack.append([name, self.path, {}, divid])
+        elif kind == 'end':
+            # Pop up to the matching start tag, so stray end tags do not unbalance the stack
+            name = token.name.decode('utf-8')
+            for ind in range(len(self.stack) - 1, -1, -1):
+                if self.stack[ind][0] == name:
+                    del self.stack[ind:]
+                    break
+        else:
+            return
+        super().handle(token)
+
+    def child_path(self, name):
+        if len(self.stack) == 0:
+            return "/{}[1]".format(name)
+        parent = self.stack[-1]
+        ct = parent[2].get(name, 0) + 1
+        parent[2][name] = ct
+        return "{}/{}[{}]".format(parent[1], name, ct)
+
+    def add_entry(self, unit, num, offset, inserted=False):
+        path = self.child_path('milestone') if inserted else self.path
+        divid = self.stack[-1][3] if len(self.stack) > 0 else None
+        self.entries.append({'n': num, 'unit': unit, 'offset': offset, 'path': path, 'div': divid})
+
+
+class LineUnitFinder(MilestoneStream):
+    """
+    Finds the unit of the first line milestone in a document, which is used for inserted first line milestones
+    """
+    def __init__(self):
+        super().__init__()
+        self.line_unit = None
+
+    def find(self, data):
+        self.data = data
+        for token in self.tokens():
+            if self.root is None and token.kind in ('start', 'empty'):
+                self.root = token
+            if token.name == b'milestone' and token.kind != 'end':
+                unit = token.get(b'unit')
+                if unit and 'line' in unit.lower():
+                    self.line_unit = unit
+                    break
+        return self.line_unit
+
+
+def tail_end(data, pos):
+    """
+    Returns the position of the next markup from pos, where the tail text of an element ending at pos ends. CDATA
+    sections are part of the text.
+    """
+    while True:
+        pos = data.find(b'<', pos)
+        if pos == -1:
+            return len(data)
+        if data[pos:pos + 9] != b'<![CDATA[':
+            return pos
+        end = data.find(b']]>', pos + 9)
+        if end == -1:
+            return len(data)
+        pos = end + 3
+
+
+def check_utf8(data):
+    """
+    Checks that a document is UTF-8 before anything is written, raising a UnicodeDecodeError if not
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for pos in range(0, len(data), CHECK_CHUNK_SIZE):
+        decoder.decode(data[pos:pos + CHECK_CHUNK_SIZE])
+    decoder.decode(b'', True)
+
+
+def open_mapped(infile):
+    """
+    Returns a read only memory map of an open file, or empty bytes for an empty file
+    """
+    try:
+        return mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        return b''
+
+
+def number_milestones(inpath, outpath, start=1, add_first=False, index=False):
+    """
+    Numbers the milestones of the XML file at inpath, writing the result to outpath.
+    Raises UnicodeDecodeError if the file is not UTF-8.
+
+    :param index: if true, a MilestoneIndexer is used, whose entries are the index of the milestones
+    :return: the MilestoneNumberer, with the number of milestones numbered in milestone_ct
+    """
+    with open(inpath, 'rb') as infile:
+        data = open_mapped(infile)
+        try:
+            line_unit = 'line'
+            if add_first:
+                finder = LineUnitFinder()
+                line_unit = finder.find(data) or 'line'
+            if index:
+                numberer = MilestoneIndexer(start, add_first, line_unit)
+            else:
+                numberer = MilestoneNumberer(start, add_first, line_unit)
+            with open(outpath, 'wb', buffering=WRITE_BUFFER_SIZE) as outfile:
+                numberer.run(data, outfile)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+    return numberer
@@ -2,123 +2,199 @@
 """
 A converter that numbers unnumbered milestones sequentially
 """
-from lxml import etree
-from .baseconverter import BaseConverter
-from os import path, walk, mkdir
-from re import match, search
+from .baseconverter import BaseConverter, ConversionException
+from .milestonestream import number_milestones
+from .milestoneindex import INDEX_FORMATS, INDEX_DB_NAME, write_json_index, remove_json_index, get_index_db
+from . import progress
+from .walkmanifest import WalkManifest, file_hash
+from os import path, walk, makedirs, remove
+from re import search
 from shutil import copy
 
+START_NUMBER_PATTERN = r'text-p(\d+)-\d+\.xml'
+
 
 class NumberPages(BaseConverter):
     def __init__(self, args, extras=None):
         super().__init__(args, extras)
-        self.stnum = args.start
+        if self.inarchive is not None or self.outarchive is not None:
+            # Numbering streams files from disk to disk and -walk mirrors the in folder's tree
+            raise ValueError("Milestones cannot be numbered in zip or tar archives. Unpack the archive into a folder")
+        self.stnum = int(args.start)
         self.add_first = '-af' in self.other_settings
-        self.dtd_statement = ''
-        self.source_entity = ''
+        # -msindex writes a JSON milestone index next to each file, -msindex=sqlite one database for the out folder
+        self.index_format = None
+        for setting in self.other_settings:
+            if setting == '-msindex':
+                self.index_format = 'json'
+            elif setting.startswith('-msindex='):
+                self.index_format = setting.split('=', 1)[1]
+                if self.index_format not in INDEX_FORMATS:
+                    raise ValueError("The index format, {}, must be one of: {}".format(
+                        self.index_format, ', '.join(INDEX_FORMATS)))
 
     def convert(self):
         # option -walk means to walk the given in directory and
         # copy the structure into the out directory with files converted
         if '-walk' in self.other_settings:
-            for dirpath, dirs, files in walk(self.indir):
-                dirs.sort()
-                files.sort()
-                for adir in dirs:
-                    fulldirpath = path.join(self.outdir, adir)
-                    if not path.exists(fulldirpath):
-                        mkdir(fulldirpath)
-
-                xmlfiles = [f for f in files if f.endswith('.xml')]
-                for fpath in xmlfiles:
-                    inpath = path.join(dirpath, fpath)
-                    outpath = inpath.replace(self.indir, self.outdir)
-                    self.convert_tree_doc(inpath, outpath)
-            print("")
-
+            self.convert_tree()
         else:
             # Otherwise convert as normal all files in workspace/in directory with converted files in ../out
             super().convert()
 
+    def convert_tree(self):
+        """
+        Numbers all the XML files in the in directory tree, mirroring its folders in the out directory. The folders
+        are all made first, so the files can then be numbered in any order, in parallel when there is more than one job.
+        Files that have not changed since the last walk, according to the manifest in the out folder, are skipped and
+        the outputs of files deleted from the in folder are removed.
+        """
+        manifest = WalkManifest(self.outdir).load()
+        items = self.build_tree()
+        todo = []
+        for item in items:
+            if not manifest.is_current(item[0], item[1], item[2], self.file_settings(item[0])):
+                todo.append(item)
+        removed = self.remove_deleted(manifest, [item[0] for item in items])
+        results = []
+        try:
+            results, failed = self.run_tasks(todo, task=self.walk_task, results=results)
+        finally:
+            self.update_manifest(manifest, results)
+        copied = len([res for res in results if res[2] == 'copied'])
+        print("\n{} files numbered, {} copied unchanged, {} failed, {} unchanged skipped, {} removed".format(
+            len(results) - copied - len(failed), copied, len(failed), len(items) - len(todo), removed))
+
+    def build_tree(self):
+        """
+        Makes the folders of the in directory tree in the out directory
+
+        :return: list of (relative path, in path, out path) tuples of the XML files to number
+        """
+        items = []
+        for dirpath, dirs, files in walk(self.indir):
+            dirs.sort()
+            files.sort()
+            reldir = path.relpath(dirpath, self.indir)
+            outdirpath = path.normpath(path.join(self.outdir, reldir))
+            makedirs(outdirpath, exist_ok=True)
+            for fname in files:
+                if fname.endswith('.xml'):
+                    relpath = path.normpath(path.join(reldir, fname)).replace(path.sep, '/')
+                    items.append((relpath, path.join(dirpath, fname), path.join(outdirpath, fname)))
+        return items
+
+    def file_settings(self, relpath):
+        """
+        Returns the settings a file is numbered with, which are recorded in the manifest
+        """
+        return {'start': self.get_start_number(path.basename(relpath)), 'add_first': self.add_first,
+                'index': self.index_format}
+
+    def remove_deleted(self, manifest, relpaths):
+        """
+        Removes the outputs of the files in the manifest that are no longer in the in folder
+
+        :return: int: the number of files removed
+        """
+        removed = 0
+        for relpath in manifest.missing(relpaths):
+            outpath = path.join(self.outdir, *relpath.split('/'))
+            if path.isfile(outpath):
+                remove(outpath)
+                removed += 1
+            self.write_index(outpath, None)
+            manifest.forget(relpath)
+        return removed
+
+    def update_manifest(self, manifest, results):
+        for relpath, inpath, status, digest in results:
+            outpath = path.join(self.outdir, *relpath.split('/'))
+            if status == 'failed' or not path.isfile(outpath):
+                manifest.forget(relpath)
+            else:
+                manifest.record(relpath, inpath, outpath, self.file_settings(relpath), digest)
+        manifest.save()
+
+    def walk_task(self, item):
+        """
+        Numbers one file of the tree walk. If it cannot be numbered, it is copied to the out folder unchanged.
+
+        :param item: tuple of the relative path, in path and out path of the file
+        :return: tuple: ((relative path, in path, 'numbered', 'copied' or 'failed', hash of the input),
+                 error message or None)
+        """
+        relpath, inpath, outpath = item
+        try:
+            status = self.number_file(inpath, outpath)
+        except Exception as e:
+            err = "{}: {}".format(e.__class__.__name__, e)
+            progress.message("Could not number {} ({}), copying it as is".format(inpath, err))
+            try:
+                copy(inpath, outpath)
+                self.write_index(outpath, None)
+            except OSError as ce:
+                return (relpath, inpath, 'failed', None), "{}, and could not copy it: {}".format(err, ce)
+            status = 'copied'
+        return (relpath, inpath, status, file_hash(inpath)), None
+
     def convertdoc(self):
         self.current_file_path = path.join(self.indir, self.current_file)
-        self.loadxml()
-        if not self.xmlroot == 'error':
-            self.number_milestones()
-            self.write_xml()
-        else:
-            copy(self.current_file_path, path.join(self.outdir, self.current_file))
+        fpth = self.get_outpath()
+        self.number_file(self.current_file_path, fpth)
 
-    def convert_tree_doc(self, infile, outfile):
-        print(f"\rConverting: {infile}      ", end="")
-        self.current_file_path = infile
-        self.loadxml()
-        if not self.xmlroot == 'error':
-            self.number_milestones()
-            self.walk_write_xml(outfile)
+    def number_file(self, infile, outfile):
+        """
+        Numbers the milestones of one file with the streaming engine, copying the file as is if it is not UTF-8
 
-        else:
+        :return: str: 'numbered' or 'copied'
+        """
+        stnum = self.get_start_number(path.basename(infile), True)
+        try:
+            numberer = number_milestones(infile, outfile, stnum, self.add_first, self.index_format is not None)
+        except UnicodeDecodeError:
+            progress.message(f"\nCould not decode file: {infile}\n")
             copy(infile, outfile)
+            self.write_index(outfile, None)
+            return 'copied'
+        self.write_index(outfile, numberer)
+        return 'numbered'
 
-    def loadxml(self):
-        with open(self.current_file_path, "rb") as infile:
-            self.dtd_statement = b''
-            self.source_entity = b''
-            try:
-                xmltext = infile.read().decode('utf-8')
-                if '!DOCTYPE' in xmltext:
-                    mtch = search(r'<\![^\]]+]>', xmltext)
-                    if mtch:
-                        self.dtd_statement = mtch.group(0).replace("\t", "\t").replace("\n", "\n").encode('utf-8')
-                    mtch = search(r'<sourceDesc n="tibbibl">[^<]+</sourceDesc>', xmltext)
-                    if mtch:
-                        self.source_entity = mtch.group(0).encode('utf-8')
-                infile.seek(0)
-                parser = etree.XMLParser(recover=True)
-                tree = etree.parse(infile, parser)
-                self.xmlroot = tree.getroot()
-                mtch = search(r'text-p(\d+)-\d+\.xml', self.current_file)
-                if mtch:
-                    self.stnum = int(mtch.group(1))
-                    print("start num", self.stnum)
-            except UnicodeDecodeError as ude:
-                print(f"\nCould not decode file: {self.current_file_path}\n")
-                self.xmlroot = 'error'
-
-    def number_milestones(self):
-        root = self.xmlroot
-        rnd = int(root.get('rend')) if root.get('rend') and root.get('rend').isdigit() else False
-        milestones = root.xpath('//milestone')
-        line_unit = 'line'
-        if self.add_first:
-            for ms in milestones:
-                unit = ms.get('unit')
-                if 'line' in unit.lower():
-                    line_unit = unit
-                    break
-
-        pnm = self.stnum - 1
-        if rnd:
-            pnm += rnd
-        lnm = 0
-        for ms in milestones:
-            unit = ms.get('unit')
-            if 'page' in unit.lower():
-                pnm += 1
-                lnm = 0
-                ms.set('n', str(pnm))
-                if self.add_first:
-                    lnms = etree.XML(f'<milestone unit="{line_unit}" n="{pnm}.1" />')
-                    ms.addnext(lnms)
-                    lnm = 1
-
-            elif 'line' in unit.lower():
-                lnm += 1
-                ms.set('n', f"{pnm}.{lnm}")
-
-    def write_xml(self):
+    def write_index(self, outfile, numberer):
+        """
+        Writes the milestone index of a numbered file, if an index is wanted. Any other index of the file, made when
+        it was numbered before with another -msindex setting, or any index at all if numberer is None because the
+        file was copied as is or removed, is deleted, so the index of a rewritten file is never stale
+        """
+        if self.index_format == 'json' and numberer is not None:
+            write_json_index(outfile, numberer.entries)
+        else:
+            remove_json_index(outfile)
+        relpath = path.relpath(outfile, self.outdir).replace(path.sep, '/')
+        if self.index_format == 'sqlite' and numberer is not None:
+            get_index_db(self.outdir).set_file(relpath, numberer.entries)
+        elif self.index_format == 'sqlite' or path.isfile(path.join(self.outdir, INDEX_DB_NAME)):
+            get_index_db(self.outdir).remove_file(relpath)
+
+    def get_start_number(self, fname, report=False):
+        """
+        Returns the start page number for a file, which is given in the names of files split into parts,
+        e.g. lccw-0002-text-p7-1.xml starts on page 7, and is otherwise the start number setting
+        """
+        mtch = search(START_NUMBER_PATTERN, fname)
+        if mtch:
+            stnum = int(mtch.group(1))
+            if report:
+                progress.message("start num {}".format(stnum))
+            return stnum
+        return self.stnum
+
+    def get_outpath(self):
         fpth = path.join(self.outdir, self.current_file)
         while path.isfile(fpth) and not self.overwrite:
+            if not self.interactive:
+                raise ConversionException("The file {} already exists in the out folder. "
+                                          "Use --overwrite to replace it".format(self.current_file))
             userin = input("The file {} already exists in the out folder. "
                            "Overwrite it (y/n/q): ".format(self.current_file))
             if userin == 'y':
@@ -128,29 +204,4 @@ class NumberPages(BaseConverter):
                 fpth = path.join(self.outdir, fname)
             else:
                 exit(0)
-        with open(fpth, "wb") as outfile:
-            xmlstring = etree.tostring(self.xmlroot,
-                                       pretty_print=True,
-                                       encoding='utf-8',
-                                       xml_declaration=True)
-            if len(self.dtd_statement) > 0:
-                xmldecl = b'<?xml version=\'1.0\' encoding=\'utf-8\'?>\n'
-                xmlstring = xmlstring.replace(xmldecl,
-                                  xmldecl + self.dtd_statement.replace(b'\t', b''))
-                src_ent = b'<sourceDesc n="tibbibl"/>'
-                xmlstring = xmlstring.replace(src_ent, self.source_entity)
-            outfile.write(xmlstring)
-
-    def walk_write_xml(self, outfile):
-        with open(outfile, "wb") as outstream:
-            xmlstring = etree.tostring(self.xmlroot,
-                                       pretty_print=True,
-                                       encoding='utf-8',
-                                       xml_declaration=True)
-            if len(self.dtd_statement) > 0:
-                xmldecl = b'<?xml version=\'1.0\' encoding=\'utf-8\'?>\n'
-                xmlstring = xmlstring.replace(xmldecl,
-                                  xmldecl + self.dtd_statement.replace(b'\t', b''))
-                src_ent = b'<sourceDesc n="tibbibl"/>'
-                xmlstring = xmlstring.replace(src_ent, self.source_entity)
-            outstream.write(xmlstring)
\ No newline at end of file
+        return fpth
@@ -0,0 +1,128 @@
+#!env/bin/python
+"""
+Outputs that are shared by all the files of a conversion, such as an out archive or a database, and so must have
+a single writer. In a parallel conversion, the worker processes send their items through a queue to a thread
+in the main process, which writes them. An item the thread cannot write is recorded in the failures of the output,
+so the conversion can fail when the outputs are closed rather than lose it silently.
+"""
+import multiprocessing
+import os
+import sqlite3
+import threading
+
+worker_queues = {}  # Set in worker processes by init_worker(), the queues of the outputs keyed on their paths
+
+
+def init_worker(queues):
+    global worker_queues
+    worker_queues = queues
+
+
+class OutputSink:
+    """
+    Base class of the shared outputs, keyed on their path. Subclasses implement write(item), which is called with
+    the lock held, and close() to finish the output, and list in unpicklable their attributes that are not copied
+    to worker processes.
+    """
+    unpicklable = ()
+
+    def __init__(self, fpath):
+        self.path = fpath
+        self.lock = threading.Lock()
+        self.queue = None
+        self.thread = None
+        self.failures = []  # The errors of the items sent by the worker processes that could not be written
+
+    def put(self, item):
+        """
+        Writes an item, or in a worker process sends it to the main process to write
+        """
+        queue = worker_queues.get(self.path)
+        if queue is not None:
+            queue.put(item)
+            return
+        with self.lock:
+            self.write(item)
+
+    def write(self, item):
+        pass
+
+    def start_listener(self):
+        """
+        Starts the thread that writes the items sent by the worker processes
+
+        :return: the multiprocessing queue to pass to init_worker(), keyed on self.path
+        """
+        self.queue = multiprocessing.Queue()
+        self.thread = threading.Thread(target=self.listen, daemon=True)
+        self.thread.start()
+        return self.queue
+
+    def listen(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                with self.lock:
+                    self.write(item)
+            except Exception as e:
+                print("Could not write to {}: {}".format(self.path, e))
+                self.failures.append("{}: {}".format(e.__class__.__name__, e))
+
+    def stop_listener(self):
+        """
+        Stops the thread after it has written the items already sent
+
+        :return: list of the errors of the items that could not be written
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            self.queue = None
+        return self.failures
+
+    def close(self):
+        self.stop_listener()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for attr in ('lock', 'queue', 'thread') + self.unpicklable:
+            state[attr] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+class SQLiteSink(OutputSink):
+    """
+    A shared output in a SQLite database, which is opened when it is first written to and made with the statements
+    in schema, e.g. CREATE TABLE IF NOT EXISTS statements. The subclasses write to self.conn after calling open() if
+    it is None, and it must be closed at the end of the conversion.
+    """
+    unpicklable = ('conn',)
+    schema = ()
+
+    def __init__(self, dbpath):
+        super().__init__(dbpath)
+        self.conn = None
+
+    def open(self):
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        # The connection is used by the listener thread, with the lock held
+        self.conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        for statement in self.schema:
+            self.conn.execute(statement)
+
+    def close(self):
+        self.stop_listener()
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
@@ -0,0 +1,106 @@
+#!env/bin/python
+"""
+Pagination planner for digital pages. The digital page and line breaks only depend on the positions of the tsek
+groups in the text, so they are planned for the whole document at once: the ends of the tsek groups are collected
+in one array and the break positions computed from it with array arithmetic. A line breaks after every
+tsek_per_line tsek groups and a page after every lines_per_page lines. As in the run by run counting, a tsek group
+at the very start of a run is not counted.
+"""
+import numpy as np
+
+# Cannot occur in the text of a docx run, so no tsek group is matched across runs. PagingOptions rejects a
+# tsek_pattern setting that matches it.
+RUN_SEPARATOR = '\x00'
+
+
+class PagePlan:
+    """
+    The planned digital page and line breaks of a document. For each break, breakruns and breakoffsets give the index
+    of the run and the offset in its text after which the placeholders are inserted, lines the number of the line
+    (counted from 0 for the first line of the document), pages and pagelines the page and line number to give
+    the break and ispage whether a new page starts there.
+    """
+    def __init__(self, tsek_per_line, lines_per_page, runcount=0):
+        self.tsek_per_line = tsek_per_line
+        self.lines_per_page = lines_per_page
+        self.runcount = runcount
+        self.tsekct = 0
+        self.breakruns = np.zeros(0, dtype=np.int64)
+        self.breakoffsets = np.zeros(0, dtype=np.int64)
+        self.lines = np.zeros(0, dtype=np.int64)
+        self.pages = np.zeros(0, dtype=np.int64)
+        self.pagelines = np.zeros(0, dtype=np.int64)
+        self.ispage = np.zeros(0, dtype=bool)
+
+    @property
+    def page_count(self):
+        return int(self.pages[-1]) if len(self.pages) > 0 else 1
+
+    @property
+    def line_count(self):
+        return len(self.lines) + 1
+
+    @property
+    def tsek_remainder(self):
+        """
+        The number of tsek groups counted after the last line break
+        """
+        return self.tsekct % self.tsek_per_line
+
+    def inserts(self, tmplts):
+        """
+        Returns the placeholders to insert in each run, the first page and line of the document in the first run
+
+        :param tmplts: dict of the placeholder template names for 'page' and 'line'
+        :return: dict keyed on run index of lists of (offset, placeholder text) tuples in text order
+        """
+        runinserts = {}
+        if self.runcount > 0:
+            runinserts[0] = [(0, "[{} 1][{} 1.1]".format(tmplts['page'], tmplts['line']))]
+        for run, offset, page, line, ispage in zip(self.breakruns.tolist(), self.breakoffsets.tolist(),
+                                                   self.pages.tolist(), self.pagelines.tolist(),
+                                                   self.ispage.tolist()):
+            msnum = "{}.{}".format(page, line)
+            placeholder = "[{} {}]".format(tmplts['line'], msnum)
+            if ispage:
+                placeholder = "[{} {}]".format(tmplts['page'], page) + placeholder
+            runinserts.setdefault(run, []).append((offset, placeholder))
+        return runinserts
+
+
+def plan_pages(texts, tsekre, tsek_per_line, lines_per_page):
+    """
+    Plans the digital page and line breaks of a document
+
+    :param texts: list of the texts of the runs to paginate in document order
+    :param tsekre: the compiled pattern of a tsek group
+    :param tsek_per_line: number of tsek groups in a line
+    :param lines_per_page: number of lines in a page
+    :return: PagePlan
+    :raises ValueError: if the pattern matches the RUN_SEPARATOR, so a tsek group would run into the next run
+    """
+    plan = PagePlan(tsek_per_line, lines_per_page, len(texts))
+    if len(texts) == 0:
+        return plan
+    lengths = np.fromiter((len(txt) for txt in texts), dtype=np.int64, count=len(texts))
+    runstarts = np.zeros(len(texts), dtype=np.int64)
+    np.cumsum(lengths[:-1] + len(RUN_SEPARATOR), out=runstarts[1:])
+    joined = RUN_SEPARATOR.join(texts)
+    spans = np.array([m.span() for m in tsekre.finditer(joined)], dtype=np.int64).reshape(-1, 2)
+    runs = np.searchsorted(runstarts, spans[:, 0], side='right') - 1
+    if np.any(spans[:, 1] > runstarts[runs] + lengths[runs]):
+        raise ValueError("The tsek pattern {} matches across the end of a run".format(tsekre.pattern))
+    # Drop the groups at the start of a run
+    counted = spans[:, 0] != runstarts[runs]
+    ends = spans[counted, 1]
+    runs = runs[counted]
+    plan.tsekct = len(ends)
+    # A line breaks after every tsek_per_line-th tsek group
+    breaks = np.arange(tsek_per_line - 1, len(ends), tsek_per_line)
+    plan.breakruns = runs[breaks]
+    plan.breakoffsets = ends[breaks] - runstarts[plan.breakruns]
+    plan.lines = np.arange(1, len(breaks) + 1, dtype=np.int64)
+    plan.pages = plan.lines // lines_per_page + 1
+    plan.pagelines = plan.lines % lines_per_page + 1
+    plan.ispage = plan.pagelines == 1
+    return plan
@@ -0,0 +1,194 @@
+#!env/bin/python
+"""
+A pre-flight check of the Word documents in the in folder, which finds the problems that would make their
+conversion fail or lose markup without converting them. Only the styles, document and footnotes XML of each docx
+are parsed, the document with iterparse one paragraph at a time. The problems reported are:
+    - paragraph styles the converter does not know, which default to paragraphs
+    - character styles with no element in styleelements.keydict, whose markup is dropped
+    - headings before the first Heading 0 (Front, Body or Back), a Heading 0 without one of those, skipped heading
+      levels and a missing Heading 0 Body
+    - unbalanced { and } lemma braces in a paragraph, other than in the first and last paragraphs of a multiline
+      apparatus, and a multiline apparatus that is never closed
+    - footnotes without a reference in the text and references to footnotes that do not exist
+"""
+import time
+import zipfile
+from collections import Counter
+
+from lxml import etree
+
+from .baseconverter import BaseConverter
+from .styleelements import getStyleTagDef
+from .textconverter import get_style_class, IGNORABLE_STYLES
+from .stylecache import read_style_names
+
+WNS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+SPECIAL_CHAR_STYLES = ('footnote', 'endnote', 'page number', 'line number', 'default paragraph font')
+SNIPPET_LENGTH = 40
+
+
+class DocChecker(BaseConverter):
+    def convert(self):
+        start = time.perf_counter()
+        results, failed = self.run_tasks(self.files, task=self.check_task, label="Checked files")
+        withproblems = 0
+        for result in sorted(r for r in results if isinstance(r, tuple)):
+            fl, problems = result
+            if problems:
+                withproblems += 1
+                print("\n{}: {} problems".format(fl, len(problems)))
+                for problem in problems:
+                    print("\t" + problem)
+        print("\nChecked {} files in {:.1f} s: {} with problems, {} could not be read".format(
+            len(self.files), time.perf_counter() - start, withproblems, len(failed)))
+
+    def check_task(self, fl):
+        """
+        Checks one file, in a worker process of a parallel check or in the main process
+
+        :return: tuple: ((file name, list of problems), None), or (file name, error message) if it cannot be read
+        """
+        try:
+            return (fl, check_docx(self.open_input(fl))), None
+        except Exception as e:
+            return fl, "{}: {}".format(e.__class__.__name__, e)
+
+
+def read_styles(zipdoc):
+    """
+    Returns the names of the styles of a docx keyed on style id and the name of its default paragraph style
+    """
+    styles = read_style_names(etree.fromstring(zipdoc.read('word/styles.xml')))
+    return styles['names'], styles['defaults'].get('paragraph', 'Normal')
+
+
+def read_footnote_ids(zipdoc):
+    """
+    Returns the ids of the footnotes of a docx, without the separator and continuation notes
+    """
+    if 'word/footnotes.xml' not in zipdoc.namelist():
+        return set()
+    root = etree.fromstring(zipdoc.read('word/footnotes.xml'))
+    return {fn.get(WNS + 'id') for fn in root.iterfind(WNS + 'footnote') if fn.get(WNS + 'type') is None}
+
+
+def char_style_known(name):
+    lower = name.lower()
+    if not name or name in IGNORABLE_STYLES or any(special in lower for special in SPECIAL_CHAR_STYLES):
+        return True
+    return getStyleTagDef(name) is not None
+
+
+def check_docx(src):
+    """
+    Checks a Word document for the problems listed above
+
+    :param src: the path of the docx or a file object with its content
+    :return: list of problem descriptions
+    """
+    problems = []
+    with zipfile.ZipFile(src) as zipdoc:
+        stylenames, default_pstyle = read_styles(zipdoc)
+        footnotes = read_footnote_ids(zipdoc)
+        with zipdoc.open('word/document.xml') as docxml:
+            parastyles, charstyles, noterefs = check_paragraphs(docxml, stylenames, default_pstyle, problems)
+    for name, count in sorted(parastyles.items()):
+        problems.append("Paragraph style “{}” is not known and defaults to paragraph ({} paragraphs)".format(
+            name, count))
+    for name, count in sorted(charstyles.items()):
+        problems.append("Character style “{}” has no element in styleelements.keydict ({} runs)".format(
+            name, count))
+    for noteid in sorted(footnotes - noterefs, key=int):
+        problems.append("Footnote {} has no reference in the text".format(noteid))
+    for noteid in sorted(noterefs - footnotes, key=int):
+        problems.append("Footnote reference {} has no footnote".format(noteid))
+    return problems
+
+
+def check_paragraphs(docxml, stylenames, default_pstyle, problems):
+    """
+    Checks the headings and braces of the body paragraphs of a document, adding to the problems, and collects the
+    unknown styles and footnote references
+
+    :return: tuple: (Counter of unknown paragraph styles, Counter of unknown character styles, set of footnote ids
+             referenced)
+    """
+    parastyles = Counter()
+    charstyles = Counter()
+    noterefs = set()
+    knownchars = {}
+    level = None  # The current heading level, None before the first Heading 0
+    hasbody = False
+    appstart = None  # The paragraph number and snippet of the multiline apparatus that is open
+    pnum = 0
+    for event, para in etree.iterparse(docxml, events=('end',), tag=WNS + 'p'):
+        if para.getparent().tag != WNS + 'body':
+            continue  # Paragraphs in tables, e.g. the metadata table, are not converted as paragraphs
+        pnum += 1
+        pstyleel = para.find(WNS + 'pPr/' + WNS + 'pStyle')
+        pstyle = get_style_class(stylenames.get(pstyleel.get(WNS + 'val'), default_pstyle)
+                                 if pstyleel is not None else default_pstyle)
+        texts = []
+        for run in para.iterfind(WNS + 'r'):
+            rstyleel = run.find(WNS + 'rPr/' + WNS + 'rStyle')
+            if rstyleel is not None:
+                name = stylenames.get(rstyleel.get(WNS + 'val'), rstyleel.get(WNS + 'val'))
+                if name not in knownchars:
+                    knownchars[name] = char_style_known(name)
+                if not knownchars[name]:
+                    charstyles[name] += 1
+            for ref in run.iterfind(WNS + 'footnoteReference'):
+                noterefs.add(ref.get(WNS + 'id'))
+            texts.append(''.join(run.itertext(WNS + 't')))
+        text = ''.join(texts)
+        snippet = text[:SNIPPET_LENGTH]
+        if pstyle['kind'] == 'heading':
+            hlevel = pstyle['level']
+            if hlevel == 0:
+                fbb = pstyle['headmatch'].group(2)
+                if fbb is None:
+                    problems.append("Paragraph {}: {} is not Front, Body or Back: {}".format(
+                        pnum, pstyle['name'], snippet))
+                hasbody = hasbody or fbb == 'Body'
+                level = 0
+            elif level is None:
+                problems.append("Paragraph {}: {} comes before any Heading 0 Front, Body or Back: {}".format(
+                    pnum, pstyle['name'], snippet))
+            else:
+                if hlevel > level + 1:
+                    problems.append("Paragraph {}: heading level skipped from {} to {}: {}".format(
+                        pnum, level, hlevel, snippet))
+                level = hlevel
+        elif level is not None and pstyle['kind'] == 'paragraph' and not pstyle['regular']:
+            parastyles[pstyle['name']] += 1
+        braced = text if level is not None else ''
+        if level is not None and text.startswith('{') and '}' not in text:
+            # A multiline apparatus begins, which a later paragraph starting with } closes, as in
+            # TextConverter.process_multiline_app()
+            if appstart is not None:
+                problems.append("Paragraph {}: multiline apparatus is not closed: {}".format(*appstart))
+            appstart = (pnum, snippet)
+            braced = ''
+        elif appstart is not None and text.startswith('}'):
+            appstart = None
+            braced = text[1:]
+        if '{' in braced or '}' in braced:
+            depth = 0
+            for char in braced:
+                if char == '{':
+                    depth += 1
+                elif char == '}':
+                    depth -= 1
+                    if depth < 0:
+                        break
+            if depth != 0:
+                problems.append("Paragraph {}: unbalanced lemma braces: {}".format(pnum, snippet))
+        # Free the parsed paragraphs as they are checked
+        para.clear()
+        while para.getprevious() is not None:
+            del para.getparent()[0]
+    if appstart is not None:
+        problems.append("Paragraph {}: multiline apparatus is not closed: {}".format(*appstart))
+    if not hasbody:
+        problems.append("There is no Heading 0 Body")
+    return parastyles, charstyles, noterefs
@@ -0,0 +1,195 @@
+#!env/bin/python
+"""
+Progress reporting for the converters. Updates are rate limited to a few per second. On a terminal the progress line
+is rewritten in place, otherwise (e.g. batch or CI runs with captured output) a progress line is written periodically.
+In the worker processes of a parallel conversion, updates are sent to the parent process, whose ProgressMonitor shows
+the combined progress of all workers.
+"""
+import os
+import sys
+import time
+import threading
+
+UPDATES_PER_SECOND = 4
+LOG_LINE_INTERVAL = 10  # Seconds between progress lines when output is not a terminal
+
+quiet = False
+worker_queue = None  # Set in worker processes by init_worker() to send updates to the parent process
+
+
+def set_quiet(isquiet):
+    global quiet
+    quiet = isquiet
+
+
+def init_worker(queue, isquiet):
+    """
+    Initializer for the processes of a worker pool, which sends progress updates and messages through the queue
+    to the ProgressMonitor of the parent process
+    """
+    global worker_queue
+    worker_queue = queue
+    set_quiet(isquiet)
+
+
+def message(msg):
+    """
+    Writes a progress message such as the name of the file being converted, unless in quiet mode
+    """
+    if quiet:
+        return
+    if worker_queue is not None:
+        worker_queue.put(('msg', os.getpid(), msg))
+    else:
+        print(msg)
+
+
+class Progress:
+    """
+    Progress of one task, e.g. the paragraphs of a document. Call update() for each item done and close() at the end.
+    Output is only written at most rate times per second, so update() can be called for every item.
+    """
+    def __init__(self, label, total=None, rate=UPDATES_PER_SECOND):
+        self.label = label
+        self.total = total
+        self.done = 0
+        self.detail = ''
+        self.interval = 1.0 / rate
+        self.tty = sys.stdout.isatty()
+        self.last = 0.0
+        self.lastline = time.monotonic()
+
+    def update(self, done=None, detail=None):
+        self.done = self.done + 1 if done is None else done
+        if detail is not None:
+            self.detail = detail
+        now = time.monotonic()
+        if now - self.last < self.interval:
+            return
+        self.last = now
+        self.show(now)
+
+    def show(self, now):
+        if quiet:
+            return
+        if worker_queue is not None:
+            worker_queue.put(('update', os.getpid(), (self.label, self.done, self.total)))
+        elif self.tty:
+            sys.stdout.write("\r{}      ".format(self.text()))
+            sys.stdout.flush()
+        elif now - self.lastline >= LOG_LINE_INTERVAL:
+            self.lastline = now
+            print(self.text())
+
+    def text(self):
+        return progress_text(self.label, self.done, self.total, self.detail)
+
+    def close(self):
+        if self.total is not None:
+            self.done = self.total
+        if quiet:
+            return
+        if worker_queue is not None:
+            worker_queue.put(('update', os.getpid(), None))
+        elif self.tty:
+            sys.stdout.write("\r{}      \n".format(self.text()))
+            sys.stdout.flush()
+        else:
+            print(self.text())
+
+
+class ProgressMonitor:
+    """
+    Shows the combined progress of the workers of a parallel conversion in the parent process. A thread reads the
+    updates and messages the workers send through the queue, while the parent calls item_done() for every finished
+    file.
+    """
+    def __init__(self, label, total, queue=None, rate=UPDATES_PER_SECOND):
+        self.label = label
+        self.total = total
+        self.queue = queue
+        self.done = 0
+        self.failed = 0
+        self.workers = {}  # The current (label, done, total) of each worker process keyed on process id
+        self.interval = 1.0 / rate
+        self.tty = sys.stdout.isatty()
+        self.last = 0.0
+        self.lastline = time.monotonic()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        if self.queue is not None:
+            self.thread = threading.Thread(target=self.listen, daemon=True)
+            self.thread.start()
+
+    def listen(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            kind, pid, data = item
+            with self.lock:
+                if kind == 'msg':
+                    self.write_message(data)
+                elif data is None:
+                    self.workers.pop(pid, None)
+                else:
+                    self.workers[pid] = data
+                self.show()
+
+    def item_done(self, failed=False):
+        with self.lock:
+            self.done += 1
+            if failed:
+                self.failed += 1
+            self.show(force=self.done == self.total)
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+        if not quiet and self.tty:
+            sys.stdout.write("\n")
+
+    def write_message(self, msg):
+        if quiet:
+            return
+        if self.tty:
+            sys.stdout.write("\r\033[K")
+        print(msg)
+
+    def show(self, force=False):
+        if quiet:
+            return
+        now = time.monotonic()
+        if not force and now - self.last < self.interval:
+            return
+        self.last = now
+        if self.tty:
+            sys.stdout.write("\r\033[K{}".format(self.text()))
+            sys.stdout.flush()
+        elif force or now - self.lastline >= LOG_LINE_INTERVAL:
+            self.lastline = now
+            print(self.text())
+
+    def text(self):
+        txt = progress_text(self.label, self.done, self.total)
+        if self.failed:
+            txt += " ({} failed)".format(self.failed)
+        current = [wk for wk in self.workers.values() if wk[2]]
+        if len(current) > 0:
+            wkdone = sum([wk[1] for wk in current])
+            wktotal = sum([wk[2] for wk in current])
+            txt += " | {} workers: {}%".format(len(current), int(wkdone / wktotal * 100))
+        return txt
+
+
+def progress_text(label, done, total, detail=''):
+    if total:
+        txt = "{}: {} of {} ({}%)".format(label, done, total, int(done / total * 100))
+    else:
+        txt = "{}: {}".format(label, done)
+    if detail:
+        txt += " {}".format(detail)
+    return txt
@@ -0,0 +1,116 @@
+#!env/bin/python
+"""
+Incremental reconversion of the top level divs of a text. With -inc, the TextConverter keeps a section file for
+each document in the .sections folder of the out folder, with a hash of the source paragraphs and footnotes of each
+top level div (from a Heading 1 to the next Heading 0 or 1) and its converted XML. When the document is converted
+again, a div whose hash has not changed is spliced from the section file instead of converting its paragraphs.
+
+Only the state that a div passes on to the following ones is global: the numbering of multiline apparatus, and the
+metadata, edition sigla and endnotes of the document. A section file made with other metadata, sigla or endnotes is
+not used, so the whole document is converted, and a div is only spliced if the apparatus numbering at its start is
+the same as when it was converted, so a change in the number of apparatus converts all the later divs. The XML is
+stored before the ids are assigned and the XML tidied, which is done again for the whole document. Delete the
+.sections folder to convert all documents in full, e.g. after changing the converter.
+"""
+import hashlib
+import json
+import os
+
+from lxml import etree
+
+SECTIONS_FOLDER = '.sections'
+SECTIONS_VERSION = 1
+WNS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
+
+def plan_sections(paragraphs, pstyles):
+    """
+    Finds the top level divs of a document
+
+    :param paragraphs: the docx paragraphs of the document
+    :param pstyles: the classification records of their styles from get_style_class()
+    :return: list of (first, end) paragraph index ranges, from each Heading 1 to the next Heading 0 or 1
+    """
+    starts = [index for index, pstyle in enumerate(pstyles)
+              if pstyle['kind'] == 'heading' and pstyle['level'] in (0, 1)]
+    ranges = []
+    for start, end in zip(starts, starts[1:] + [len(paragraphs)]):
+        if pstyles[start]['level'] == 1:
+            ranges.append((start, end))
+    return ranges
+
+
+def section_hash(paragraphs, footnotes):
+    """
+    Returns the SHA-1 hash of the XML of the paragraphs of a div and of the footnotes they refer to
+
+    :param footnotes: the footnote records of TextConverter.pre_process_notes() keyed on footnote id
+    """
+    sha = hashlib.sha1()
+    for p in paragraphs:
+        sha.update(etree.tostring(p._p))
+        for ref in p._p.iter(WNS + 'footnoteReference'):
+            fno = footnotes.get(ref.get(WNS + 'id'))
+            if fno is not None:
+                sha.update(json.dumps([fno['num'], fno['text'], fno['markup'], fno['is_annotation']],
+                                      ensure_ascii=False).encode('utf-8'))
+                for fnrun in fno['runs'] or []:
+                    sha.update(etree.tostring(fnrun))
+    return sha.hexdigest()
+
+
+def document_key(*values):
+    """
+    Returns the hash of the global state of a document, e.g. its metadata, which must be the same to reuse its divs
+    """
+    return hashlib.sha1(json.dumps([SECTIONS_VERSION] + list(values), ensure_ascii=False, sort_keys=True,
+                                   default=str).encode('utf-8')).hexdigest()
+
+
+class SectionFile:
+    """
+    The section file of a document, with the divs converted before keyed on their hash and the apparatus number at
+    their start
+    """
+    def __init__(self, outdir, fname, key):
+        """
+        :param fname: the name of the document
+        :param key: the document_key() of the document
+        """
+        self.path = os.path.join(outdir, SECTIONS_FOLDER, os.path.splitext(fname)[0] + '.json')
+        self.key = key
+        self.divs = {}
+
+    def load(self):
+        """
+        Loads the divs of the section file, if there is one made with the same document key
+        """
+        self.divs = {}
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as secfile:
+                    data = json.load(secfile)
+                if data.get('key') == self.key:
+                    self.divs = {(div['hash'], div['apparatus'][0]): div for div in data['divs']}
+            except (OSError, ValueError, KeyError, IndexError):
+                print("Could not read the section file {}, converting the whole document".format(self.path))
+                self.divs = {}
+        return self
+
+    def find(self, shash, apparatus):
+        """
+        Returns the stored div with a hash and apparatus number at its start, or None
+        """
+        return self.divs.get((shash, apparatus))
+
+    def save(self, divs):
+        """
+        :param divs: list of div records, dicts with hash, apparatus (the numbers at the start and end), last_style
+                     (the style name of its last paragraph), xml and empty (the positions of its elements with
+                     empty text)
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmppath = self.path + '.tmp'
+        with open(tmppath, 'w', encoding='utf-8') as secfile:
+            json.dump({'key': self.key, 'divs': divs}, secfile, ensure_ascii=False)
+        os.replace(tmppath, self.path)
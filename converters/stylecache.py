@@ -0,0 +1,155 @@
+#!env/bin/python
+"""
+A cache of the style names of Word documents, keyed on the SHA-1 hash of their styles XML. Most documents are made
+from the same template, so their styles are the same, but python-docx looks up the style of each run and paragraph
+by searching the styles part, and the default style of unstyled runs by testing every style, every time. The
+StyleTable of a document instead looks up the name of a style id in a dictionary, which is built once per styles
+hash in each process and shared by all the documents converted in it.
+
+With the -sc option, the tables are also saved in a JSON file, so later conversions and the worker processes of a
+parallel conversion start with the tables of the documents seen before. Only the style ids, types and names are
+saved: the classification of paragraph styles (get_style_class()) and the element definitions of character styles
+(getStyleTagDef()) depend on the converter's code, so they are memoized by style name in each process instead.
+"""
+import hashlib
+import json
+import os
+
+from docx.styles import BabelFish
+from lxml import etree
+
+from .outputsink import OutputSink
+
+STYLE_CACHE_VERSION = 1
+WNS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
+style_tables = {}  # The StyleTables of this process keyed on styles hash
+
+
+def styles_hash(worddoc):
+    """
+    Returns the SHA-1 hash of the styles XML of a python-docx document
+    """
+    return hashlib.sha1(etree.tostring(worddoc.styles.element)).hexdigest()
+
+
+def read_style_names(styles):
+    """
+    Reads the styles of a document as python-docx resolves them
+
+    :param styles: the w:styles element of the document
+    :return: dict with the names and types of the styles keyed on style id and the names of the default styles keyed
+             on type
+    """
+    names = {}
+    types = {}
+    defaults = {}
+    for style in styles.iterfind(WNS + 'style'):
+        styleid = style.get(WNS + 'styleId')
+        if styleid in names:
+            continue  # python-docx uses the first style with an id
+        nameel = style.find(WNS + 'name')
+        # python-docx gives the built-in styles their names in the Word UI, e.g. Heading 1 for heading 1
+        name = BabelFish.internal2ui(nameel.get(WNS + 'val')) if nameel is not None else None
+        stype = style.get(WNS + 'type', 'paragraph')
+        names[styleid] = name or ''
+        types[styleid] = stype
+        if style.get(WNS + 'default') in ('1', 'true', 'on'):
+            defaults[stype] = name or ''  # The last default of a type is used, as in python-docx
+    return {'names': names, 'types': types, 'defaults': defaults}
+
+
+class StyleTable:
+    """
+    The style names of the documents with the same styles XML
+    """
+    def __init__(self, data):
+        """
+        :param data: dict of the style names from read_style_names()
+        """
+        self.names = data['names']
+        self.types = data['types']
+        self.defaults = data['defaults']
+
+    def style_name(self, styleid, stype):
+        """
+        Returns the name of a style id, or the name of the default style of its type if it has none or is not a style
+        of that type, as python-docx's Style.name does
+        """
+        if styleid is not None and self.types.get(styleid) == stype:
+            return self.names[styleid]
+        return self.defaults.get(stype, '')
+
+    def paragraph_style(self, p):
+        """
+        Returns the style name of a docx paragraph
+        """
+        return self.style_name(p._p.style, 'paragraph')
+
+    def run_style(self, run):
+        """
+        Returns the character style name of a docx run
+        """
+        return self.style_name(run.element.style, 'character')
+
+    def by_id(self):
+        """
+        Returns the names of all the styles keyed on style id
+        """
+        return dict(self.names)
+
+
+class StyleCache(OutputSink):
+    """
+    The style tables of the documents converted. If it has a path, the tables are read from that JSON file and the
+    new tables saved to it when it is closed; in a parallel conversion, the workers send their new tables to the main
+    process to save.
+    """
+    def __init__(self, fpath=None):
+        super().__init__(fpath)
+        self.tables = {}  # The data of the tables keyed on styles hash
+        self.changed = False
+        if fpath and os.path.isfile(fpath):
+            try:
+                with open(fpath, 'r', encoding='utf-8') as cachefile:
+                    cache = json.load(cachefile)
+                if cache.get('version') == STYLE_CACHE_VERSION:
+                    self.tables = cache['tables']
+            except (ValueError, KeyError) as e:
+                print("Ignoring the unreadable style cache {}: {}".format(fpath, e))
+
+    def table(self, worddoc):
+        """
+        Returns the StyleTable of a python-docx document
+        """
+        shash = styles_hash(worddoc)
+        if shash in style_tables:
+            return style_tables[shash]
+        data = self.tables.get(shash)
+        if data is None:
+            data = read_style_names(worddoc.styles.element)
+            self.tables[shash] = data
+            if self.path:
+                self.put((shash, data))
+        style_tables[shash] = StyleTable(data)
+        return style_tables[shash]
+
+    def write(self, item):
+        shash, data = item
+        self.tables[shash] = data
+        self.changed = True
+
+    def close(self):
+        self.stop_listener()
+        with self.lock:
+            if not self.path or not self.changed:
+                return
+            folder = os.path.dirname(self.path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            # Written to a temporary file first, so an interrupted save does not lose the cache
+            tmppath = self.path + '.tmp'
+            with open(tmppath, 'w', encoding='utf-8') as cachefile:
+                json.dump({'version': STYLE_CACHE_VERSION, 'tables': self.tables}, cachefile, ensure_ascii=False)
+            os.replace(tmppath, self.path)
+            self.changed = False
@@ -118,6 +118,22 @@ keydict = {
 # Defining global dictionary for Word style to element keys to be populated by createStyleKeyDict() function
 styledict = {}
 
+# Dictionary of milestone (tag, unit) definitions keyed on Word style name, populated by getMilestoneDef() function
+milestonedefs = {}
+
+# Font properties of runs that are marked up with <hi rend="...">, with the w:rPr child element they are read from.
+# The position of the property in this list is its bit in the signature returned by getFontSignature()
+WNS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+FONT_PROPS = [('all_caps', 'caps'), ('bold', 'b'), ('double_strike', 'dstrike'), ('italic', 'i'),
+              ('small_caps', 'smallCaps'), ('underline', 'u')]
+FONT_PROP_COUNT = len(FONT_PROPS)
+FONT_ON_MASK = (1 << FONT_PROP_COUNT) - 1
+UNDERLINE_BIT = 1 << (FONT_PROP_COUNT - 1)
+fontbits = {WNS + tag: 1 << n for n, (prop, tag) in enumerate(FONT_PROPS)}
+# Dictionaries populated by getFontSignature() and getFontElement() of underline type codes and rend values by bitmask
+underlinecodes = {}
+fontrends = {}
+
 # Elements is a keyed dictionary of information for defining XML elements
 elements = {
     "abbr": {
@@ -586,12 +602,52 @@ def buildElement(stynm, text=None, vals=list()):
             el = el.replace('></', '>{0}</'.format(text))
 
     if '<milestone' in el and len(vals) == 1:
-        el.replace('>', f' ed="{vals[0]}>', 1)
-    for n, v in vals:
-        el = el.replace('%{0}%'.format(n), v)
+        el = el.replace('>', f' ed="{vals[0]}">', 1)
+    else:
+        for n, v in vals:
+            el = el.replace('%{0}%'.format(n), v)
     return el
 
 
+def getMilestoneDef(style_name):
+    """
+    Returns a (tag, unit) tuple for a page or line number style. The definition is looked up in the element
+    dictionary the first time a style name is seen and then cached in the global milestonedefs.
+    Styles not in the dictionary default to a page or line milestone depending on their name.
+
+    :param style_name:
+    :return: tuple: (tag name, unit attribute value)
+    """
+    global milestonedefs
+    if style_name in milestonedefs:
+        return milestonedefs[style_name]
+    eldef = getStyleTagDef(style_name)
+    if eldef is not None and 'unit' in eldef['attributes']:
+        msdef = (eldef['tag'], eldef['attributes']['unit'])
+    else:
+        msdef = ('milestone', 'page' if 'page' in style_name.lower() else 'line')
+    milestonedefs[style_name] = msdef
+    return msdef
+
+
+def buildMilestone(style_name, msnum, ed=None):
+    """
+    Creates the milestone element for a page or line number style directly, without going through an XML string
+
+    :param style_name: the name of the page or line number style
+    :param msnum: the value of the n attribute
+    :param ed: the edition sigla for the ed attribute if any
+    :return: the milestone element
+    """
+    tag, unit = getMilestoneDef(style_name)
+    elem = etree.Element(tag)
+    elem.set('unit', unit)
+    elem.set('n', msnum)
+    if ed:
+        elem.set('ed', ed)
+    return elem
+
+
 def list_all():
     '''
     Lists all styles / keys/ elements in dictionary
@@ -605,30 +661,64 @@ def list_all():
         # print "%s\t\t:\t\t%s" % (k, skl[k])
 
 
+def getFontSignature(r):
+    """
+    Returns an integer bitmask of the six font properties used for markup (all caps, bold, double strike, italic,
+    small caps and underline) read in a single pass over the run's w:rPr element. The lowest six bits are the
+    properties that are on, the next six the properties explicitly turned off, and the bits above those the
+    underline type if other than single. Two runs have the same font characteristics if their signatures are equal.
+    The signature is cached on the run object, so it is only computed once per run.
+
+    :param r: the python-docx run
+    :return: int
+    """
+    sig = getattr(r, 'fontsig', None)
+    if sig is not None:
+        return sig
+    sig = 0
+    rpr = r._element.rPr
+    if rpr is not None:
+        seen = 0
+        for child in rpr:
+            bit = fontbits.get(child.tag)
+            if bit is None or seen & bit:
+                continue
+            seen |= bit
+            val = child.get(WNS + 'val')
+            if bit == UNDERLINE_BIT:
+                if val is None:
+                    continue   # An underline element without a value inherits, as if it were not there
+                if val == 'none':
+                    sig |= bit << FONT_PROP_COUNT
+                else:
+                    sig |= bit
+                    if val != 'single':
+                        if val not in underlinecodes:
+                            underlinecodes[val] = len(underlinecodes) + 1
+                        sig |= underlinecodes[val] << (FONT_PROP_COUNT * 2)
+            elif val in ('0', 'false', 'off'):
+                sig |= bit << FONT_PROP_COUNT
+            else:
+                sig |= bit
+    r.fontsig = sig
+    return sig
+
+
 def fontSame(r1, r2):
-    props = ['all_caps', 'bold', 'double_strike', 'italic', 'small_caps', 'underline']
-    font1 = r1.font
-    font2 = r2.font
-    for prop in props:
-        prp1 = font1.__getattribute__(prop)
-        prp2 = font2.__getattribute__(prop)
-        if prp1 != prp2:
-            # print(f"different {prop} values: {prp1} : {prp2}")
-            return False
-    return True
+    return getFontSignature(r1) == getFontSignature(r2)
 
 
 def getFontElement(r):
-    props = ['all_caps', 'bold', 'double_strike', 'italic', 'small_caps', 'underline']
-    onvals = []
-    for prop in props:
-        if r.font.__getattribute__(prop):
-            pname = prop.replace('_', '')
-            onvals.append(pname)
-    if len(onvals) == 0:
+    onbits = getFontSignature(r) & FONT_ON_MASK
+    if onbits == 0:
         return None
+    rend = fontrends.get(onbits)
+    if rend is None:
+        onvals = [prop.replace('_', '') for n, (prop, tag) in enumerate(FONT_PROPS) if onbits & (1 << n)]
+        rend = ' '.join(onvals)
+        fontrends[onbits] = rend
     elem = etree.Element('hi')
-    elem.set('rend', ' '.join(onvals))
+    elem.set('rend', rend)
     return elem
 
 
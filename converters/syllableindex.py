@@ -0,0 +1,108 @@
+#!env/bin/python
+"""
+An inverted index of the Tibetan syllables of the converted texts, so a search service can load the postings of
+a syllable instead of parsing the TEI of every text. The syllables are the text between the tsek and punctuation
+groups of the digital paging tsek pattern. Each posting gives the text id, the id of the div (or its path of
+heading numbers if the heading has no number), the number of the paragraph in the text and the milestone, as
+page.line, of the syllable.
+
+The SyllableIndexer collects the postings of one text while it is converted, as a shard that is merged into the
+SQLite corpus index, replacing the text's earlier postings, in one transaction. The postings table is clustered on
+syllable, so the postings of a syllable are stored together in text order.
+"""
+import bisect
+import re
+import sqlite3
+
+from .digitalpages import TSEK_PATTERN
+from .outputsink import SQLiteSink
+from .textexport import ParagraphWalker
+
+TIBETAN_LETTER_PATTERN = re.compile(r'[\u0F40-\u0FBC]')
+tsekre = re.compile(TSEK_PATTERN)
+
+
+def milestone(page, line):
+    """
+    Returns the page.line of a syllable, e.g. 3.2, or just the page or line if only one is known. Digital lines are
+    already numbered as page.line
+    """
+    if line is not None and (page is None or '.' in line):
+        return line
+    if page is not None and line is not None:
+        return "{}.{}".format(page, line)
+    return page
+
+
+class SyllableIndexer(ParagraphWalker):
+    """
+    Collects the syllable postings of one text, with add_paragraph() for each of its paragraphs. Notes are not indexed
+    """
+    def __init__(self, stylenames):
+        super().__init__({}, stylenames)
+        self.postings = []  # List of (syllable, div, paragraph, milestone) tuples in text order
+
+    def add_text(self, kind, level, page, segments):
+        # Syllables can be split between runs, so the runs are joined and each syllable is given the milestone of
+        # the run it starts in
+        starts = []
+        texts = []
+        pos = 0
+        for txt, pg, ln in segments:
+            starts.append(pos)
+            texts.append(txt)
+            pos += len(txt)
+        text = ''.join(texts)
+        div = self.divid or self.div_path()
+        pos = 0
+        for mtch in tsekre.finditer(text + ' '):
+            if mtch.start() > pos:
+                syl = text[pos:mtch.start()]
+                if TIBETAN_LETTER_PATTERN.search(syl):
+                    txt, pg, ln = segments[bisect.bisect_right(starts, pos) - 1]
+                    self.postings.append((syl, div, self.paras, milestone(pg, ln)))
+            pos = mtch.end()
+
+    def shard(self, textid):
+        """
+        Returns the shard of the text to add to the SyllableIndex
+        """
+        return {'textid': textid, 'postings': self.postings}
+
+
+class SyllableIndex(SQLiteSink):
+    """
+    The corpus syllable index in a SQLite database, opened when the first shard is added. It must be closed at the
+    end of the conversion.
+    """
+    schema = ('CREATE TABLE IF NOT EXISTS postings (syllable TEXT NOT NULL, textid TEXT NOT NULL, '
+              'seq INTEGER NOT NULL, div TEXT, para INTEGER, ms TEXT, PRIMARY KEY (syllable, textid, seq)) '
+              'WITHOUT ROWID',
+              'CREATE INDEX IF NOT EXISTS postings_text ON postings (textid)')
+
+    def add(self, shard):
+        """
+        Adds the shard of a text from SyllableIndexer.shard()
+        """
+        self.put(shard)
+
+    def write(self, shard):
+        if self.conn is None:
+            self.open()
+        with self.conn:
+            self.conn.execute('DELETE FROM postings WHERE textid = ?', (shard['textid'],))
+            self.conn.executemany('INSERT INTO postings VALUES (?, ?, ?, ?, ?, ?)',
+                                  [(syl, shard['textid'], seq, div, para, ms)
+                                   for seq, (syl, div, para, ms) in enumerate(shard['postings'])])
+
+
+def find_syllable(dbpath, syllable):
+    """
+    Returns the postings of a syllable in a syllable index as a list of (textid, div, paragraph, milestone) tuples
+    """
+    conn = sqlite3.connect(dbpath)
+    try:
+        return conn.execute('SELECT textid, div, para, ms FROM postings WHERE syllable = ? ORDER BY textid, seq',
+                            (syllable,)).fetchall()
+    finally:
+        conn.close()
@@ -11,10 +11,19 @@ import html
 import docx
 from lxml import etree
 
-from datetime import date
-from .styleelements import getStyleElement, getFontElement, buildElement
+from datetime import date, datetime
+from .styleelements import getStyleElement, getFontElement, buildMilestone
 from w3lib.html import replace_entities
-from .baseconverter import BaseConverter
+from .baseconverter import BaseConverter, ConversionException
+from .digitalpages import PagingOptions
+from .textfolders import text_number, folder_header
+from .textstore import TextStore, source_hash
+from .textexport import TextExport, EXPORT_EXTENSIONS, read_footnotes
+from .syllableindex import SyllableIndex, SyllableIndexer
+from .sections import SectionFile, document_key, plan_sections, section_hash
+from .media import MediaStore, image_rel_ids, relative_url
+from . import conversionlog, progress
+from .progress import Progress
 
 TEMPLATE_FOLDER = 'templates'
 IGNORABLE_STYLES = ['Paragraph Char', 'List Bullet Char']
@@ -30,6 +39,72 @@ Explanation of annotation regex above:
     fifth parentheses ([\u0F00-\u0FFF] ... ) = matching group of Tibetan reading or keywords (the whole second line)
 '''
 
+HEADING_PATTERN = re.compile(r'^Heading (?:Tibetan\s*)?(\d+)[\,\s]*(Front|Body|Back)?')
+SECTION_PATTERN = re.compile(r'section\s+(\d)', re.IGNORECASE)
+MILESTONE_PATTERN = re.compile(r'\[?(page|line\s+)?([^\]]+)\]?', re.IGNORECASE)
+MILESTONE_ED_PAGE_PATTERN = re.compile(r'\[?(\d)+\-page\s+([^\]]+)\]?', re.IGNORECASE)
+MILESTONE_SIGLA_PATTERN = re.compile(r'([^\W\d]\w*)-([\dab]+)')
+
+# Classification records of paragraph style names, populated by get_style_class()
+style_classes = {}
+
+
+def get_style_class(style_name):
+    """
+    Returns the classification record for a paragraph style name. The record is computed the first time a style name
+    is seen and then memoized, so that the handlers in TextConverter can dispatch on its values instead of
+    re-testing the style name for every paragraph.
+
+    :param style_name: the name of the Word paragraph style
+    :return: dict with the kind of paragraph ('heading', 'list', 'verse', 'citation', 'section', 'speech' or
+             'paragraph'), its level, the heading match and boolean flags
+    """
+    if style_name in style_classes:
+        return style_classes[style_name]
+    stynm = style_name or ''
+    lower = stynm.lower()
+    headmtch = HEADING_PATTERN.match(stynm)
+    level = None
+    if headmtch:
+        kind = 'heading'
+        level = int(headmtch.group(1))
+    elif "List" in stynm:
+        kind = 'list'
+        listnum = TextConverter.getnumber(stynm)
+        level = int(listnum) if listnum else None
+    elif "Verse" in stynm:
+        kind = 'verse'
+        level = 2 if '2' in stynm else 1
+    elif "Citation" in stynm:
+        kind = 'citation'
+    elif "Section" in stynm:
+        kind = 'section'
+        nmtch = SECTION_PATTERN.match(stynm)
+        level = int(nmtch.group(1)) if nmtch else None
+    elif "Speech" in stynm:
+        kind = 'speech'
+    else:
+        kind = 'paragraph'
+    stycls = {
+        'name': stynm,
+        'lower': lower,
+        'kind': kind,
+        'level': level,
+        'headmatch': headmtch,
+        'heading': 'heading' in lower,
+        'nested': 'nested' in lower,
+        'continued': 'continued' in lower,
+        'cite': 'citation' in lower,
+        'speech': 'speech' in lower,
+        'verse': 'verse' in lower,
+        'paragraph': 'paragraph' in lower,
+        'bullet': "Bullet" in stynm,
+        'verse_key': lower.replace('2', '1'),  # Verse style name without its level, to compare with previous verse
+        'regular': TextConverter.is_reg_p(stynm),
+    }
+    style_classes[style_name] = stycls
+    return stycls
+
 
 def get_lang_by_char(chr):
     unm = unicodedata.name(chr)
@@ -42,8 +117,44 @@ def get_lang_by_char(chr):
     return ''
 
 
+def parse_templates(option):
+    """
+    Parses the -t option, a template name or a comma separated list of them, each optionally followed by = and the
+    folder in the out folder to write its XML to, e.g. tib_text.xml=new,tib_text_old.xml=old. Without a folder, the
+    XML of each of several templates is written to a folder named after it.
+
+    :return: list of (template name, folder) tuples, the folder being '' for a single template
+    """
+    templates = []
+    for item in option.split(','):
+        tmpl, _, subdir = item.strip().partition('=')
+        if not tmpl:
+            continue
+        if not os.path.isfile(os.path.join(TEMPLATE_FOLDER, tmpl)):
+            raise FileNotFoundError("The template, {}, is not in the {} folder".format(tmpl, TEMPLATE_FOLDER))
+        templates.append((tmpl, subdir.strip()))
+    if len(templates) == 0:
+        raise ValueError("No template given")
+    if len(templates) > 1:
+        templates = [(tmpl, subdir or os.path.splitext(tmpl)[0]) for tmpl, subdir in templates]
+        subdirs = [subdir for tmpl, subdir in templates]
+        if len(set(subdirs)) < len(subdirs):
+            raise ValueError("Each template must be written to a different folder: {}".format(option))
+    return templates
+
+
+def parse_template(xmltext):
+    """
+    Returns the root element of a filled in template string
+    """
+    xmldoc = bytes(bytearray(xmltext, encoding='utf-8'))
+    # create lxml element tree from metadata info
+    parser = etree.XMLParser(ns_clean=True, recover=True, encoding='utf-8')
+    return etree.fromstring(xmldoc, parser)
+
+
 class TextConverter(BaseConverter):
-    def __init__(self, args):
+    def __init__(self, args, export_only=False):
         super().__init__(args)
         self.footnotes = {}
         self.fncount = 0
@@ -55,50 +166,276 @@ class TextConverter(BaseConverter):
         self.in_multiline_apparatus = False
         self.multiline_apparatus_num = 0
         self.multiline_apparatus_el = None
-
-    def convert(self):
-        for fl in self.files:
-            print("\n======================================\nConverting file: {}".format(fl))
-            self.current_file = fl
-            self.setlog()
+        self.paragraphs = []
+        self.prev_pstyle = get_style_class('')
+        # With -dp, digital pages and lines are added to the document before converting it
+        self.digital_pages = args.digital_pages if 'digital_pages' in args else False
+        self.paging = PagingOptions(args.options) if self.digital_pages else None
+        self.layout = args.layout if 'layout' in args else 'flat'
+        # With -db, the converted texts are also stored in a SQLite database with their header fields
+        self.metadata = {}
+        self.metarows = []
+        # With several templates, the document is converted once and written with the header of each
+        self.templates = parse_templates(self.template)
+        self.template = self.templates[0][0]
+        if 'database' in args and args.database:
+            self.textstore = TextStore(args.database)
+        # With -exp, the text is also exported as JSON Lines or plain text, or only exported for the export type
+        self.export_format = args.export if 'export' in args and args.export else None
+        self.export_only = export_only
+        if self.export_only and self.export_format is None:
+            self.export_format = 'jsonl'
+        self.export = None
+        # With -si, the syllables of the texts are indexed in a SQLite corpus index
+        self.syllableindex = SyllableIndex(args.syllable_index) if 'syllable_index' in args and args.syllable_index \
+            else None
+        self.indexer = None
+        # With -inc, the top level divs that have not changed since the last conversion are spliced from its
+        # section file instead of converted again
+        self.incremental = args.incremental if 'incremental' in args else False
+        if self.incremental and (self.outarchive is not None or self.digital_pages):
+            raise ValueError("Incremental conversion needs an out folder and cannot be used with digital pages")
+        self.sectionfile = None
+        self.sectiondivs = []
+        self.spliced = 0
+        # With -md, the images of the documents are extracted to the media folder of the out folder
+        self.media = None
+        if 'media' in args and args.media:
+            if self.outarchive is not None:
+                raise ValueError("Extracting the images of the documents needs an out folder")
+            self.media = MediaStore(self.outdir, self.jobs)
+        self.mediazip = None  # The zip file of the current document, opened for its first image
+        self.mediaurls = {}  # The urls of the images of the current document keyed on their name in the docx
+
+    def convertfile(self, fl):
+        progress.message("\n======================================\nConverting file: {}".format(fl))
+        self.current_file = fl
+        # The text id and chapter number are read from each document
+        self.textid = ''
+        self.chapnum = None
+        self.template = self.templates[0][0]
+        self.setlog()
+        try:
+            if self.export_only:
+                self.exportdoc()
+                self.write_walkers()
+                return
             self.convertdoc()
             self.bodydivcheck()
             self.assignids()
-            self.tidyxml()
-            self.writexml()
+            for tmpl, subdir in self.templates:
+                if tmpl != self.template:
+                    self.use_template(tmpl)
+                self.tidyxml()
+                self.writexml(subdir)
+            self.write_walkers()
+        finally:
+            self.export = None
+            self.indexer = None
+            if self.mediazip is not None:
+                self.mediazip.close()
+                self.mediazip = None
+            self.mediaurls = {}
+            self.endlog()
+
+    def check_log(self):
+        # Every document converted is logged
+        conversionlog.check_folder(self.log)
+
+    def sinks(self):
+        return super().sinks() + [sink for sink in (self.syllableindex, self.media) if sink is not None]
+
+    def start_walkers(self, notes, stylenames):
+        """
+        Starts the export and syllable index of the current document, if they are being made, which are given each
+        paragraph in the same traversal as the conversion
+        """
+        if self.export_format:
+            self.export = TextExport(self.export_format, notes, stylenames)
+        if self.syllableindex is not None:
+            self.indexer = SyllableIndexer(stylenames)
+        return [walker for walker in (self.export, self.indexer) if walker is not None]
+
+    def write_walkers(self):
+        if self.export is not None:
+            fname = self.current_file.replace('.docx', EXPORT_EXTENSIONS[self.export_format])
+            if self.outarchive is None and os.path.isfile(os.path.join(self.outdir, fname)) and not self.overwrite:
+                raise ConversionException("The file {} already exists. Use --overwrite to replace it".format(fname))
+            self.write_output(fname, self.export.getvalue())
+        if self.indexer is not None:
+            self.syllableindex.add(self.indexer.shard(self.text_key()))
+
+    def text_key(self):
+        """
+        Returns the text id of the current document, or its file name without extension if it has none
+        """
+        return self.textid or os.path.splitext(self.current_file)[0]
+
+    def exportdoc(self):
+        """
+        Exports the text of the current document, and indexes its syllables with -si, without converting it to XML
+        """
+        self.current_file_path = self.open_input(self.current_file)
+        self.worddoc = docx.Document(self.current_file_path)
+        self.styles = self.stylecache.table(self.worddoc)
+        mtch = re.search(r"^\S+-\d+-text", self.current_file)
+        if mtch:
+            self.textid = mtch.group(0)
+        walkers = self.start_walkers(read_footnotes(self.current_file_path), self.styles.by_id())
+        paragraphs = self.worddoc.paragraphs
+        prog = Progress("Exporting paragraphs", len(paragraphs))
+        for p in paragraphs:
+            prog.update()
+            pstyle = get_style_class(self.styles.paragraph_style(p))
+            for walker in walkers:
+                walker.add_paragraph(p, pstyle)
+        prog.close()
 
     def convertdoc(self):
-        self.current_file_path = os.path.join(self.indir, self.current_file)
+        # A path, or the content of the file if it is read from an archive
+        self.current_file_path = self.open_input(self.current_file)
         self.worddoc = docx.Document(self.current_file_path)
+        self.styles = self.stylecache.table(self.worddoc)
         if self.textid == '':
             mtch = re.search(r"^\S+-\d+-text", self.current_file)
             if mtch:
                 self.textid = mtch.group(0)
         self.nsmap = self.worddoc.element.nsmap
         self.merge_runs()
+        if self.digital_pages:
+            paginator = self.paging.paginator(self.current_file)
+            paginator.plan_document(self.worddoc, self.styles)
+            paginator.apply()
         self.pre_process_notes()
         self.createxml()
+        walkers = self.start_walkers({fnum: fno['text'] for fnum, fno in self.footnotes.items()},
+                                     self.styles.by_id())
 
         # self.mylog("In self my warning")
 
         # Iterate through paragraphs
-        totalp = len(self.worddoc.paragraphs)
-        ct = 0
+        self.paragraphs = self.worddoc.paragraphs
+        self.prev_pstyle = get_style_class('')
+        pstyles = [get_style_class(self.styles.paragraph_style(p)) for p in self.paragraphs]
+        # With -inc, the top level divs are keyed on the index of their first paragraph
+        sections = self.start_sections(pstyles) if self.incremental else {}
+        section = None  # The top level div being converted
+        skip_to = 0  # The end of the div spliced from the section file
+        prog = Progress("Converting paragraphs", len(self.paragraphs))
         in_app = False
         app_ps = []
-        for index, p in enumerate(self.worddoc.paragraphs):
-            ct += 1
-            print("\rDoing paragraph {} of {}  ".format(ct, totalp), end="")
+        for index, p in enumerate(self.paragraphs):
+            prog.update()
             self.pindex = index
             if isinstance(p, docx.text.paragraph.Paragraph):
+                pstyle = pstyles[index]
+                # Export and index the paragraph before the conversion changes the text of its runs
+                for walker in walkers:
+                    walker.add_paragraph(p, pstyle)
+                if section is not None and index == section['end']:
+                    self.end_section(section)
+                    section = None
+                if index in sections:
+                    if self.splice_section(sections[index]):
+                        skip_to = sections[index]['end']
+                    else:
+                        section = sections[index]
+                        section['apparatus'] = self.multiline_apparatus_num
+                if index < skip_to:
+                    continue
                 # Checks for and processes multiline apparatus returns true if paragraph is processed
                 paragraph_processed = self.process_multiline_app(p)
                 # If not in a multiline apparatus, process paragraph normally
                 if not paragraph_processed:
-                    self.convertpara(p)
+                    self.convertpara(p, pstyle)
+                if section is not None and index == section['start'] and len(self.headstack) == 2:
+                    section['div'] = self.headstack[-1]
+                self.prev_pstyle = pstyle
             else:
                 self.mylog("Warning: paragraph ({}) is not a docx paragraph cannot convert".format(p))
-        print("")
+        prog.close()
+        if self.incremental:
+            if section is not None:
+                self.end_section(section)
+            progress.message("Reused {} of {} top level divs".format(self.spliced, len(sections)))
+            self.sectionfile.save(self.sectiondivs)
+
+    def start_sections(self, pstyles):
+        """
+        Loads the section file of the current document and hashes its top level divs
+
+        :return: dict of the divs, dicts with their start, end and hash, keyed on the index of their first paragraph
+        """
+        key = document_key(self.textid, self.metadata, self.edsig, self.chapnum, len(self.endnotes),
+                           self.media_signature())
+        self.sectionfile = SectionFile(self.outdir, self.current_file, key).load()
+        self.sectiondivs = []
+        self.spliced = 0
+        if self.endnotes:
+            self.sectionfile.divs = {}  # Endnotes are taken in order by the divs that refer to them
+        sections = {}
+        for start, end in plan_sections(self.paragraphs, pstyles):
+            sections[start] = {'start': start, 'end': end,
+                               'hash': section_hash(self.paragraphs[start:end], self.footnotes),
+                               'last_style': pstyles[end - 1]['name']}
+        return sections
+
+    def media_signature(self):
+        """
+        Returns the names and CRCs of the images of the current document with -md, so its divs are converted again
+        if an image is replaced, or None
+        """
+        if self.media is None:
+            return None
+        with zipfile.ZipFile(self.current_file_path) as zipdoc:
+            return sorted((info.filename, info.CRC) for info in zipdoc.infolist()
+                          if info.filename.startswith('word/media/'))
+
+    def splice_section(self, section):
+        """
+        Adds the stored XML of a top level div to the current front, body or back, as do_header() would add the div,
+        if its hash and the apparatus number at its start are the same as when it was stored
+
+        :return: bool: whether the div was spliced
+        """
+        if self.in_multiline_apparatus or len(self.headstack) == 0:
+            return False
+        stored = self.sectionfile.find(section['hash'], self.multiline_apparatus_num)
+        if stored is None:
+            return False
+        div = etree.fromstring(stored['xml'])
+        # A div with an image no longer in the media folder is converted again to extract it
+        if self.media is not None and not all(self.media.register(graphic.get('url'))
+                                              for graphic in div.iter('graphic')):
+            return False
+        # Elements with empty text, e.g. milestones, are parsed with no text, which would serialize them as empty tags
+        elements = list(div.iter())
+        for pos in stored['empty']:
+            elements[pos].text = ''
+        self.headstack = self.headstack[0:1]
+        self.headstack[-1].append(div)
+        self.headstack.append(div)
+        self.current_el = div
+        self.multiline_apparatus_num = stored['apparatus'][1]
+        self.prev_pstyle = get_style_class(stored['last_style'])
+        self.sectiondivs.append(stored)
+        self.spliced += 1
+        return True
+
+    def end_section(self, section):
+        """
+        Keeps the XML of a converted top level div for the section file, unless a multiline apparatus continues
+        after it
+        """
+        if self.in_multiline_apparatus or 'div' not in section:
+            return
+        self.sectiondivs.append({
+            'hash': section['hash'],
+            'apparatus': [section['apparatus'], self.multiline_apparatus_num],
+            'last_style': section['last_style'],
+            'xml': etree.tostring(section['div'], encoding='unicode', with_tail=False),
+            'empty': [pos for pos, el in enumerate(section['div'].iter()) if el.text == '' and len(el) == 0],
+        })
 
     def pre_process_notes(self):
         """
@@ -278,19 +615,35 @@ class TextConverter(BaseConverter):
         self.endntcount = len(self.endnotes)
 
     def createxml(self):
-        template_path = os.path.join(TEMPLATE_FOLDER, self.template)
+        self.xmltemplate = self.read_template(self.template)
+        self.metatable = self.worddoc.tables[0] if len(self.worddoc.tables) else False
+        self.metadata = {}
+        self.metarows = []
+        if self.metatable:
+            self.createmeta()  # Separated out to be overriden. Creates the XML string with metadata inserted
+        self.xmlroot = parse_template(self.xmltemplate)
+
+    def read_template(self, template):
+        template_path = os.path.join(TEMPLATE_FOLDER, template)
         with open(template_path, 'r') as tempstream:
             if self.debug:
                 self.mylog(f"Template file: {template_path}")
-            self.xmltemplate = tempstream.read()
-            self.metatable = self.worddoc.tables[0] if len(self.worddoc.tables) else False
-            if self.metatable:
-                self.createmeta()  # Separated out to be overriden. Creates the XML string with metadata inserted
-            # Take self.xmltemplate the xml string and convert to an XML object
-            xmldoc = bytes(bytearray(self.xmltemplate, encoding='utf-8'))
-            # create lxml element tree from metadata info
-            parser = etree.XMLParser(ns_clean=True, recover=True, encoding='utf-8')
-            self.xmlroot = etree.fromstring(xmldoc, parser)
+            return tempstream.read()
+
+    def use_template(self, template):
+        """
+        Moves the converted text of the document into the header of another template, filled from the metadata
+        table already read, so the document can be written with that template without converting it again
+        """
+        xmltext = self.read_template(template)
+        if self.metatable:
+            xmltext = self.fill_template(xmltext)
+        root = parse_template(xmltext)
+        newtext = root.find('text')
+        newtext.getparent().replace(newtext, self.xmlroot.find('text'))
+        self.xmlroot = root
+        self.xmltemplate = xmltext
+        self.template = template
 
     def createmeta(self):
         """
@@ -303,12 +656,10 @@ class TextConverter(BaseConverter):
         :return:
         """
         wordtable = self.metatable
-        # Fill out metadata matching on string in wordtable with {strings} in template (teiHeader.dat)
-        xmltext = self.xmltemplate.replace("{Digital Creation Date}", str(date.today()))
         problems_on = False
         tablerows = len(wordtable.rows)
         problems = []
-        print("Process Metadata Table ...")
+        progress.message("Process Metadata Table ...")
         for rwnum in range(0, tablerows):
             try:
                 if wordtable._column_count < 2:
@@ -363,9 +714,8 @@ class TextConverter(BaseConverter):
                 if label != 'Cover Page':
                     label = label.replace('Cover Page', 'Cover').replace('Title Page', 'Cover')
                 srclbl = "{" + label + "}"
-
-                # Replace occurence of label in XML header
-                xmltext = xmltext.replace(srclbl, rowval)
+                self.metadata[label] = rowval
+                self.metarows.append((srclbl, rowval))
 
                 # Deal with edition sigla
                 if label.lower() == 'edition sigla':
@@ -380,52 +730,68 @@ class TextConverter(BaseConverter):
             except TypeError as e:
                 logging.error("Type error in iterating wordtable: {}".format(e))
 
+        self.xmltemplate = self.fill_template(self.xmltemplate)
+
+    def fill_template(self, xmltext):
+        """
+        Fills in the labels of a template string, e.g. {Title of Text}, with the values of the metadata table rows
+        read by createmeta()
+
+        :return: the filled in template string
+        """
+        # Fill out metadata matching on string in wordtable with {strings} in template (teiHeader.dat)
+        xmltext = xmltext.replace("{Digital Creation Date}", str(date.today()))
+        for srclbl, rowval in self.metarows:
+            # Replace occurence of label in XML header
+            xmltext = xmltext.replace(srclbl, rowval)
+
         # Add text ID if necessary and in current file name
         if self.current_file:
             res = re.search(r'^(\w+-\d+)-text', self.current_file)
             if res:
                 xmltext = xmltext.replace('{Text ID}', res.group(1))
 
-        self.xmltemplate = re.sub(r'{([^}]+)}', r'<!--\1-->', xmltext)  # comment out any unreplaced labels
+        return re.sub(r'{([^}]+)}', r'<!--\1-->', xmltext)  # comment out any unreplaced labels
 
-    def convertpara(self, p):
-        style_name = p.style.name
-        headmtch = re.match(r'^Heading (?:Tibetan\s*)?(\d+)[\,\s]*(Front|Body|Back)?', style_name)
-        if headmtch:
-            self.do_header(p, headmtch)
+    def convertpara(self, p, pstyle=None):
+        if pstyle is None:
+            pstyle = get_style_class(self.styles.paragraph_style(p))
+        kind = pstyle['kind']
+        if kind == 'heading':
+            self.do_header(p, pstyle['headmatch'])
 
         elif len(self.headstack) == 0:
             # if there is not yet a headstack then it's notes at beginning of document that should be ignored
             ptxt = p.text[0:150] if len(p.text) > 150 else p.text
-            self.mylog(f"Skipping Paragraph at beginning: {ptxt}")
+            self.mylog(f"Skipping Paragraph at beginning: {ptxt}", "Skipping Paragraph at beginning")
             return
 
-        elif "List" in style_name:
-            self.do_list(p)
+        elif kind == 'list':
+            self.do_list(p, pstyle)
 
-        elif "Verse" in style_name:
-            self.do_verse(p)  # Note this does verse citation and verse speech as well
+        elif kind == 'verse':
+            self.do_verse(p, pstyle)  # Note this does verse citation and verse speech as well
 
-        elif "Citation" in style_name:
-            self.do_citation(p)  # Note verse citation is done above in do_verse()
+        elif kind == 'citation':
+            self.do_citation(p, pstyle)  # Note verse citation is done above in do_verse()
 
-        elif "Section" in style_name:
-            doruns = self.do_section(p)
+        elif kind == 'section':
+            doruns = self.do_section(p, pstyle)
             if not doruns:
                 return
 
-        elif "Speech" in style_name:
-            self.do_speech(p)  # verse speech is done in do_verse()
+        elif kind == 'speech':
+            self.do_speech(p, pstyle)  # verse speech is done in do_verse()
 
         else:
-            if not self.is_reg_p(style_name):
-                msg = "\n\tStyle {} defaulting to paragraph".format(style_name)
-                self.mylog(msg)
+            if not pstyle['regular']:
+                msg = "\n\tStyle {} defaulting to paragraph".format(pstyle['name'])
+                self.mylog(msg, "Style {} defaulting to paragraph".format(pstyle['name']))
             self.reset_current_el()
             self.do_paragraph(p)
 
         # Once paragraphs have been processed. self.current_el is the element where the runs of the paragraph go
-        self.iterate_runs(p)  # so all we need to do is send the word paragraph object
+        self.iterate_runs(p, pstyle=pstyle)  # so all we need to do is send the word paragraph object
 
     def do_header(self, p, headmtch):
         """
@@ -437,7 +803,7 @@ class TextConverter(BaseConverter):
         :return: none
         """
         hlevel = int(headmtch.group(1))
-        style_name = p.style.name
+        style_name = self.styles.paragraph_style(p)
         if hlevel == 0:
             # If level is 0, its front body or back, create element and clear head stack
             fbbel = etree.XML('<{0}><head></head></{0}>'.format(headmtch.group(2).lower())) # the match is e.g. "front"
@@ -473,20 +839,19 @@ class TextConverter(BaseConverter):
                 self.headstack.append(hdiv)
             self.current_el = hdiv.find('head')
 
-    def do_list(self, p):
+    def do_list(self, p, pstyle):
         # Get current and previous list styles and numbers
-        my_style = p.style.name
-        my_num = self.getnumber(my_style) or 1
-        prev_style = self.get_previous_p(True)
-        prev_num = self.getnumber(prev_style) if "List" in prev_style else False
+        prev_pstyle = self.prev_pstyle
+        my_num = pstyle['level'] or 1
+        prev_num = prev_pstyle['level'] if prev_pstyle['kind'] == 'list' else False
         if not prev_num:
-            if my_style == prev_style:
+            if pstyle['name'] == prev_pstyle['name']:
                 prev_num = my_num
-            elif "List" in prev_style:
+            elif prev_pstyle['kind'] == 'list':
                 prev_num = 1
 
         # Determine the type of list and set attribute values
-        rend = "bullet" if "Bullet" in my_style else "1"
+        rend = "bullet" if pstyle['bullet'] else "1"
         nval = ' n="1"' if rend == "1" else ""
         # ptxt = p.text
 
@@ -534,18 +899,16 @@ class TextConverter(BaseConverter):
                 self.headstack[-1].append(listel)
                 self.current_el = listel.find('item')
 
-    def do_verse(self, p):
+    def do_verse(self, p, pstyle):
         # TODO: Throw warning when a Verse2 is found without a preceding verse1 (maybe interpret it as verse1)
-        my_style = p.style.name
-        prev_style = self.get_previous_p(True)  # TODO: Check if current style is same (except number) with previous
-        is_cite = True if 'citation' in my_style.lower() else False
-        is_speech = True if 'speech' in my_style.lower() else False
-        is_nested = True if 'nested' in my_style.lower() else False
-        is_same = True if my_style.lower().replace('2', '1') == prev_style.lower().replace('2', '1') else False
-        level = 2 if '2' in my_style else 1
-        if level == 2:
+        prev_pstyle = self.prev_pstyle
+        is_cite = pstyle['cite']
+        is_speech = pstyle['speech']
+        is_nested = pstyle['nested']
+        is_same = pstyle['verse_key'] == prev_pstyle['verse_key']
+        if pstyle['level'] == 2:
             myel = etree.Element('l')
-            if not is_nested and "nested" in prev_style.lower():
+            if not is_nested and prev_pstyle['nested']:
                 self.current_el.getparent().addnext(myel)
             else:
                 self.current_el.addnext(myel)
@@ -557,7 +920,7 @@ class TextConverter(BaseConverter):
                 self.current_el.getparent().addnext(markup)
                 self.current_el = markup.find('l')
 
-            elif is_nested and "citation" in prev_style.lower() and "paragraph" in prev_style.lower():
+            elif is_nested and prev_pstyle['cite'] and prev_pstyle['paragraph']:
                 # when nested in paragraph citation
                 markup = etree.XML('<lg><l></l></lg>')
                 self.current_el.addnext(markup)
@@ -585,15 +948,14 @@ class TextConverter(BaseConverter):
                 self.current_el = markup.find('l')
             self.headstack[-1].append(markup)
 
-    def do_citation(self, p):
-        my_style = p.style.name
-        prev_style = self.get_previous_p(True)  # TODO: Check if current style is same (except number) with previous
-        nested = True if "nested" in my_style.lower() else False
-        continued = True if "continued" in my_style.lower() else False
+    def do_citation(self, p, pstyle):
+        prev_pstyle = self.prev_pstyle
+        nested = pstyle['nested']
+        continued = pstyle['continued']
 
-        if continued or (nested and my_style == prev_style):
+        if continued or (nested and pstyle['name'] == prev_pstyle['name']):
             cite_el = etree.XML('<p rend="cont"></p>')
-            if "verse" in prev_style.lower():
+            if prev_pstyle['verse']:
                 self.current_el.getparent().addnext(cite_el)
             else:
                 self.current_el.addnext(cite_el)
@@ -602,30 +964,28 @@ class TextConverter(BaseConverter):
             cite_el = etree.XML('<quote><p></p></quote>')
             if nested:
                 self.current_el.append(cite_el)
-            elif "nested" in prev_style:
+            elif "nested" in prev_pstyle['name']:
                 self.current_el.getparent().addnext(cite_el)
             else:
                 self.current_el.addnext(cite_el)
             self.current_el = cite_el.find('p')
 
-    def do_section(self, p):
-        my_style = p.style.name
+    def do_section(self, p, pstyle):
         ptext = p.text
-        nmtch = re.match(r'section\s+(\d)', my_style, re.IGNORECASE)
-        if nmtch:
-            n = nmtch.group(1)
+        if pstyle['level'] is not None:
+            n = pstyle['level']
             sect_el = etree.XML('<milestone unit="section" n="{}" rend="{}" />'.format(n, ptext))
             self.headstack[-1].append(sect_el)
             self.current_el = sect_el
             return False
 
-        elif 'chapter element' in my_style.lower():
+        elif 'chapter element' in pstyle['lower']:
             sect_el = etree.XML('<milestone unit="section" n="cle" rend="{}" />'.format(ptext))
             self.headstack[-1].append(sect_el)
             self.current_el = sect_el
             return False
 
-        elif 'interstitial' in my_style.lower():
+        elif 'interstitial' in pstyle['lower']:
             sect_el = etree.XML('<div type="interstitial"><head></head></div>')
             self.headstack[-1].append(sect_el)
             self.current_el = sect_el.find('head')
@@ -639,17 +999,15 @@ class TextConverter(BaseConverter):
             self.current_el = sect_el.find('head')
             return True
 
-    def do_speech(self, p):
+    def do_speech(self, p, pstyle):
         #  Note this is speech not already covered in verse or citation. See convertpara() method above
-        my_style = p.style.name.lower()
-        prev_style = self.get_previous_p(True)
-        iscont = True if "continued" in my_style else False
-        isnested = True if "nested" in my_style else False
+        iscont = pstyle['continued']
+        isnested = pstyle['nested']
         speech_el = etree.XML('<q><p></p></q>')  # use for new nested or new not nested
         if iscont:
             # iscontinued whether nested or not
             speech_el = etree.XML('<p rend="cont"></p>')
-            if "nested" in prev_style and "nested" not in my_style:
+            if "nested" in self.prev_pstyle['name'] and not isnested:
                 self.current_el.getparent().addnext(speech_el)
             else:
                 self.current_el.addnext(speech_el)
@@ -686,7 +1044,7 @@ class TextConverter(BaseConverter):
                 self.current_el.addnext(p_el)
         self.current_el = p_el
 
-    def iterate_runs(self, p, skip=0):
+    def iterate_runs(self, p, skip=0, pstyle=None):
         '''
         Populates a paragraph level element with its runs properly marked up (these are character level styles)
         Creates a <temp> element to contain the inner XML structure of the paragraph level element
@@ -697,6 +1055,7 @@ class TextConverter(BaseConverter):
 
         :param p:
         :param skip: (int) number of runs to skip before beginning processing (used for multiline apparatus)
+        :param pstyle: the classification record of the paragraph style, see get_style_class()
         :return:
         '''
         last_run_style = ''
@@ -727,7 +1086,8 @@ class TextConverter(BaseConverter):
                 while "}" not in p.runs[nextct].text and nextct - rct < 100:
                     nextct += 1
                     lemma_contents.append(p.runs[nextct])
-                if "}" in p.runs[nextct].text and p.runs[nextct + 1].style.name == 'footnote reference':
+                if "}" in p.runs[nextct].text and \
+                        self.styles.run_style(p.runs[nextct + 1]) == 'footnote reference':
                     skip = nextct + 1
                     if rtxt == '{' or rtxt[0] == '{':
                         continue
@@ -748,7 +1108,17 @@ class TextConverter(BaseConverter):
             # if "Heading" in p.style.name:
             #    rtxt = re.sub(r'^[\d\s\.]+', '', rtxt)
 
-            char_style = run.style.name
+            # Images, with -md
+            if self.media is not None:
+                figures = self.create_figures(run)
+                for figure in figures:
+                    temp_el.append(figure)
+                    elem = figure
+                if figures and rtxt == '':
+                    last_run_style = ''  # So the text of the next run is not added to the figure
+                    continue
+
+            char_style = self.styles.run_style(run)
             is_new_style = True if char_style != last_run_style else False
             # if "root" in char_style.lower():
             #    print(f"root style: {char_style}")
@@ -836,7 +1206,7 @@ class TextConverter(BaseConverter):
                             pstart = pstart[0:25]
                         msg = f"\n\tNo style definition found for style name, {char_style}: {outrtxt}\n" \
                               f"\tParagraph beginning with: “{pstart}”..."
-                        self.mylog(msg)
+                        self.mylog(msg, f"No style definition found for style {char_style}")
 
                 else:
                     if self.debug:
@@ -873,7 +1243,9 @@ class TextConverter(BaseConverter):
             self.current_el.append(tempchild)
 
         # Deal with numbers at the beginning of headers
-        if "heading" in p.style.name.lower():
+        if pstyle is None:
+            pstyle = get_style_class(self.styles.paragraph_style(p))
+        if pstyle['heading']:
             headtxt = self.current_el.text
             mtch = re.match(r'^((\d+\.?)+)', headtxt)
             if mtch:
@@ -979,7 +1351,7 @@ class TextConverter(BaseConverter):
             elif isinstance(rn, bytes):
                 lemmaout += rn.decode('utf-8')
             elif isinstance(rn, docx.text.run.Run):
-                rstyle = rn.style.name
+                rstyle = self.styles.run_style(rn)
                 rtxt = rn.text
                 if "Page Number" in rstyle or "Line Number" in rstyle:
                     # If there are multiple ms of the same style, they get merged in merge_runs. So split them up
@@ -1090,7 +1462,7 @@ class TextConverter(BaseConverter):
                 self.mylog("Multiline apparatus finished: " + ptxt)
                 paragraph_processed = True  # This returns true to prevent further processing of this paragraph
                 srcs = []
-                if p.runs[1].style.name == 'footnote reference':
+                if self.styles.run_style(p.runs[1]) == 'footnote reference':
                     nnum, note = self.get_footnote_from_ref(p.runs[1])
                     srcs = [pt.strip() for pt in note['text'].split(',')]
                 else:
@@ -1127,7 +1499,7 @@ class TextConverter(BaseConverter):
                 self.current_el.append(lb)
                 self.current_el = lb
         for rn in app_ps[-1].runs:
-            char_style = rn.style.name.lower()
+            char_style = self.styles.run_style(rn).lower()
             if "footnote" in char_style or "endnote" in char_style:
                 note = self.endnotes.pop(0) if "endnote" in char_style.lower() else self.footnotes.pop(0)
                 notedata = TextConverter.process_critical_note(note)
@@ -1152,24 +1524,45 @@ class TextConverter(BaseConverter):
         orig_current_el.addnext(app_el)
         self.current_el = app_el
 
+    def create_figures(self, run):
+        """
+        Extracts the images of a run to the media folder
+
+        :return: list of figure elements with the graphic of each image
+        """
+        figures = []
+        for rid in image_rel_ids(run.element):
+            rel = self.worddoc.part.rels.get(rid)
+            if rel is None or rel.is_external:
+                self.mylog("Image {} is linked rather than embedded and is not extracted".format(rid))
+                continue
+            member = rel.target_part.partname.lstrip('/')
+            if member not in self.mediaurls:
+                if self.mediazip is None:
+                    self.mediazip = zipfile.ZipFile(self.current_file_path)
+                self.mediaurls[member] = self.media.extract(self.mediazip, member)
+            figure = etree.Element('figure')
+            etree.SubElement(figure, 'graphic', url=self.mediaurls[member])
+            figures.append(figure)
+        return figures
+
     @staticmethod
     def createmilestone(char_style, mstxt):
         msnum = mstxt.replace('[', '').replace(']', '')   # Default backup num if regex doesn't match
-        mtch = re.match(r'\[?(page|line\s+)?([^\]]+)\]?', mstxt, re.IGNORECASE)
+        mtch = MILESTONE_PATTERN.match(mstxt)
         if mtch:
             # Discard the "page" or "line" part, i.e., mtch.group(1), as this can be resupplied by xslt in display.
             msnum = mtch.group(2)
         else:  # In TCD some formatting weirdness in page milestones read as: [21-page Dg]
-            mtch = re.match(r'\[?(\d)+\-page\s+([^\]]+)\]?', mstxt, re.IGNORECASE)
+            mtch = MILESTONE_ED_PAGE_PATTERN.match(mstxt)
             if mtch:
                 msnum = mtch.group(2) + '-' + mtch.group(1)  # 2 is Ed sig and 1 is pagenum
         # Check for milestones with ed sigla in pagination, as in TCD: [page Ad-7] which will yield a msnum of Ad-7
-        ed = False
-        if re.match(r'\w+-\[\dab]+', msnum):
-            ed, msnum = msnum.split('-')
-        ed = [] if ed is False else [ed]
-        ms = buildElement(char_style, msnum, ed)
-        return etree.XML(ms)
+        ed = None
+        mtch = MILESTONE_SIGLA_PATTERN.fullmatch(msnum.strip())
+        if mtch:
+            ed, msnum = mtch.group(1), mtch.group(2)
+        return buildMilestone(char_style, msnum, ed)
 
     def reset_current_el(self):
         """
@@ -1193,7 +1586,7 @@ class TextConverter(BaseConverter):
 
         :return:
         """
-        print("\rChecking body for chapter divs")
+        progress.message("Checking body for chapter divs")
         bdivs = self.xmlroot.xpath('/*//text/body/div[@n="1"]')
         if len(bdivs) == 0:
             bd = self.xmlroot.xpath('/*//text/body')[0]
@@ -1205,7 +1598,7 @@ class TextConverter(BaseConverter):
                     div.append(bdchild)
 
     def assignids(self):
-        print("\rAssigning IDs");
+        progress.message("Assigning IDs")
         divs = self.xmlroot.xpath('/*//text//div')
         for divel in divs:
             headtxt = divel.xpath('./head[1]/num/text()')
@@ -1274,74 +1667,135 @@ class TextConverter(BaseConverter):
         for resp in empty_resp:
             resp.getparent().remove(resp)
 
-    def writexml(self):
+    def writexml(self, subdir=''):
+        """
+        Writes the XML file of the current document
+
+        :param subdir: the folder within the out folder to write it in, for one of several templates
+        """
         # Determine Name for Resulting XML file
         fname = self.current_file.replace('.docx', '.xml')
-        fpth = os.path.join(self.outdir, fname)
-        while os.path.isfile(fpth) and not self.overwrite:
+        outdir = os.path.join(self.outdir, subdir) if subdir else self.outdir
+        tnum = None
+        if self.layout == 'foldered':
+            # Write the file directly into its text number folder, as makeTextFolders does
+            tnum = text_number(self.textid)
+            if tnum is None:
+                raise ConversionException("Cannot write {} in a text folder as its text id, {}, has no "
+                                          "text number".format(fname, self.textid))
+            outdir = os.path.join(outdir, tnum)
+        if self.outarchive is None:
+            os.makedirs(outdir, exist_ok=True)
+        fpth = os.path.join(outdir, fname)
+        while self.outarchive is None and os.path.isfile(fpth) and not self.overwrite:
+            if not self.interactive:
+                raise ConversionException("The file {} already exists. Use --overwrite to replace it".format(fname))
             userin = input("The file {} already exists. Overwrite it (y/n/q): ".format(fname))
             if userin == 'y':
                 break
             elif userin == 'n':
                 fname = input("Enter a new file name: ")
-                fpth = os.path.join(self.outdir, fname)
+                fpth = os.path.join(outdir, fname)
             else:
                 exit(0)
 
+        # Build the XML File
+        genid = self.textid.split('-text')[0] if '-text' in self.textid else self.textid
+        bibid = genid + '-bib'
+        # remove text document sub number for e.g. lccw-0353-1.docx
+        # genid = re.sub(r'(-\d{4})-\d+', r'\1', genid)
+        # Calculate bibl folder (first number of text id number)
+        mtch = re.search(r'-(\d{4})', genid)
+        fldr = mtch.group(1)[0] if mtch else '0'
+        biblent = f"<!ENTITY {bibid} " \
+                  f"SYSTEM \"../../{fldr}/{bibid}.xml\">" if self.args.bibl_entity is True else ""
+        doc_type = f"<!DOCTYPE TEI.2 SYSTEM \"{self.dtdpath}xtib3.dtd\" [ \n" \
+            f"\t<!ENTITY % thlnotent SYSTEM \"{self.dtdpath}catalog-refs.dtd\" > \n" \
+            "\t%thlnotent;\n" \
+            f"\t{biblent}\n]>"
+
+        # Replace profile desc with entity
+        pdentity = etree.Entity('thdlprofiledesc')
+        pdesc = self.xmlroot.xpath('//profileDesc')[0]
+        pdesc.addprevious(pdentity)
+        pdesc.getparent().remove(pdesc)
+
+        # Add tibbibl entity if there is a text id
+        if self.textid and genid:
+            tibsrc = etree.XML('<sourceDesc n="tibbibl"></sourceDesc>')
+            if self.args.bibl_entity:
+                tibbibl_ent = etree.Entity(bibid)
+                tibsrc.append(tibbibl_ent)
+                tibsrc.tail = "\n"
+                docsrc = self.xmlroot.xpath('//sourceDesc')[0]
+                docsrc.addprevious(tibsrc)
+        # The image urls are relative to the out folder until the folder of the XML file is known
+        graphics = [(graphic, graphic.get('url')) for graphic in self.xmlroot.iter('graphic')] if self.media else []
+        for graphic, url in graphics:
+            graphic.set('url', relative_url(url, os.path.relpath(outdir, self.outdir)))
+        xmlstring = etree.tostring(self.xmlroot,
+                                   pretty_print=True,
+                                   encoding='utf-8',
+                                   xml_declaration=True,
+                                   doctype=doc_type)
+        for graphic, url in graphics:
+            graphic.set('url', url)
+        if tnum is not None:
+            # Use the relative DTD and tibbibl entity of the text folder, from the folder of the template if any
+            depth = len(os.path.normpath(subdir).split(os.sep)) if subdir else 0
+            xmlstring = folder_header(xmlstring, tnum, depth)
+
         # Write XML File
-        with open(fpth, "wb") as outfile:
-            genid = self.textid.split('-text')[0] if '-text' in self.textid else self.textid
-            bibid = genid + '-bib'
-            # remove text document sub number for e.g. lccw-0353-1.docx
-            # genid = re.sub(r'(-\d{4})-\d+', r'\1', genid)
-            # Calculate bibl folder (first number of text id number)
-            mtch = re.search(r'-(\d{4})', genid)
-            fldr = mtch.group(1)[0] if mtch else '0'
-            biblent = f"<!ENTITY {bibid} " \
-                      f"SYSTEM \"../../{fldr}/{bibid}.xml\">" if self.args.bibl_entity is True else ""
-            doc_type = f"<!DOCTYPE TEI.2 SYSTEM \"{self.dtdpath}xtib3.dtd\" [ \n" \
-                f"\t<!ENTITY % thlnotent SYSTEM \"{self.dtdpath}catalog-refs.dtd\" > \n" \
-                "\t%thlnotent;\n" \
-                f"\t{biblent}\n]>"
-
-            # Replace profile desc with entity
-            pdentity = etree.Entity('thdlprofiledesc')
-            pdesc = self.xmlroot.xpath('//profileDesc')[0]
-            pdesc.addprevious(pdentity)
-            pdesc.getparent().remove(pdesc)
-
-            # Add tibbibl entity if there is a text id
-            if self.textid and genid:
-                tibsrc = etree.XML('<sourceDesc n="tibbibl"></sourceDesc>')
-                if self.args.bibl_entity:
-                    tibbibl_ent = etree.Entity(bibid)
-                    tibsrc.append(tibbibl_ent)
-                    tibsrc.tail = "\n"
-                    docsrc = self.xmlroot.xpath('//sourceDesc')[0]
-                    docsrc.addprevious(tibsrc)
-            xmlstring = etree.tostring(self.xmlroot,
-                                       pretty_print=True,
-                                       encoding='utf-8',
-                                       xml_declaration=True,
-                                       doctype=doc_type)
-            outfile.write(xmlstring)
+        if self.outarchive is not None:
+            self.write_output(os.path.relpath(fpth, self.outdir), xmlstring)
+        else:
+            with open(fpth, "wb") as outfile:
+                outfile.write(xmlstring)
+        if self.textstore is not None:
+            self.textstore.add(self.store_row(xmlstring))
+
+    def store_row(self, xmlstring):
+        """
+        Returns the row of the text store for the current file
+
+        :param xmlstring: the bytes of the converted XML
+        :return: dict keyed on the columns of the store
+        """
+        return {
+            'textid': self.text_key(),
+            'file': self.current_file,
+            'source_hash': source_hash(self.current_file_path),
+            'template': self.template,
+            'converted': datetime.now().isoformat(timespec='seconds'),
+            'title': self.metadata.get('Title of Text') or None,
+            'author': self.metadata.get('Author of Text') or None,
+            'edition_sigla': self.edsig or None,
+            'chapter_number': self.chapnum,
+            'xml': xmlstring,
+        }
 
     #  HELPER METHODS
     def get_previous_p(self, as_style=False):
         pind = self.pindex - 1
         if pind > -1:
-            prevp = self.worddoc.paragraphs[pind]
+            prevp = self.paragraphs[pind] if self.paragraphs else self.worddoc.paragraphs[pind]
             if as_style:
-                return prevp.style.name
+                return self.styles.paragraph_style(prevp)
             else:
                 return prevp
         return False
 
     # STATIC HELPER METHODS
     @staticmethod
-    def mylog(msg):
-        print(msg)
-        logging.warning(msg)
+    def mylog(msg, category=None):
+        """
+        Logs a warning that is also shown on the console. Messages of the same category (by default the message
+        itself) are only logged the first few times per document and then counted, see conversionlog
+
+        :param msg: the message
+        :param category: the category of message for counting repeats, e.g. "style X missing"
+        """
+        logging.warning(msg, extra={'console': True, 'category': category})
 
     @staticmethod
     def getnumber(stynm):
@@ -1405,7 +1859,7 @@ class TextConverter(BaseConverter):
         prevrun = None
         for paragraph in self.worddoc.paragraphs:
             for run in paragraph.runs:
-                if run.style.name == 'footnote reference':
+                if self.styles.run_style(run) == 'footnote reference':
                     fnnum, note = self.get_footnote_from_ref(run, False)
                     if fnnum == nnum:
                         if prevrun and prevrun.text:
@@ -1435,8 +1889,3 @@ class TextConverter(BaseConverter):
                 self.mylog("index error: {}".format(ie))
 
         return fnnum, note
-
-
-class ConversionException(Exception):
-    pass
-
@@ -0,0 +1,185 @@
+#!env/bin/python
+"""
+A plain text and JSON Lines export of Word documents for search indexing and QA diffing, which keeps only the text
+and its structural boundaries: divs, paragraphs, verse lines and notes. It walks the same paragraphs and runs as the
+TextConverter, but only joins the text of the runs, without building or serializing any TEI elements. It is used by
+the export conversion type or, with the -exp option, alongside the XML of a conversion from the same parse. Its
+ParagraphWalker, which follows the divs and milestones of the paragraphs, is also used by the syllable index.
+
+Each JSON line is a paragraph or a note, e.g.:
+    {"seq": 12, "kind": "verse", "level": 1, "div": "body.2.1", "page": "3a", "text": "..."}
+where kind is the kind of the paragraph style (see get_style_class()) or "note", div is the path of heading numbers
+within the front, body or back and page is the last page milestone before the paragraph. In the plain text, each
+paragraph or verse line is a line, each heading is preceded by a blank line and notes follow their paragraph
+as "[n] text".
+"""
+import json
+import re
+import zipfile
+
+from lxml import etree
+
+EXPORT_FORMATS = ('jsonl', 'text')
+EXPORT_EXTENSIONS = {'jsonl': '.jsonl', 'text': '.txt'}
+WORD_NS = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+FOOTNOTE_REF_TAG = '{%s}footnoteReference' % WORD_NS
+MILESTONE_PATTERN = re.compile(r'\[?(?:page\s+|line\s+)?([^\]]*)\]?', re.IGNORECASE)
+HEAD_NUMBER_PATTERN = re.compile(r'^((\d+\.?)+)')
+SECTION_LETTERS = ['', 'a', 'b', 'c']
+
+
+def read_footnotes(src):
+    """
+    Reads the plain text of the footnotes of a docx without processing them as the TextConverter does
+
+    :param src: the path of the docx or a file object with its content
+    :return: dict of footnote text keyed on footnote id
+    """
+    notes = {}
+    with zipfile.ZipFile(src) as zipdoc:
+        if 'word/footnotes.xml' not in zipdoc.namelist():
+            return notes
+        root = etree.fromstring(zipdoc.read('word/footnotes.xml'))
+    for fn in root.iterfind('{%s}footnote' % WORD_NS):
+        fnid = fn.get('{%s}id' % WORD_NS)
+        if fnid is not None:
+            notes[fnid] = ''.join(fn.itertext('{%s}t' % WORD_NS))
+    return notes
+
+
+def div_id(headnum):
+    """
+    Returns the id that assignids() gives the div of a heading number, e.g. b1-2 for 2.1.2.
+    """
+    headlist = headnum.split('.')
+    first = headlist.pop(0)
+    mainsect = SECTION_LETTERS[int(first)] if first.isdigit() and 0 < int(first) < 4 else first
+    if len(headlist) == 0:
+        return mainsect
+    headlist[0] = mainsect + headlist[0]
+    return '-'.join(headlist).rstrip('-')
+
+
+class ParagraphWalker:
+    """
+    Walks the paragraphs and runs of a document as the conversion does, keeping track of the div, page and line
+    milestones and the number of the paragraph, and passes the text of each paragraph and its notes to add_text()
+    and add_note(), which subclasses implement.
+    """
+    def __init__(self, notes, stylenames):
+        """
+        :param notes: dict of footnote text keyed on footnote id
+        :param stylenames: dict of the style names of the document keyed on style id, from StyleTable.by_id()
+        """
+        self.notes = notes
+        self.stylenames = stylenames
+        self.divs = []  # The front, body or back, then the number of the current div at each heading level
+        self.divid = None  # The id of the current div from its heading number, if it has one
+        self.page = None
+        self.line = None
+        self.paras = 0
+
+    def add_paragraph(self, p, pstyle):
+        """
+        Adds a Word paragraph and its notes. As in the conversion, paragraphs before the first heading are skipped
+
+        :param p: the docx paragraph
+        :param pstyle: the classification record of its style from get_style_class()
+        """
+        kind = pstyle['kind']
+        if kind == 'heading':
+            self.start_div(pstyle['level'], pstyle['headmatch'].group(2))
+        elif len(self.divs) == 0:
+            return
+        self.paras += 1
+        page = self.page
+        segments = []  # The text of each run with the page and line it is on
+        noteids = []
+        for run in p.runs:
+            char_style = self.stylenames.get(run.element.style, '').lower()
+            if 'footnote' in char_style:
+                ref = run.element.find(FOOTNOTE_REF_TAG)
+                if ref is not None:
+                    noteids.append(ref.get('{%s}id' % WORD_NS))
+            elif 'page number' in char_style:
+                self.page = MILESTONE_PATTERN.match(run.text.split('][')[-1]).group(1).strip()
+            elif 'line number' in char_style:
+                self.line = MILESTONE_PATTERN.match(run.text.split('][')[-1]).group(1).strip()
+            else:
+                segments.append((run.text.replace('{', '').replace('}', ''), self.page, self.line))
+        if kind == 'heading' and pstyle['level'] > 0:
+            mtch = HEAD_NUMBER_PATTERN.match(''.join(txt for txt, pg, ln in segments).strip())
+            self.divid = div_id(mtch.group(1)) if mtch else None
+        self.add_text(kind, pstyle['level'], page, segments)
+        for noteid in noteids:
+            if noteid in self.notes:
+                self.add_note(noteid, page, self.notes[noteid].strip())
+
+    def start_div(self, level, fbb):
+        self.divid = None
+        if level == 0 or len(self.divs) == 0:
+            self.divs = [fbb.lower() if fbb else 'body']
+            if level == 0:
+                return
+        del self.divs[level + 1:]
+        while len(self.divs) <= level:
+            self.divs.append(0)
+        self.divs[level] += 1
+
+    def div_path(self):
+        return '.'.join(str(d) for d in self.divs)
+
+    def add_text(self, kind, level, page, segments):
+        """
+        :param kind: the kind of the paragraph style
+        :param level: the level of the paragraph style, e.g. of a heading
+        :param page: the page at the start of the paragraph
+        :param segments: list of (text, page, line) tuples for the text runs of the paragraph
+        """
+        pass
+
+    def add_note(self, noteid, page, text):
+        pass
+
+
+class TextExport(ParagraphWalker):
+    """
+    The export of one document, built up paragraph by paragraph with add_paragraph()
+    """
+    def __init__(self, fmt, notes, stylenames):
+        """
+        :param fmt: one of EXPORT_FORMATS
+        """
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError("The export format, {}, must be one of: {}".format(fmt, ', '.join(EXPORT_FORMATS)))
+        super().__init__(notes, stylenames)
+        self.format = fmt
+        self.lines = []
+        self.seq = 0
+
+    def add_text(self, kind, level, page, segments):
+        text = ''.join(txt for txt, pg, ln in segments).strip()
+        if text or kind == 'heading':
+            self.add_record(kind, level, page, text)
+
+    def add_note(self, noteid, page, text):
+        self.add_record('note', None, page, text, noteid)
+
+    def add_record(self, kind, level, page, text, n=None):
+        self.seq += 1
+        if self.format == 'text':
+            if kind == 'heading':
+                self.lines.append('')
+            self.lines.append(text if n is None else '[{}] {}'.format(n, text))
+            return
+        record = {'seq': self.seq, 'kind': kind, 'level': level, 'div': self.div_path(),
+                  'page': page, 'text': text}
+        if n is not None:
+            record['n'] = n
+        self.lines.append(json.dumps(record, ensure_ascii=False))
+
+    def getvalue(self):
+        """
+        Returns the bytes of the export
+        """
+        return ('\n'.join(self.lines) + '\n').encode('utf-8')
@@ -0,0 +1,118 @@
+#!env/bin/python
+"""
+A converter that puts converted texts into their text number folders, as in the lccw catalog, e.g.
+lccw-0012-text.xml goes into the folder 0012. The header of each text is changed to use the relative DTD and the
+tibbibl entity of its folder. Only the header is read and rewritten, the rest of the file is copied in blocks,
+so the files are not held in memory.
+"""
+from .baseconverter import BaseConverter, ConversionException
+from shutil import copyfileobj
+from os import path, makedirs
+import re
+
+TEXT_NUMBER_PATTERN = r'^[^-]+-(\d{4})'
+FOLDER_DTD = '<?xml version="1.0" encoding="UTF-8"?>' \
+             '<!DOCTYPE TEI.2 SYSTEM "../../../../../xml/dtds/xtib3.dtd" [' \
+             '<!ENTITY % thlnotent SYSTEM "../../../catalog-refs.dtd" >' \
+             '%thlnotent;' \
+             ' <!ENTITY lccw-TNUM SYSTEM "../../0/lccw-TNUM-bib.xml">' \
+             ']><TEI.2'
+FOLDER_SOURCE_DESC = ' <sourceDesc n="tibbibl">&lccw-TNUM;</sourceDesc>'
+HEADER_READ_SIZE = 64 * 1024
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class TextFolders(BaseConverter):
+    def __init__(self, args):
+        # The files to put in folders are XML, so if no extension is given do not use the default .docx
+        if args.extension == '.docx':
+            args.extension = '.xml'
+        super().__init__(args)
+
+    def convert(self):
+        failed = self.run_tasks(self.files, label="Texts put in folders")[1]
+        print("\nPut {} texts into text folders in {}, {} failed".format(
+            len(self.files) - len(failed), self.outdir, len(failed)))
+
+    def convertdoc(self):
+        tnum = text_number(self.current_file)
+        if tnum is None:
+            raise ConversionException("No text number in the file name {}".format(self.current_file))
+        src = self.open_input(self.current_file)
+        if self.outarchive is not None:
+            # Archive entries are written whole, so the text is read into memory
+            with open(src, 'rb') if isinstance(src, str) else src as infile:
+                head, rest = read_header(infile)
+                self.write_output(path.join(tnum, self.current_file),
+                                  folder_header(head, tnum) + rest + infile.read())
+            return
+        dest = path.join(self.outdir, tnum, self.current_file)
+        if path.isfile(dest) and not self.overwrite:
+            raise ConversionException("The file {} already exists. Use --overwrite to replace it".format(dest))
+        make_folder_text(src, dest, tnum)
+
+
+def text_number(fname):
+    """
+    Returns the text number of a file name or text id, e.g. 0012 for lccw-0012-text.xml, or None if it has none
+    """
+    mtch = re.search(TEXT_NUMBER_PATTERN, fname)
+    return mtch.group(1) if mtch else None
+
+
+def folder_header(head, tnum, depth=0):
+    """
+    Rewrites the beginning of a text, up to the end of its first sourceDesc, for its text folder. Everything before
+    the root TEI.2 element is replaced with the folder DTD and the first sourceDesc with the tibbibl entity.
+
+    :param head: the bytes of the beginning of the text up to the end of its first sourceDesc
+    :param tnum: the text number
+    :param depth: the number of folders between the out folder and the text folder, e.g. 1 for the text folders in
+                  the folder of a template, whose relative paths each need one more ../
+    :return: bytes: the new beginning
+    """
+    root = head.find(b'<TEI.2')
+    if root == -1:
+        raise ConversionException("No TEI.2 root element found")
+    srcstart = head.find(b'<sourceDesc', root)
+    srcend = head.find(b'</sourceDesc>', srcstart) if srcstart > -1 else -1
+    if srcend == -1:
+        raise ConversionException("No sourceDesc element found in the header")
+    dtd = FOLDER_DTD.replace('SYSTEM "', 'SYSTEM "' + '../' * depth)
+    return dtd.replace('TNUM', tnum).encode('utf-8') + head[root + len(b'<TEI.2'):srcstart] + \
+        FOLDER_SOURCE_DESC.replace('TNUM', tnum).encode('utf-8') + head[srcend + len(b'</sourceDesc>'):]
+
+
+def read_header(infile):
+    """
+    Reads an open XML file up to the end of its first sourceDesc element
+
+    :return: tuple: (the bytes up to the end of the first sourceDesc, the rest of the bytes read)
+    """
+    data = b''
+    while True:
+        block = infile.read(HEADER_READ_SIZE)
+        # Search from a little before the new block in case the end tag is split between blocks
+        searchfrom = max(len(data) - len(b'</sourceDesc>'), 0)
+        data += block
+        end = data.find(b'</sourceDesc>', searchfrom)
+        if end > -1:
+            end += len(b'</sourceDesc>')
+            return data[:end], data[end:]
+        if not block:
+            return data, b''
+
+
+def make_folder_text(src, dest, tnum):
+    """
+    Writes the text at src, a path or an open binary file, to dest with its header rewritten for its text folder,
+    making the folder if needed
+    """
+    makedirs(path.dirname(dest) or '.', exist_ok=True)
+    with open(src, 'rb') if isinstance(src, str) else src as infile:
+        head, rest = read_header(infile)
+        newhead = folder_header(head, tnum)
+        with open(dest, 'wb') as outfile:
+            outfile.write(newhead)
+            outfile.write(rest)
+            copyfileobj(infile, outfile, COPY_BUFFER_SIZE)
@@ -0,0 +1,87 @@
+#!env/bin/python
+"""
+A SQLite store of converted TEI documents, so a catalog can query the texts by their header fields without
+scanning the out folder. Each text is a row keyed on its text id and template with the hash of its source document,
+the time of the conversion, the title, author, edition sigla and chapter number from its metadata table, and its XML
+compressed with zlib.
+
+Rows are written in batches of STORE_BATCH_SIZE per transaction. The store is a SQLiteSink, so in a parallel
+conversion the main process is the only writer to the database.
+"""
+import hashlib
+import zlib
+
+from .outputsink import SQLiteSink
+from .walkmanifest import file_hash
+
+STORE_BATCH_SIZE = 50
+STORE_COLUMNS = ('textid', 'file', 'source_hash', 'template', 'converted', 'title', 'author', 'edition_sigla',
+                 'chapter_number', 'xml')
+INDEXED_COLUMNS = ('title', 'author', 'edition_sigla', 'chapter_number', 'source_hash')
+
+
+def source_hash(src):
+    """
+    Returns the SHA-1 hash of a source document given by path or as a BytesIO
+    """
+    if isinstance(src, str):
+        return file_hash(src)
+    return hashlib.sha1(src.getvalue()).hexdigest()
+
+
+def read_xml(blob):
+    """
+    Returns the XML bytes of a stored text from its compressed blob
+    """
+    return zlib.decompress(blob)
+
+
+class TextStore(SQLiteSink):
+    """
+    The store of the converted texts in a SQLite database, which is opened when the first row is written and must
+    be closed at the end of the conversion to write the last batch. A text converted again with the same template
+    replaces its row.
+    """
+    schema = ('CREATE TABLE IF NOT EXISTS texts (textid TEXT NOT NULL, file TEXT, source_hash TEXT, '
+              'template TEXT NOT NULL, converted TEXT, title TEXT, author TEXT, edition_sigla TEXT, '
+              'chapter_number TEXT, xml BLOB, PRIMARY KEY (textid, template))',) + \
+        tuple('CREATE INDEX IF NOT EXISTS texts_{0} ON texts ({0})'.format(col) for col in INDEXED_COLUMNS)
+
+    def __init__(self, dbpath):
+        super().__init__(dbpath)
+        self.pending = []
+        self.stored = 0
+
+    def add(self, row):
+        """
+        Adds the row of a converted text, a dictionary keyed on STORE_COLUMNS with the XML uncompressed
+        """
+        self.put(dict(row, xml=zlib.compress(row['xml'])))
+
+    def write(self, row):
+        self.pending.append(tuple(row[col] for col in STORE_COLUMNS))
+        if len(self.pending) >= STORE_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        # Called with the lock held
+        if not self.pending:
+            return
+        if self.conn is None:
+            self.open()
+        rows, self.pending = self.pending, []
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO texts VALUES ({})'.format(
+                ', '.join('?' * len(STORE_COLUMNS))), rows)
+        self.stored += len(rows)
+
+    def close(self):
+        self.stop_listener()
+        with self.lock:
+            self.flush()
+        super().close()
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['pending'] = []
+        return state
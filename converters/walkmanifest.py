@@ -0,0 +1,104 @@
+#!env/bin/python
+"""
+Manifest of a tree of converted files, kept in the root of the out folder, so a later walk of the same tree only
+converts the files that changed. For each input file (keyed on its path relative to the in folder) it records the
+size, modification time and content hash of the input, the settings it was converted with and the size and
+modification time of the output. Delete the manifest file to convert the whole tree again.
+"""
+import hashlib
+import json
+import os
+
+MANIFEST_NAME = '.numpage-manifest.json'
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+class WalkManifest:
+    def __init__(self, outdir, name=MANIFEST_NAME):
+        self.path = os.path.join(outdir, name)
+        self.entries = {}
+
+    def load(self):
+        """
+        Loads the manifest if there is one. An unreadable manifest is ignored, so all files are converted again
+        """
+        self.entries = {}
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as mf:
+                    self.entries = json.load(mf).get('files', {})
+            except (OSError, ValueError, AttributeError):
+                print("Could not read the manifest {}, converting all files".format(self.path))
+                self.entries = {}
+        return self
+
+    def save(self):
+        tmppath = self.path + '.tmp'
+        with open(tmppath, 'w', encoding='utf-8') as mf:
+            json.dump({'files': self.entries}, mf, indent=1, sort_keys=True)
+        os.replace(tmppath, self.path)
+
+    def is_current(self, relpath, inpath, outpath, settings):
+        """
+        Checks whether a file was converted with the same settings and neither its input nor its output have changed
+        since. If only the modification time of the input changed, its hash is compared and the entry updated.
+
+        :param settings: dict of the conversion settings, e.g. start number
+        :return: bool
+        """
+        entry = self.entries.get(relpath)
+        if entry is None or entry.get('settings') != settings:
+            return False
+        try:
+            instat = os.stat(inpath)
+            outstat = os.stat(outpath)
+        except OSError:
+            return False
+        if outstat.st_size != entry.get('out_size') or outstat.st_mtime_ns != entry.get('out_mtime'):
+            return False
+        if instat.st_size != entry.get('size'):
+            return False
+        if instat.st_mtime_ns != entry.get('mtime'):
+            if file_hash(inpath) != entry.get('hash'):
+                return False
+            entry['mtime'] = instat.st_mtime_ns
+        return True
+
+    def record(self, relpath, inpath, outpath, settings, digest=None):
+        """
+        Adds or updates the entry of a converted file
+
+        :param digest: the hash of the input if already known, otherwise it is computed
+        """
+        instat = os.stat(inpath)
+        outstat = os.stat(outpath)
+        self.entries[relpath] = {
+            'size': instat.st_size,
+            'mtime': instat.st_mtime_ns,
+            'hash': digest or file_hash(inpath),
+            'settings': settings,
+            'out_size': outstat.st_size,
+            'out_mtime': outstat.st_mtime_ns,
+        }
+
+    def forget(self, relpath):
+        self.entries.pop(relpath, None)
+
+    def missing(self, relpaths):
+        """
+        :param relpaths: the relative paths of the files now in the in folder
+        :return: list of the relative paths in the manifest whose input no longer exists
+        """
+        current = set(relpaths)
+        return [rp for rp in self.entries if rp not in current]
+
+
+def file_hash(fpath):
+    """
+    Returns the SHA-1 hash of a file's content as a hex string
+    """
+    hsh = hashlib.sha1()
+    with open(fpath, 'rb') as fl:
+        for block in iter(lambda: fl.read(HASH_BLOCK_SIZE), b''):
+            hsh.update(block)
+    return hsh.hexdigest()
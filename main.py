@@ -3,8 +3,10 @@
 import argparse
 
 from converters.numberpages import NumberPages
+from converters.preflight import DocChecker
 from converters.textconverter import TextConverter
 from converters.digitalpages import DigitalPages
+from converters.textfolders import TextFolders
 
 
 def main():
@@ -12,9 +14,21 @@ def main():
 
     # Generate the arg parser and options
     parser = argparse.ArgumentParser(description='Convert THL Word marked up documents to THL TEI XML')
+    parser.add_argument('-ck', '--check',
+                        action='store_true',
+                        help='Check the documents in the in folder for unknown styles, heading errors, unbalanced '
+                             'lemma braces and unreferenced footnotes, without converting them')
     parser.add_argument('-d', '--debug',
                         action="store_true",
                         help='Whether to debug')
+    parser.add_argument('-db', '--database',
+                        default='',
+                        help='Path of a SQLite database in which to also store the converted XML files, compressed, '
+                             'with their text id, source hash and header fields')
+    parser.add_argument('-dp', '--digital-pages',
+                        action='store_true',
+                        help='Add digital pages and lines to the text as it is converted to XML, '
+                             'instead of first running the digpage conversion')
     parser.add_argument('-dtd', '--dtdpath',
                         default='http://texts.thlib.org/cocoon/texts/catalogs/',
                         help='Path to the xtib3.dtd to add to the xmlfile')
@@ -25,36 +39,75 @@ def main():
     parser.add_argument('-e', '--edition-sigla',
                         default='',
                         help="The main edition sigla to be used for a lemma readings")
+    parser.add_argument('-exp', '--export',
+                        choices=['jsonl', 'text'],
+                        help='Also export the text of each document, with its divs, paragraphs, verse lines and notes, '
+                             'as JSON Lines or plain text. The export type only exports, as JSON Lines by default')
     parser.add_argument('-ext', '--extension',
                         default='.docx',
                         help="The extension by which to filter the indocs")
     parser.add_argument('-i', '--indir',
                         default='./workspace/in',
-                        help='The relative path to the in-folder containing files to be converted. '
-                             'Defaults to ./workspace/in')
+                        help='The relative path to the in-folder containing files to be converted, or of a zip '
+                             'or tar archive of them. Defaults to ./workspace/in')
+    parser.add_argument('-inc', '--incremental',
+                        action='store_true',
+                        help='Keep the converted top level divs of each text in the .sections folder of the out folder '
+                             'and only convert again the divs whose paragraphs or footnotes have changed')
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=1,
+                        help='Number of worker processes to convert files in parallel. Defaults to 1')
     parser.add_argument('-l', '--log',
                         default='./workspace/logs',
                         help='The relative path to the out-folder where converted files are written. '
                              'Defaults to ./workspace/logs')
+    parser.add_argument('-ly', '--layout',
+                        choices=['flat', 'foldered'],
+                        default='flat',
+                        help='Write the XML files in the out folder (flat) or in text number folders within it '
+                             '(foldered), with the DTD and tibbibl entity paths for those folders. Defaults to flat')
+    parser.add_argument('-md', '--media',
+                        action='store_true',
+                        help='Extract the images of the documents to the media folder of the out folder, with '
+                             'thumbnails and web versions, and refer to them in the XML')
     parser.add_argument('-mtf', '--metafields',
                         action='store_true',
                         help='List the metadata fields in the template')
     parser.add_argument('-o', '--out',
                         default='./workspace/out',
-                        help='The relative path to the out-folder where converted files are written. '
-                             'Defaults to ./workspace/out')
+                        help='The relative path to the out-folder where converted files are written, or of a zip '
+                             'or tar archive to write them to. Defaults to ./workspace/out')
     parser.add_argument('-opt', '--options',
                         default='',
-                        help='JSON String of options for each converter')
+                        help='JSON String of options for each converter, or the path of a JSON file. '
+                             'For digital pages, the paging settings, profile and batch manifest')
     parser.add_argument('-ow', '--overwrite',
                         action='store_true',
                         help='Overwrite XML files by the same name in out directory')
+    parser.add_argument('-po', '--plan-only',
+                        action='store_true',
+                        help='For digital pages, only report the pages and lines that would be made, '
+                             'without writing the documents')
+    parser.add_argument('-q', '--quiet',
+                        action='store_true',
+                        help='Do not show the progress of the conversion')
+    parser.add_argument('-sc', '--style-cache',
+                        default='',
+                        help='Path of a JSON file in which to keep the style names of the documents, keyed on the hash '
+                             'of their styles, for later conversions')
+    parser.add_argument('-si', '--syllable-index',
+                        default='',
+                        help='Path of a SQLite database in which to index the Tibetan syllables of the texts, with the '
+                             'div, paragraph and page.line of each')
     parser.add_argument('-st', '--start',
                         default=1,
                         help="The incremental number to start with")
     parser.add_argument('-t', '--template',
                         default='tib_text.xml',
-                        help='Name of template file in template folder')
+                        help='Name of template file in template folder, or a comma separated list of them to write '
+                             'each document with several templates from one conversion. Each can be followed by = and '
+                             'the folder in the out folder for its files, which otherwise is named after the template')
     # Make type the only positional that defaults to word-2-xml
     parser.add_argument('-tp', '--type',
                         default="word-2-xml",
@@ -63,12 +116,21 @@ def main():
     args, extras = parser.parse_known_args()
 
     # Initialize appropriate converter for type
-    if args.type == 'digpage':
+    if args.check:
+        print("Checking Documents!")
+        converter = DocChecker(args)
+    elif args.type == 'digpage':
         print("Digital Page conversions!")
         converter = DigitalPages(args)
     elif args.type == 'numpage':
         print("Numbering Existing Milestones!")
         converter = NumberPages(args, extras)
+    elif args.type == 'export':
+        print("Exporting Text!")
+        converter = TextConverter(args, export_only=True)
+    elif args.type == 'textfolders':
+        print("Making Text Folders!")
+        converter = TextFolders(args)
     else:
         print("Word to XML Conversion")
         converter = TextConverter(args)
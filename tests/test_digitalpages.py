@@ -0,0 +1,154 @@
+"""
+Tests of the digital page and line placeholders added by the DigitalPaginator, against the run by run insertion
+it replaced. Run from the repository folder with:
+    python -m unittest discover tests
+"""
+import re
+import unittest
+
+import docx
+from docx.enum.style import WD_STYLE_TYPE
+
+from converters.digitalpages import DigitalPaginator, PagingOptions
+from converters.pageplan import plan_pages
+from converters.stylecache import StyleTable, read_style_names
+
+TMPLTS = {'page': 'tdp', 'line': 'tdl'}
+# The runs of each paragraph of the test document, as (style, list of (text, character style) tuples). The tsek
+# groups are split across runs, start or end runs, and some runs are empty or have none.
+PARAGRAPHS = [
+    ('Normal', [('Not paginated before the first heading་ ཀ་ཁ་ག་', None)]),
+    ('Heading 1', [('ལེའུ་དང་པོ།', None)]),
+    ('Normal', [('བཀྲ་ཤིས་', None), ('་བདེ་ལེགས', 'Tibetan'), (' ཕུན་', None), ('', None),
+                ('སུམ་ཚོགས།', 'Tibetan'), ('no tsek here', None)]),
+    ('Normal', [('༄༅། །རྒྱ་གར་སྐད་དུ།', None), ('ཨཱརྱ་', 'Tibetan'), ('་', None), ('ཏྲི་སྐནྡྷ་ནཱ་མ་', None)]),
+    ('Heading 2', [('སྐབས་གཉིས་པ།', None)]),
+    ('Normal', [('བོད་སྐད་དུ། ', 'Tibetan'), ('འཕགས་པ་ཕུང་པོ་གསུམ་པ་ཞེས་བྱ་བ་ཐེག་པ་ཆེན་པོའི་མདོ།', None)]),
+    ('Normal', [('ཀ', None), ('་ཁ', 'Tibetan'), ('་ག', None), ('་ང་', None)]),
+]
+
+
+def make_document():
+    worddoc = docx.Document()
+    for stnm in ('page number', 'line number', 'Tibetan'):
+        worddoc.styles.add_style(stnm, WD_STYLE_TYPE.CHARACTER)
+    for pstyle, runs in PARAGRAPHS:
+        p = worddoc.add_paragraph(style=pstyle)
+        for txt, rstyle in runs:
+            p.add_run(txt, rstyle)
+    return worddoc
+
+
+def per_run_texts(paras, tsekpattern, tsek_per_line, lines_per_page):
+    """
+    Inserts the placeholders into the run texts of the paginated paragraphs one run at a time, as
+    DigitalPages.insert_ms() did before the pages were planned for the whole document
+
+    :param paras: list of the lists of the run texts of each paragraph
+    :return: the run texts with the placeholders in the same lists
+    """
+    pgct, lnct, tskcount = 1, 0, 0
+    donefirst = False
+    result = []
+    for texts in paras:
+        ptexts = []
+        for rtxt in texts:
+            inserts = []
+            for m in re.finditer(tsekpattern, rtxt):
+                if m.start() == 0:
+                    continue
+                tskcount += 1
+                if tskcount == tsek_per_line:
+                    lnct += 1
+                    tskcount = 0
+                    if lnct == lines_per_page:
+                        pgct += 1
+                        lnct = 0
+                        inserts.append(('page', f"{pgct}", m))
+                    inserts.append(('line', f"{pgct}.{lnct + 1}", m))
+            inserts.reverse()
+            for mstype, msnum, m in inserts:
+                rtxt = rtxt[:m.end()] + f"[{TMPLTS[mstype]} {msnum}]" + rtxt[m.end():]
+            if not donefirst:
+                rtxt = f"[{TMPLTS['page']} 1][{TMPLTS['line']} 1.1]" + rtxt
+                donefirst = True
+            ptexts.append(rtxt)
+        result.append(ptexts)
+    return result
+
+
+def per_run_styles(runs, digstyles):
+    """
+    Splits runs at their page placeholders and then at their line placeholders, as DigitalPages.apply_styles() did
+
+    :param runs: list of the (text, style name) tuples of a paragraph
+    :return: list of the (text, style name) tuples of the new runs, without the empty ones
+    """
+    for mstype in ('page', 'line'):
+        pattern = r'\[' + TMPLTS[mstype] + (r'\s+\d+\]' if mstype == 'page' else r'\s+\d+\.\d+\]')
+        newruns = []
+        for rtxt, rstyle in runs:
+            mtchs = list(re.finditer(pattern, rtxt))
+            if len(mtchs) == 0:
+                newruns.append((rtxt, rstyle))
+                continue
+            newruns.append((rtxt[:mtchs[0].start()], rstyle))
+            for mi, mtch in enumerate(mtchs):
+                newruns.append((mtch.group(0).replace(TMPLTS[mstype] + ' ', ''), digstyles[mstype]))
+                endindex = mtchs[mi + 1].start() if mi < len(mtchs) - 1 else len(rtxt)
+                newruns.append((rtxt[mtch.end():endindex], rstyle))
+        runs = newruns
+    return [(rtxt, rstyle) for rtxt, rstyle in runs if rtxt != '']
+
+
+class DigitalPaginatorTest(unittest.TestCase):
+    def paginate(self, tsek_per_line, lines_per_page):
+        worddoc = make_document()
+        paginator = DigitalPaginator().configure({'tsek_per_line': tsek_per_line, 'lines_per_page': lines_per_page})
+        paginator.plan_document(worddoc, StyleTable(read_style_names(worddoc.styles.element)))
+        before = [[(r.text, r.style.name) for r in p.runs] for p in paginator.paras]
+        expected = per_run_texts([[txt for txt, _ in runs] for runs in before], paginator.tsekpattern,
+                                 tsek_per_line, lines_per_page)
+        paginator.apply()
+        return paginator, before, expected
+
+    def test_same_as_per_run_insertion(self):
+        for tsek_per_line, lines_per_page in ((1, 1), (2, 3), (3, 2), (7, 5), (20, 15)):
+            with self.subTest(tsek_per_line=tsek_per_line, lines_per_page=lines_per_page):
+                paginator, before, expected = self.paginate(tsek_per_line, lines_per_page)
+                self.assertEqual(len(paginator.paras), 4)
+                for p, runs, texts in zip(paginator.paras, before, expected):
+                    exruns = per_run_styles([(txt, rstyle) for txt, (_, rstyle) in zip(texts, runs)],
+                                            paginator.digstyles)
+                    self.assertEqual([(r.text, r.style.name) for r in p.runs if r.text != ''], exruns)
+
+    def test_counters_at_end(self):
+        paginator, _, expected = self.paginate(2, 3)
+        lines = re.findall(r'\[tdl (\d+)\.(\d+)\]', ''.join(txt for texts in expected for txt in texts))
+        self.assertEqual(paginator.plan.line_count, len(lines))
+        self.assertEqual(paginator.pgct, int(lines[-1][0]))
+
+
+class PagingOptionsTest(unittest.TestCase):
+    def test_tsek_pattern(self):
+        opts = PagingOptions('{"tsek_pattern": "[\\u0F0B\\u0F0D\\\\s]+", "tsek_per_line": 4}')
+        self.assertEqual(opts.for_file('a.docx'), {'tsek_pattern': '[\u0F0B\u0F0D\\s]+', 'tsek_per_line': 4})
+
+    def test_tsek_pattern_matching_run_separator(self):
+        # The runs are joined with a NUL character when the pages are planned, which a tsek group must not match
+        for pattern in ('[^\u0F40-\u0FBC]+', '\\W', '.', '\u0F0B.', '[\u0F0B\u0F0D]\\W?', '\u0F0B\\s*\\S?'):
+            with self.subTest(pattern=pattern):
+                with self.assertRaises(ValueError):
+                    PagingOptions({'tsek_pattern': pattern})
+
+    def test_plan_rejects_match_across_runs(self):
+        with self.assertRaises(ValueError):
+            plan_pages(['\u0F40\u0F0B\u0F41\u0F0B', '\u0F42\u0F0B'], re.compile('\u0F0B.'), 2, 2)
+
+    def test_invalid_tsek_pattern(self):
+        with self.assertRaises(ValueError):
+            PagingOptions({'tsek_pattern': '[\u0F0B'})
+
+
+if __name__ == '__main__':
+    unittest.main()
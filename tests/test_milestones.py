@@ -0,0 +1,30 @@
+"""
+Tests of the page and line milestones built by TextConverter.createmilestone(). Run from the repository folder with:
+    python -m unittest discover tests
+"""
+import unittest
+
+from converters.textconverter import TextConverter
+
+
+class CreateMilestoneTest(unittest.TestCase):
+    def milestone(self, char_style, mstxt):
+        ms = TextConverter.createmilestone(char_style, mstxt)
+        return ms.get('unit'), ms.get('n'), ms.get('ed')
+
+    def test_page_with_sigla(self):
+        self.assertEqual(self.milestone('Page Number', '[page Ad-7]'), ('page', '7', 'Ad'))
+        self.assertEqual(self.milestone('Page Number', '[page Dg-21b]'), ('page', '21b', 'Dg'))
+
+    def test_page_number_longer_than_sigla_number(self):
+        # The sigla is only split off when the whole number is SIGLA-NUM
+        self.assertEqual(self.milestone('Page Number', '[page D-12a.3]'), ('page', ' D-12a.3', None))
+        self.assertEqual(self.milestone('Page Number', '[Ad-7b-8]'), ('page', 'Ad-7b-8', None))
+
+    def test_plain_numbers(self):
+        self.assertEqual(self.milestone('Page Number', '[page 12]'), ('page', ' 12', None))
+        self.assertEqual(self.milestone('Line Number', '[line 3]'), ('line', '3', None))
+
+
+if __name__ == '__main__':
+    unittest.main()
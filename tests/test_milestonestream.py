@@ -0,0 +1,78 @@
+"""
+Tests of the streaming milestone numbering of NumberPages. Run from the repository folder with:
+    python -m unittest discover tests
+"""
+import re
+import unittest
+from io import BytesIO
+
+from converters.milestonestream import MilestoneNumberer, MilestoneIndexer
+
+SAMPLE = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE TEI.2 SYSTEM "../xtib3.dtd" [
+\t<!ENTITY lccw-0001-bib SYSTEM "../../0/lccw-0001-bib.xml">
+\t<!ENTITY tsek "&#x0F0B;">
+]>
+<TEI.2 rend="2"><teiHeader><sourceDesc>&lccw-0001-bib;</sourceDesc></teiHeader>
+<text><body><div1 id="d1">
+<!-- a <milestone unit="page" n="99"/> in a comment is not numbered -->
+<p>Tom &amp; Jerry<milestone unit="page" n="x"/>ཀ&tsek;ཁ <hi>ga</hi><milestone unit="line"/>nga</p>
+<p><milestone unit="page"></milestone>tail <![CDATA[<b>]]> text<lb/><milestone unit="line" n="7"/></p>
+</div1></body></text></TEI.2>
+'''.encode('utf-8')
+
+
+def number(numberer, data=SAMPLE):
+    outstream = BytesIO()
+    numberer.run(data, outstream)
+    return outstream.getvalue()
+
+
+def unnumbered(data):
+    """
+    Returns an XML text without the n attributes of its milestones, to compare it with the input
+    """
+    return re.sub(rb'(<milestone unit="[^"]*")(?: n="[^"]*")?', rb'\1', data)
+
+
+class MilestoneNumbererTest(unittest.TestCase):
+    def test_pass_through(self):
+        output = number(MilestoneNumberer(start=1))
+        self.assertEqual(unnumbered(output), unnumbered(SAMPLE))
+        # The DOCTYPE, entities and comments are copied as they are
+        self.assertEqual(output[:output.index(b'<TEI.2')], SAMPLE[:SAMPLE.index(b'<TEI.2')])
+        for kept in (b'&lccw-0001-bib;', b'&tsek;', b'Tom &amp; Jerry', b'<![CDATA[<b>]]>',
+                     b'<!-- a <milestone unit="page" n="99"/> in a comment is not numbered -->'):
+            self.assertIn(kept, output)
+
+    def test_numbers(self):
+        numberer = MilestoneNumberer(start=1)
+        output = number(numberer)
+        # The rend of the root is added to the start number, and the milestone in the comment is left as it is
+        self.assertEqual(re.findall(rb'<milestone unit="(\w+)" n="([^"]*)"', output.split(b'-->')[1]),
+                         [(b'page', b'3'), (b'line', b'3.1'), (b'page', b'4'), (b'line', b'4.1')])
+        self.assertEqual(numberer.milestone_ct, 4)
+
+    def test_add_first_after_tail_text(self):
+        output = number(MilestoneNumberer(start=1, add_first=True)).decode('utf-8')
+        self.assertIn('<milestone unit="page" n="3"/>ཀ&tsek;ཁ <milestone unit="line" n="3.1"/><hi>ga</hi>'
+                      '<milestone unit="line" n="3.2"/>nga', output)
+        # CDATA is part of the tail text
+        self.assertIn('<milestone unit="page" n="4"></milestone>tail <![CDATA[<b>]]> text'
+                      '<milestone unit="line" n="4.1"/><lb/><milestone unit="line" n="4.2"/>', output)
+
+    def test_index_offsets(self):
+        for add_first in (False, True):
+            with self.subTest(add_first=add_first):
+                indexer = MilestoneIndexer(start=1, add_first=add_first)
+                output = number(indexer)
+                self.assertEqual(len(indexer.entries), 6 if add_first else 4)
+                for entry in indexer.entries:
+                    tag = output[entry['offset']:output.index(b'>', entry['offset']) + 1]
+                    self.assertTrue(tag.startswith(b'<milestone'), tag)
+                    self.assertIn('n="{}"'.format(entry['n']).encode('utf-8'), tag)
+                    self.assertEqual(entry['div'], 'd1')
+
+
+if __name__ == '__main__':
+    unittest.main()